@@ -63,6 +63,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': os.path.join(BASE_DIR, 'figgy.db.sqlite3'),
+        # Seconds a write waits for another process' lock before "database is locked".
+        'OPTIONS': {'timeout': 30},
     }
 }
 
@@ -85,6 +87,9 @@ USE_TZ = True
 
 STATIC_URL = '/static/'
 
+# Which of CACHES storage.caching keeps books and identifier lookups in.
+STORAGE_CACHE = 'default'
+
 
 try:
     from local import *
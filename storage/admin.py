@@ -1,41 +1,173 @@
 from django.contrib import admin
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR, PAGE_VAR, SEARCH_VAR
+from django.core.paginator import InvalidPage
+from django.db import connection
 
+from storage import search
 from storage.models import Alias, Book, Conflict
+from storage.pagination import EstimatedCountPaginator, estimated_count, keyset_filter
+
+# Query string parameter holding the pk of the last row of the previous page.
+AFTER_VAR = 'after'
+
+
+class KeysetChangeList(ChangeList):
+    """ChangeList that pages forward by keyset instead of OFFSET and never counts exactly
+
+    Keyset paging applies while the list is in its default ordering, which must end with the
+    primary key; sorting by a column or by search relevance falls back to numbered pages. Either
+    way the counts come from estimated_count.
+    """
+
+    def get_filters_params(self, params=None):
+        lookup_params = super(KeysetChangeList, self).get_filters_params(params)
+        lookup_params.pop(AFTER_VAR, None)
+        return lookup_params
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(request, self.queryset, self.list_per_page)
+        result_count = paginator.count
+        if self.get_filters_params() or self.params.get(SEARCH_VAR):
+            full_result_count = estimated_count(self.root_queryset)
+        else:
+            full_result_count = result_count
+        can_show_all = result_count <= self.list_max_show_all
+
+        self.keyset = (
+            ORDER_VAR not in self.params and not self.queryset.query.extra_order_by and
+            not self.list_editable and not (self.show_all and can_show_all))
+        self.first_page_url = self.next_page_url = None
+        if self.keyset:
+            result_list = self.get_keyset_page()
+            multi_page = bool(self.first_page_url or self.next_page_url)
+        else:
+            multi_page = result_count > self.list_per_page
+            if (self.show_all and can_show_all) or not multi_page:
+                result_list = self.queryset._clone()
+            else:
+                try:
+                    result_list = paginator.page(self.page_num + 1).object_list
+                except InvalidPage:
+                    raise IncorrectLookupParameters
+
+        self.result_count = result_count
+        self.full_result_count = full_result_count
+        self.result_list = result_list
+        self.can_show_all = can_show_all
+        self.multi_page = multi_page
+        self.paginator = paginator
+
+    def get_keyset_page(self):
+        """Return the rows of the page after the AFTER_VAR row and set the paging links"""
+        queryset = self.queryset
+        after = self.params.get(AFTER_VAR)
+        if after:
+            ordering = queryset.query.order_by
+            try:
+                values = self.model._default_manager.filter(pk=after).values_list(
+                    *[name.lstrip('-') for name in ordering]).first()
+            except (ValueError, TypeError):
+                raise IncorrectLookupParameters
+            if values is None:
+                raise IncorrectLookupParameters
+            queryset = queryset.filter(keyset_filter(ordering, values))
+            self.first_page_url = self.get_query_string(remove=[AFTER_VAR, PAGE_VAR])
+        # One row more than a page tells whether there is a next page.
+        rows = list(queryset[:self.list_per_page + 1])
+        if len(rows) > self.list_per_page:
+            self.next_page_url = self.get_query_string(
+                {AFTER_VAR: rows[self.list_per_page - 1].pk}, remove=[PAGE_VAR])
+        return rows[:self.list_per_page]
+
+
+class KeysetPaginationMixin(object):
+    """ModelAdmin mixin for tables too large to COUNT(*) or OFFSET into on every page"""
+    paginator = EstimatedCountPaginator
+    change_list_template = 'admin/keyset_change_list.html'
+
+    def get_changelist(self, request, **kwargs):
+        return KeysetChangeList
 
 
 class InlineAliasAdmin(admin.StackedInline):
     model = Alias
     extra = 0
 
+    def get_queryset(self, request):
+        # Each inline's header is the alias' __unicode__, which names its book.
+        return super(InlineAliasAdmin, self).get_queryset(request).select_related('book')
+
 
 class InlineConflictAdmin(admin.StackedInline):
     model = Conflict
     extra = 0
+    # Conflicts are found by the importer and scan_conflicts, not entered by hand. Showing the
+    # alias read-only spares every inline a <select> of the whole Alias table.
+    readonly_fields = ['alias']
+
+    def get_queryset(self, request):
+        return super(InlineConflictAdmin, self).get_queryset(request).select_related(
+            'book', 'alias__book')
 
+    def has_add_permission(self, request):
+        return False
 
-class BookAdmin(admin.ModelAdmin):
+
+class BookAdmin(KeysetPaginationMixin, admin.ModelAdmin):
     inlines = [InlineConflictAdmin, InlineAliasAdmin]
+    # Ends with the pk, as keyset paging needs; the title index holds the rowid, so it serves both.
+    # Searches are ranked by relevance instead.
+    ordering = ['title', 'id']
+    search_fields = ['title']
+
+    list_display = ['title', 'id', 'num_aliases', 'list_aliases', 'num_conflicts',
+                    'list_conflicts']
+
+    def get_queryset(self, request):
+        # A fixed number of queries per changelist page, however many rows it shows. The counts
+        # come from the prefetched rows: annotating them would group and sort the whole table on
+        # every page.
+        return super(BookAdmin, self).get_queryset(request).prefetch_related(
+            'aliases', 'conflicted_books__alias__book')
+
+    def get_search_results(self, request, queryset, search_term):
+        """Find the books whose title or description hold the search words, best match first"""
+        if not search_term.strip():
+            return queryset, False
+        if connection.vendor != 'sqlite':
+            return queryset.filter(title__istartswith=search_term.strip()), False
+        return search.search_books(search_term, queryset), False
+
+    def num_aliases(self, obj):
+        return len(obj.aliases.all())
+
+    num_aliases.short_description = 'aliases'
+
+    def num_conflicts(self, obj):
+        return len(obj.conflicted_books.all())
 
-    list_display = ['title', 'id', 'list_aliases', 'list_conflicts']
+    num_conflicts.short_description = 'conflicts'
 
     def list_aliases(self, obj):
         if obj:
+            # Sorted here rather than with order_by(), which would bypass the prefetched rows.
             return '<pre>{}</pre>'.format('\n'.join(
                 ['{0: <9}: {1}'.format(o.scheme, o.value)
-                 for o in obj.aliases.all().order_by('scheme')])
+                 for o in sorted(obj.aliases.all(), key=lambda o: o.scheme)])
             )
 
     list_aliases.allow_tags = True
 
     def list_conflicts(self, obj):
         if obj:
-            conflicts = Conflict.objects.filter(book=obj)
+            conflicts = sorted(obj.conflicted_books.all(), key=lambda c: c.alias.book.title)
             return '<pre>{}</pre>'.format('\n'.join(
                 ['{title}: {scheme}/{value}'.format(
                     title=conflict.alias.book.title,
                     scheme=conflict.alias.scheme,
                     value=conflict.alias.value)
-                 for conflict in conflicts.all().order_by('book__title')])
+                 for conflict in conflicts])
             )
 
     list_conflicts.allow_tags = True
@@ -0,0 +1,251 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Import, conflict-detection and admin benchmarks over synthetic catalogs
+
+Each catalog size runs in a child process of its own against a scratch SQLite database, so the
+peak RSS reported is that size's and the configured database is never touched. Results are
+plain dicts, saved as JSON by run_benchmarks so that runs can be compared over time.
+"""
+import datetime
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import django
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.test.client import RequestFactory
+
+from storage import generator, tools
+from storage.admin import BookAdmin
+from storage.models import Book
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+DEFAULT_SIZES = (10000, 100000, 1000000)
+
+# Books sampled for the per-book measurements, and renders of each admin page.
+ELEMENT_SAMPLE = 1000
+CONFLICT_SAMPLE = 1000
+ADMIN_REPEATS = 5
+
+# (name, query string) of the admin changelist pages timed. Any sort chosen in the changelist
+# turns keyset paging off, so sorting by id times the OFFSET paging it falls back to.
+ADMIN_PAGES = (
+    ('first_page', {}),
+    ('offset_sorted_by_id', {'o': '-2'}),
+    ('search', {'q': 'python'}),
+)
+
+# The figures compare() shows, as key paths into the results of each size.
+COMPARED = (
+    ('process_data_file', 'books_per_sec'),
+    ('process_data_file_update', 'books_per_sec'),
+    ('process_book_element', 'books_per_sec'),
+    ('conflict_detection', 'p95_ms'),
+    ('admin_changelist', 'first_page', 'mean_ms'),
+    ('peak_rss_kb',),
+)
+
+
+def run_benchmarks(sizes, workdir, catalog, layout='single', import_options=None):
+    """Benchmark a catalog like `catalog` at each of sizes; return the results to save
+
+    catalog is a generator.Catalog whose settings every size uses, with its number of books
+    replaced. Feeds and scratch databases are written under workdir. import_options are passed
+    to process_data_file.
+    """
+    results = {
+        'started': datetime.datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'django': django.get_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'layout': layout,
+        'catalog': catalog.settings(),
+        'import_options': import_options or {},
+        'sizes': [],
+    }
+    # Children must not share this process' database connection.
+    connection.close()
+    for num_books in sizes:
+        catalog.num_books = num_books
+        pool = multiprocessing.Pool(1)
+        try:
+            results['sizes'].append(pool.apply(
+                benchmark_size, (catalog, os.path.join(workdir, str(num_books)), layout,
+                                 import_options or {})))
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    return results
+
+
+def benchmark_size(catalog, workdir, layout, import_options):
+    """Write catalog's feeds under workdir, import them into a scratch database and measure"""
+    feeds = generator.write_catalog(os.path.join(workdir, 'feeds'), catalog, layout)
+    result = {'books': catalog.num_books}
+    try:
+        with scratch_database(os.path.join(workdir, 'benchmark.sqlite3')):
+            for name, feed in (('process_data_file', 'initial'),
+                               ('process_data_file_update', 'update')):
+                paths, num_records = feeds[feed]
+                seconds = timed(run_import, paths, import_options)
+                result[name] = rate(num_records, seconds)
+            result['process_book_element'] = benchmark_elements(catalog)
+            result['conflict_detection'] = benchmark_conflicts()
+            result['admin_changelist'] = benchmark_admin()
+    finally:
+        shutil.rmtree(os.path.join(workdir, 'feeds'), ignore_errors=True)
+    # In kilobytes on Linux, in bytes on Mac OS X.
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        result['peak_rss_kb'] //= 1024
+    return result
+
+
+@contextmanager
+def scratch_database(path):
+    """Point the default connection at a new SQLite database at path while the block runs"""
+    if connection.vendor != 'sqlite':
+        raise ValueError('Benchmarks run on SQLite only')
+    if os.path.exists(path):
+        os.remove(path)
+    connection.close()
+    old_name, connection.settings_dict['NAME'] = connection.settings_dict['NAME'], path
+    try:
+        call_command('syncdb', interactive=False, verbosity=0)
+        yield
+    finally:
+        connection.close()
+        connection.settings_dict['NAME'] = old_name
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def run_import(paths, import_options):
+    """Run process_data_file over paths, throwing away what it prints"""
+    stdout, sys.stdout = sys.stdout, open(os.devnull, 'w')
+    try:
+        call_command('process_data_file', *paths, **import_options)
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+def benchmark_elements(catalog, sample=ELEMENT_SAMPLE):
+    """Time process_book_element on sample new books, some in conflict with stored ones"""
+    # The books that would follow the catalog's last one.
+    elements = [generator.book_element(catalog.book(n))
+                for n in range(catalog.num_books, catalog.num_books + sample)]
+    seconds = timed(lambda: [tools.process_book_element(element) for element in elements])
+    return rate(len(elements), seconds)
+
+
+def benchmark_conflicts(sample=CONFLICT_SAMPLE):
+    """Time get_alias_conflicts for sample books picked at random"""
+    last_id = Book.objects.order_by('-id').values_list('id', flat=True).first() or 0
+    ids = random.Random(0).sample(range(1, last_id + 1), min(sample, last_id))
+    samples = []
+    for book in tools.in_chunks(Book.objects.all(), 'id', ids):
+        samples.append(timed(tools.get_alias_conflicts, book))
+    return summarize(samples)
+
+
+def benchmark_admin(repeats=ADMIN_REPEATS):
+    """Time rendering the Book changelist pages of ADMIN_PAGES, as a superuser"""
+    model_admin = BookAdmin(Book, admin.site)
+    factory = RequestFactory()
+    user = User(username='benchmark', is_active=True, is_staff=True, is_superuser=True)
+    timings = {}
+    for name, params in ADMIN_PAGES:
+        samples = []
+        for n in range(repeats):
+            request = factory.get('/admin/storage/book/', params)
+            request.user = user
+            samples.append(timed(lambda: model_admin.changelist_view(request).render()))
+        timings[name] = summarize(samples)
+    return timings
+
+
+def timed(func, *args, **kwargs):
+    """Return the seconds func(*args, **kwargs) took"""
+    start = time.time()
+    func(*args, **kwargs)
+    return time.time() - start
+
+
+def rate(num_books, seconds):
+    """Return the throughput of num_books books in seconds"""
+    return {'books': num_books, 'seconds': round(seconds, 3),
+            'books_per_sec': round(num_books / seconds, 1) if seconds else None}
+
+
+def summarize(samples):
+    """Return the mean, median, 95th percentile and maximum of samples in seconds, in ms"""
+    if not samples:
+        return {'count': 0}
+    samples = sorted(samples)
+
+    def ms(seconds):
+        return round(seconds * 1000, 3)
+    return {
+        'count': len(samples),
+        'mean_ms': ms(sum(samples) / len(samples)),
+        'p50_ms': ms(samples[len(samples) // 2]),
+        'p95_ms': ms(samples[min(len(samples) - 1, int(len(samples) * 0.95))]),
+        'max_ms': ms(samples[-1]),
+    }
+
+
+def git_revision():
+    """Return the commit the working tree is at, or None outside a git checkout"""
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', 'HEAD'], stderr=devnull).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(old, new):
+    """Return lines setting the COMPARED figures of two results side by side, size by size"""
+    old_sizes = dict((result['books'], result) for result in old['sizes'])
+    lines = []
+    for result in new['sizes']:
+        previous = old_sizes.get(result['books'])
+        if previous is None:
+            continue
+        lines.append('{} books:'.format(result['books']))
+        for path in COMPARED:
+            before, after = lookup(previous, path), lookup(result, path)
+            if before is None or after is None:
+                continue
+            change = '{:+.1f}%'.format((after - before) * 100.0 / before) if before else ''
+            lines.append('    {name}: {before} -> {after} {change}'.format(
+                name='.'.join(path), before=before, after=after, change=change).rstrip())
+    return lines
+
+
+def lookup(result, path):
+    """Return the figure at key path in result, or None if it has none"""
+    for key in path:
+        if not isinstance(result, dict) or key not in result:
+            return None
+        result = result[key]
+    return result
@@ -0,0 +1,121 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Opt-in SQLite settings for commands that write a large part of the database at once
+
+By default the database runs in rollback-journal mode with synchronous=FULL and a small page
+cache, which suits the web application but costs imports an fsync per commit and a lot of
+re-reading. bulk_load() switches to WAL with lighter syncing and a larger cache for as long as
+it lasts, and can leave some indexes to be built once at the end of a first load.
+"""
+from contextlib import contextmanager
+
+from django.db import connection
+from django.db.backends.signals import connection_created
+
+from storage.models import Alias, Book, Conflict
+
+# Books stored per transaction while loading, where a command lets that be chosen.
+BULK_BATCH_SIZE = 5000
+
+# Journal mode while loading. WAL appends commits to a log instead of rewriting pages, and lets
+# readers carry on while a batch is written.
+BULK_JOURNAL_MODE = 'wal'
+
+# Per-connection settings while loading. With WAL, synchronous=NORMAL stays consistent after a
+# crash but may lose the last commits on power loss; cache_size is in KiB when negative.
+BULK_PRAGMAS = (
+    ('synchronous', 'NORMAL'),
+    ('cache_size', -256 * 1024),
+    ('mmap_size', 256 * 1024 * 1024),
+)
+
+# Single-column indexes a first load does without; each is built in one pass once it is done.
+DEFERRABLE_INDEXES = (
+    (Book, 'title'),
+    (Book, 'last_modified_time'),
+    (Alias, 'value'),
+    (Alias, 'last_modified_time'),
+    (Conflict, 'last_modified_time'),
+)
+
+
+def pragma(name, value=None):
+    """Return the current value of the SQLite setting name, setting it to value first if given"""
+    cursor = connection.cursor()
+    if value is None:
+        cursor.execute('PRAGMA {}'.format(name))
+    else:
+        cursor.execute('PRAGMA {} = {}'.format(name, value))
+    row = cursor.fetchone()
+    return row[0] if row else None
+
+
+@contextmanager
+def bulk_load(drop_indexes=False):
+    """Run the enclosed block with the database set up for loading, and restore it afterwards
+
+    With drop_indexes the DEFERRABLE_INDEXES are dropped first and created again at the end, then
+    ANALYZE is run; that is only allowed while there are no books yet. The previous journal mode
+    and settings are restored however the block ends. Backends other than SQLite are left alone.
+    """
+    if connection.vendor != 'sqlite':
+        yield
+        return
+    saved = [(name, pragma(name)) for name, value in BULK_PRAGMAS]
+    # The journal mode cannot change inside a transaction, nor for an in-memory database.
+    journal_mode = None if connection.in_atomic_block else pragma('journal_mode')
+    dropped = []
+    try:
+        if journal_mode is not None:
+            pragma('journal_mode', BULK_JOURNAL_MODE)
+        _apply_bulk_pragmas()
+        # Connections opened while loading, e.g. after a worker pool closed this one, too.
+        connection_created.connect(_apply_bulk_pragmas)
+        if drop_indexes:
+            dropped = drop_deferrable_indexes()
+        yield
+    finally:
+        connection_created.disconnect(_apply_bulk_pragmas)
+        cursor = connection.cursor()
+        for sql in dropped:
+            cursor.execute(sql)
+        if dropped:
+            cursor.execute('ANALYZE')
+        for name, value in saved:
+            if value is not None:
+                pragma(name, value)
+        if journal_mode is not None:
+            pragma('journal_mode', journal_mode)
+
+
+def _apply_bulk_pragmas(sender=None, connection=connection, **kwargs):
+    if connection.vendor == 'sqlite':
+        cursor = connection.cursor()
+        for name, value in BULK_PRAGMAS:
+            cursor.execute('PRAGMA {} = {}'.format(name, value))
+
+
+def drop_deferrable_indexes():
+    """Drop the DEFERRABLE_INDEXES of an empty database; return the SQL creating them again
+
+    Raises ValueError if there are books already: rebuilding their indexes would cost more than
+    keeping them up to date.
+    """
+    if Book.objects.exists():
+        raise ValueError('Indexes can only be dropped before the first load')
+    qn = connection.ops.quote_name
+    cursor = connection.cursor()
+    statements = []
+    for model, field_name in DEFERRABLE_INDEXES:
+        column = model._meta.get_field(field_name).column
+        # Automatic indexes backing UNIQUE constraints have no SQL and cannot be dropped.
+        cursor.execute(
+            "SELECT name, sql FROM sqlite_master "
+            "WHERE type = 'index' AND tbl_name = %s AND sql IS NOT NULL", [model._meta.db_table])
+        for name, sql in cursor.fetchall():
+            cursor.execute('PRAGMA index_info({})'.format(qn(name)))
+            if [row[2] for row in cursor.fetchall()] == [column]:
+                cursor.execute('DROP INDEX {}'.format(qn(name)))
+                statements.append(sql)
+    return statements
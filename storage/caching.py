@@ -0,0 +1,169 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Cached reads of books and identifier lookups, invalidated as the rows behind them change
+
+Two kinds of entries are kept: the ids of the books holding a (scheme, value), and a book's
+serialize_book data. Saves and deletes of Book, Alias and Conflict invalidate them through
+signals; the bulk paths that write without signals (the batch importer, the conflict scanner,
+clustering) call invalidate_books and invalidate_aliases themselves. Entries also expire after
+CACHE_TIMEOUT, which bounds how long a reader racing an uncommitted write can keep stale data.
+
+The backend is the Django cache named by the STORAGE_CACHE setting ('default' if unset), so any
+configured backend can be plugged in.
+"""
+import hashlib
+from collections import Counter
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models.signals import post_delete, post_init, post_save
+from django.dispatch import receiver
+from django.utils import six
+
+from storage.models import Alias, Book, Conflict
+from storage.serializers import BOOK_PREFETCH, serialize_book
+
+CACHE_TIMEOUT = 300
+
+_backend = None
+_stats = Counter()
+
+
+def backend():
+    global _backend
+    if _backend is None:
+        _backend = get_cache(getattr(settings, 'STORAGE_CACHE', 'default'))
+    return _backend
+
+
+def stats():
+    """Return the hits, misses and evictions (entries invalidated) of this process"""
+    return {'hits': _stats['hits'], 'misses': _stats['misses'], 'evictions': _stats['evictions']}
+
+
+def book_key(book_id):
+    return 'storage:book:{}'.format(book_id)
+
+
+def alias_key(scheme, value):
+    # Identifiers can hold anything; memcached keys cannot.
+    digest = hashlib.sha1(u'{}\x00{}'.format(scheme, value).encode('utf-8')).hexdigest()
+    return 'storage:alias:{}'.format(digest)
+
+
+def get_book(book_id):
+    """Return serialize_book data for a book, or None if there is no such book"""
+    key = book_key(book_id)
+    data = backend().get(key)
+    if data is not None:
+        _stats['hits'] += 1
+        return data
+    _stats['misses'] += 1
+    book = Book.objects.prefetch_related(*BOOK_PREFETCH).filter(pk=book_id).first()
+    if book is None:
+        return None
+    data = serialize_book(book)
+    backend().set(key, data, CACHE_TIMEOUT)
+    return data
+
+
+def resolve(scheme, value):
+    """Return the sorted ids of the books holding (scheme, value)"""
+    return resolve_many([(scheme, value)])[(scheme, value)]
+
+
+def resolve_many(pairs):
+    """Return a dict of (scheme, value) -> sorted ids of the books holding it for each of pairs
+
+    Schemes and values are text, as stored in Alias; anything else raises TypeError, since it
+    would share the cache key of its text without matching any row. Identifiers missing from the
+    cache are looked up together, one query per tools.MAX_QUERY_PARAMS values, and cached, those
+    no book holds included.
+    """
+    # tools imports this module, so this one cannot import tools until it is called.
+    from storage.tools import MAX_QUERY_PARAMS
+    texts = dict((pair, (_text(pair[0]), _text(pair[1]))) for pair in set(pairs))
+    keys = dict((alias_key(scheme, value), (scheme, value)) for scheme, value in texts.values())
+    cached = backend().get_many(list(keys))
+    found = dict((keys[key], book_ids) for key, book_ids in cached.items())
+    _stats['hits'] += len(found)
+    missing = set(keys.values()) - set(found)
+    _stats['misses'] += len(missing)
+    if missing:
+        holders = dict((pair, set()) for pair in missing)
+        values = sorted(set(value for scheme, value in missing))
+        for start in range(0, len(values), MAX_QUERY_PARAMS):
+            rows = Alias.objects.filter(
+                value__in=values[start:start + MAX_QUERY_PARAMS]).values_list(
+                'scheme', 'value', 'book_id')
+            for scheme, value, book_id in rows:
+                if (scheme, value) in holders:
+                    holders[(scheme, value)].add(book_id)
+        loaded = dict((pair, sorted(book_ids)) for pair, book_ids in holders.items())
+        backend().set_many(
+            dict((alias_key(*pair), book_ids) for pair, book_ids in loaded.items()),
+            CACHE_TIMEOUT)
+        found.update(loaded)
+    return dict((pair, found[text]) for pair, text in texts.items())
+
+
+def _text(part):
+    if isinstance(part, six.binary_type):
+        return part.decode('utf-8')
+    if not isinstance(part, six.text_type):
+        raise TypeError('Identifier schemes and values are text, not {!r}'.format(part))
+    return part
+
+
+def invalidate_books(book_ids):
+    """Drop the cached data of the given books"""
+    keys = [book_key(book_id) for book_id in set(book_ids) if book_id is not None]
+    if keys:
+        backend().delete_many(keys)
+        _stats['evictions'] += len(keys)
+
+
+def invalidate_aliases(pairs):
+    """Drop the cached lookups of the given (scheme, value) pairs"""
+    keys = [alias_key(scheme, value) for scheme, value in set(pairs)]
+    if keys:
+        backend().delete_many(keys)
+        _stats['evictions'] += len(keys)
+
+
+@receiver(post_save, sender=Book)
+@receiver(post_delete, sender=Book)
+def _book_changed(sender, instance, **kwargs):
+    invalidate_books([instance.pk])
+
+
+def _row_keys(sender, instance):
+    """Return the book id and, for an alias, the (scheme, value) the row is cached under"""
+    if sender is Alias:
+        return instance.book_id, (instance.scheme, instance.value)
+    return instance.book_id, None
+
+
+@receiver(post_init, sender=Alias)
+@receiver(post_init, sender=Conflict)
+def _row_loaded(sender, instance, **kwargs):
+    # Kept so that an edited row also invalidates what it held before, without reading it back.
+    instance._cached_keys = _row_keys(sender, instance)
+
+
+@receiver(post_save, sender=Alias)
+@receiver(post_delete, sender=Alias)
+@receiver(post_save, sender=Conflict)
+@receiver(post_delete, sender=Conflict)
+def _row_changed(sender, instance, created=False, **kwargs):
+    keys = _row_keys(sender, instance)
+    original = getattr(instance, '_cached_keys', keys)
+    instance._cached_keys = keys
+    invalidate_books([keys[0], original[0]])
+    if sender is Alias:
+        invalidate_aliases([keys[1], original[1]])
+        if not created and keys != original:
+            # The books in conflict with an edited alias show it too.
+            invalidate_books(Conflict.objects.filter(alias=instance).values_list(
+                'book_id', flat=True))
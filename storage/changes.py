@@ -0,0 +1,85 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Change feed: the books modified after a cursor, oldest change first
+
+A cursor is an opaque string standing for the (last_modified_time, id) of the last book a
+consumer has seen. Pages are read by keyset on that pair, which the last_modified_time index
+(holding the id as its rowid) serves in order, so every page costs the same however far into
+the feed it is.
+
+Only a book's own saves move it in the feed; conflicts that other books' imports add to it later
+show up the next time the book itself changes.
+
+A write stamps its books when it makes the change, not when it commits, and an import batch can
+hold its transaction open for a while. A page therefore stops at books modified SAFETY_WINDOW
+ago: books stamped more recently may still be joined by earlier stamps of a transaction that
+has not committed yet, which a cursor past them would skip for good. Consumers see each change
+SAFETY_WINDOW late, and a transaction open for longer than that can still be missed.
+"""
+import base64
+import binascii
+from datetime import datetime, timedelta
+
+from django.conf import settings
+from django.utils import timezone
+
+from storage.models import Book
+from storage.pagination import keyset_filter
+from storage.serializers import BOOK_PREFETCH
+
+DEFAULT_PAGE_SIZE = 500
+# Longer than a batch import transaction is expected to stay open.
+SAFETY_WINDOW = timedelta(minutes=2)
+ORDERING = ['last_modified_time', 'id']
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(book):
+    """Return the cursor standing for book's place in the feed"""
+    modified = book.last_modified_time
+    if timezone.is_aware(modified):
+        modified = timezone.make_naive(modified, timezone.utc)
+    raw = '{}/{}'.format(modified.strftime(TIME_FORMAT), book.id)
+    return base64.urlsafe_b64encode(raw.encode('ascii')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """Return the (last_modified_time, id) a cursor stands for; raise ValueError if it is bad"""
+    try:
+        raw = base64.urlsafe_b64decode(str(cursor)).decode('ascii')
+        modified, book_id = raw.split('/')
+        modified, book_id = datetime.strptime(modified, TIME_FORMAT), int(book_id)
+    except (TypeError, UnicodeError, binascii.Error, ValueError):
+        raise ValueError('Invalid change feed cursor: {!r}'.format(cursor))
+    if settings.USE_TZ:
+        modified = timezone.make_aware(modified, timezone.utc)
+    return modified, book_id
+
+
+def changes_page(cursor=None, page_size=DEFAULT_PAGE_SIZE, safety_window=SAFETY_WINDOW):
+    """Return the next page of changed books after cursor and the cursor that follows it
+
+    With no cursor the feed starts at the beginning. Books modified less than safety_window ago
+    are left for a later page. An empty page comes back with the cursor it was given, to be
+    retried later.
+    """
+    books = Book.objects.filter(last_modified_time__lt=timezone.now() - safety_window).order_by(
+        *ORDERING)
+    if cursor:
+        books = books.filter(keyset_filter(ORDERING, decode_cursor(cursor)))
+    books = list(books.prefetch_related(*BOOK_PREFETCH)[:page_size])
+    if books:
+        cursor = encode_cursor(books[-1])
+    return books, cursor
+
+
+def iter_changes(cursor=None, page_size=DEFAULT_PAGE_SIZE, safety_window=SAFETY_WINDOW):
+    """Yield (books, cursor) pages until the feed is caught up"""
+    while True:
+        books, cursor = changes_page(cursor, page_size, safety_window)
+        if not books:
+            break
+        yield books, cursor
+        if len(books) < page_size:
+            break
@@ -0,0 +1,159 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from array import array
+
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from storage import caching
+from storage.models import Alias, Book
+
+try:
+    range = xrange
+except NameError:
+    pass
+
+DEFAULT_CHUNK_SIZE = 10000
+
+# Every alias in (scheme, value, id) order, a page at a time, straight off the (scheme, value)
+# index, so aliases sharing a pair arrive next to each other.
+ALIAS_PAGE_SQL = (
+    'SELECT id, book_id, scheme, value FROM {alias} WHERE (scheme, value, id) > (%s, %s, %s) '
+    'ORDER BY scheme, value, id LIMIT %s')
+
+
+class UnionFind(object):
+    """Disjoint sets over the integers 1..size-1, backed by one flat array
+
+    parent[x] is 0 when x is the root of its set. The root of a set is always its smallest
+    member, so it doubles as a stable cluster id.
+    """
+
+    def __init__(self, size):
+        typecode = 'i' if size < 2 ** 31 else 'l'
+        self.parent = array(typecode, [0]) * size
+
+    def find(self, x):
+        parent = self.parent
+        root = x
+        while parent[root]:
+            root = parent[root]
+        # Path compression: point everything on the way straight at the root.
+        while x != root:
+            parent[x], x = root, parent[x]
+        return root
+
+    def union(self, a, b):
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a < root_b:
+            self.parent[root_b] = root_a
+        elif root_b < root_a:
+            self.parent[root_a] = root_b
+
+
+def rebuild_clusters(chunk_size=DEFAULT_CHUNK_SIZE):
+    """Recompute Book.cluster_id for the whole catalog; return (clusters, books updated)
+
+    One streaming pass over Alias unions the books holding each (scheme, value), then only the
+    books whose cluster changed are written, chunk_size per transaction.
+    """
+    max_id = Book.objects.aggregate(max_id=Max('id'))['max_id'] or 0
+    sets = UnionFind(max_id + 1)
+
+    cursor = connection.cursor()
+    sql = ALIAS_PAGE_SQL.format(alias=Alias._meta.db_table)
+    last = ('', '', 0)
+    previous = (None, None)
+    while True:
+        cursor.execute(sql, list(last) + [chunk_size])
+        rows = cursor.fetchall()
+        for alias_id, book_id, scheme, value in rows:
+            # Books created since max_id was read are left for the next rebuild.
+            if book_id > max_id:
+                continue
+            if (scheme, value) == previous[:2]:
+                sets.union(previous[2], book_id)
+            previous = (scheme, value, book_id)
+        if len(rows) < chunk_size:
+            break
+        last = (rows[-1][2], rows[-1][3], rows[-1][0])
+
+    # A root is only a cluster if some other book joined it.
+    roots = set()
+    for book_id in range(1, max_id + 1):
+        root = sets.find(book_id)
+        if root != book_id:
+            roots.add(root)
+
+    current = dict(Book.objects.filter(cluster_id__isnull=False).values_list('id', 'cluster_id'))
+    changes = []
+    for book_id in range(1, max_id + 1):
+        root = sets.find(book_id)
+        cluster_id = root if root in roots else None
+        if current.get(book_id) != cluster_id:
+            changes.append((cluster_id, book_id))
+
+    # A new cluster_id is a change to the book: its ETag and change feed entry follow
+    # last_modified_time.
+    sql = 'UPDATE {book} SET cluster_id = %s, last_modified_time = %s WHERE id = %s'.format(
+        book=Book._meta.db_table)
+    for start in range(0, len(changes), chunk_size):
+        chunk = changes[start:start + chunk_size]
+        now = timezone.now()
+        with transaction.atomic():
+            connection.cursor().executemany(
+                sql, [(cluster_id, now, book_id) for cluster_id, book_id in chunk])
+        caching.invalidate_books(book_id for cluster_id, book_id in chunk)
+    return len(roots), len(changes)
+
+
+def merge_clusters(groups):
+    """Put the books of each group of book ids in one cluster, with the clusters they are in
+
+    Used by the import path as it finds books sharing aliases; clusters only ever grow this way,
+    splitting them takes a rebuild_clusters().
+    """
+    groups = [set(group) for group in groups if len(set(group)) > 1]
+    if not groups:
+        return
+    # tools imports this module, so this one cannot import tools until it is called.
+    from storage.tools import MAX_QUERY_PARAMS, in_chunks
+    book_ids = sorted(set().union(*groups))
+    current = {}
+    for start in range(0, len(book_ids), MAX_QUERY_PARAMS):
+        chunk = book_ids[start:start + MAX_QUERY_PARAMS]
+        current.update(Book.objects.filter(id__in=chunk).values_list(
+            'id', 'cluster_id'))
+
+    # Group the groups that share a book; small enough for a dict-backed union-find.
+    parent = {}
+
+    def find(x):
+        while parent.get(x, x) != x:
+            x = parent[x]
+        return x
+
+    for group in groups:
+        first = min(group)
+        for book_id in group:
+            parent[find(book_id)] = find(first)
+    components = {}
+    for book_id in book_ids:
+        components.setdefault(find(book_id), set()).add(book_id)
+
+    for members in components.values():
+        cluster_ids = set(current.get(book_id) for book_id in members) - set([None])
+        cluster_id = min(members | cluster_ids)
+        if cluster_ids == set([cluster_id]) and all(current.get(b) == cluster_id for b in members):
+            continue
+        # Both id lists are chunked: one shared junk identifier can join thousands of books.
+        ids = sorted(members | set(in_chunks(
+            Book.objects.values_list('id', flat=True), 'cluster_id', sorted(cluster_ids))))
+        # update() sends no signals, nor sets auto_now fields.
+        caching.invalidate_books(ids)
+        now = timezone.now()
+        for start in range(0, len(ids), MAX_QUERY_PARAMS):
+            Book.objects.filter(id__in=ids[start:start + MAX_QUERY_PARAMS]).update(
+                cluster_id=cluster_id, last_modified_time=now)
@@ -0,0 +1,32 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from storage.feeds import FeedError
+from storage.models import FailedRecord
+
+
+def error_message(err):
+    """Return a readable message for any exception; `err.message` only exists on Python 2"""
+    message_dict = getattr(err, 'message_dict', None)
+    if message_dict:
+        # A ValidationError from full_clean(): one line per field.
+        return u'; '.join(u'{}: {}'.format(field, u' '.join(messages))
+                          for field, messages in sorted(message_dict.items()))
+    return u'{}'.format(err)
+
+
+def error_name(err):
+    """Return the class name of err, or of the error a feeds.FeedError stands in for"""
+    if isinstance(err, FeedError):
+        return err.name
+    return type(err).__name__
+
+
+def record_failure(source, stage, err, raw_xml=None):
+    """Write a dead-letter entry for a record that failed at stage; return it"""
+    return FailedRecord.objects.create(
+        source=source,
+        stage=stage,
+        raw_xml=raw_xml or '',
+        exception=error_name(err)[:255],
+        message=error_message(err))
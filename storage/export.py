@@ -0,0 +1,92 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Streaming catalog export
+
+Books are read in id order, chunk_size at a time with their aliases and conflicts prefetched, and
+written out as they are read, so memory use depends on the chunk size, not the catalog size.
+"""
+from lxml import etree
+
+from storage.models import Book
+from storage.serializers import BOOK_PREFETCH, serialize_book, to_json
+
+DEFAULT_CHUNK_SIZE = 1000
+FORMATS = ('jsonl', 'xml')
+
+
+def iter_books(chunk_size=DEFAULT_CHUNK_SIZE, prefetch=BOOK_PREFETCH):
+    """Yield every book in id order, reading chunk_size books per query"""
+    last_id = 0
+    while True:
+        books = list(Book.objects.filter(id__gt=last_id).order_by('id').prefetch_related(
+            *prefetch)[:chunk_size])
+        for book in books:
+            yield book
+        if len(books) < chunk_size:
+            break
+        last_id = books[-1].id
+
+
+def book_element(book):
+    """Return the <book> element extract_book_data would read book from, or None
+
+    The publisher id the book was created for becomes the id attribute, and its other PUB_ID
+    aliases, such as another book's id it shares, stay aliases. A book created before publisher
+    ids were kept takes the smallest of its PUB_ID aliases instead; without any, it cannot be
+    written and None is returned.
+    """
+    aliases = sorted((alias.scheme, alias.value) for alias in book.aliases.all())
+    publisher_id = book.publisher_id
+    if not publisher_id:
+        publisher_ids = [value for scheme, value in aliases if scheme == 'PUB_ID']
+        if not publisher_ids:
+            return None
+        publisher_id = publisher_ids[0]
+    element = etree.Element('book', id=publisher_id)
+    etree.SubElement(element, 'title').text = book.title
+    if book.version:
+        etree.SubElement(element, 'version').text = book.version
+    if book.description:
+        etree.SubElement(element, 'description').text = book.description
+    aliases_element = etree.SubElement(element, 'aliases')
+    for scheme, value in aliases:
+        if (scheme, value) != ('PUB_ID', publisher_id):
+            etree.SubElement(aliases_element, 'alias', scheme=scheme, value=value)
+    return element
+
+
+def write_jsonl(fh, books):
+    """Write each book as a line of JSON, with its aliases and conflicts; return (written, 0)"""
+    num_written = 0
+    for book in books:
+        fh.write((to_json(serialize_book(book)) + '\n').encode('utf-8'))
+        num_written += 1
+    return num_written, 0
+
+
+def write_xml(fh, books):
+    """Write the books as a <catalog> of <book> elements; return (written, skipped)
+
+    Conflicts are left out: importing the file finds them again. Books without a publisher id
+    are skipped.
+    """
+    num_written = num_skipped = 0
+    with etree.xmlfile(fh, encoding='utf-8') as xf:
+        xf.write_declaration()
+        with xf.element('catalog'):
+            for book in books:
+                element = book_element(book)
+                if element is None:
+                    num_skipped += 1
+                    continue
+                xf.write(element, pretty_print=True)
+                num_written += 1
+    return num_written, num_skipped
+
+
+def export_catalog(fh, format='jsonl', chunk_size=DEFAULT_CHUNK_SIZE):
+    """Write the whole catalog to fh in format; return (books written, books skipped)"""
+    if format == 'xml':
+        return write_xml(fh, iter_books(chunk_size, prefetch=('aliases',)))
+    return write_jsonl(fh, iter_books(chunk_size))
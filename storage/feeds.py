@@ -0,0 +1,345 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import bz2
+import gzip
+import re
+import tarfile
+import zipfile
+from contextlib import closing
+
+from lxml import etree
+
+from storage import instrumentation, tools
+
+# Books per chunk of records handed to a worker by parallel imports.
+WORKER_CHUNK_SIZE = 200
+# Bytes read at a time when a stream is split into books without parsing them.
+SPLIT_BLOCK_SIZE = 64 * 1024
+
+# The markup that can be, or hide, a <book> tag; group 1 is '/' for an end tag.
+MARKUP = re.compile(br'<(?:!--|!\[CDATA\[|\?|!DOCTYPE|(/?)book(?=[\s/>]))')
+MARKUP_ENDS = {b'<!--': b'-->', b'<![CDATA[': b']]>', b'<?': b'?>'}
+# The rest of a tag, or of a DOCTYPE with its internal subset, after the markup above.
+TAG_END = re.compile(br'''(?:[^>"']|"[^"]*"|'[^']*')*>''')
+DOCTYPE_END = re.compile(br'''(?:[^>"'\[]|"[^"]*"|'[^']*'|\[(?:[^\]"']|"[^"]*"|'[^']*')*\])*>''')
+# Markup that, inside a book, keeps its first </book> from being taken for its end.
+HIDDEN = re.compile(br'<(?:!|\?|book)')
+# The XML declaration and DOCTYPE, which every book split out of a stream is parsed after.
+PROLOG = re.compile(br'<(?:\?xml\s|!DOCTYPE)')
+# Longest prefix of that markup a block can end in.
+MAX_MARKUP_PREFIX = len(b'<![CDATA[')
+
+
+class FeedError(Exception):
+    """A picklable record of an error raised while reading or extracting a feed
+
+    lxml's parse errors cannot cross a process boundary, so every feed error is reduced to the
+    name of its class and its message.
+    """
+    def __init__(self, name, message):
+        super(FeedError, self).__init__(name, message)
+        self.name = name
+        self.message = message
+
+    def __unicode__(self):
+        return self.message
+
+    def __str__(self):
+        return self.message
+
+    @classmethod
+    def wrap(cls, err):
+        return cls(type(err).__name__, u'{}'.format(err))
+
+
+def read_feed(filename, extract=True):
+    """Yield a (kind, label, payload, raw) record for everything read from filename, in order
+
+    Kinds are 'source' for the start of each XML stream (payload None), 'book' for each <book>
+    element (payload is the extract_book_data record, or a FeedError if extraction failed; raw is
+    the element's XML) and 'error' for a stream that could not be opened or parsed (payload is a
+    FeedError). Records hold only plain data, so they can be produced in a worker process.
+
+    With extract False the books are split out of the streams without being parsed: the payload
+    of 'book' records is left None and raw holds the book's bytes, for extract_records to parse
+    and extract, possibly in another process.
+    """
+    try:
+        for source, fh in open_feed(filename):
+            yield 'source', source, None, None
+            try:
+                if not extract:
+                    fragments = instrumentation.iterate('split', iter_book_fragments(fh))
+                    for num, (is_root, xml) in enumerate(fragments, 1):
+                        label = source if is_root else u'{} #{}'.format(source, num)
+                        yield 'book', label, None, xml
+                    continue
+                elements = instrumentation.iterate('parse', iter_book_elements(fh))
+                for num, element in enumerate(elements, 1):
+                    if element.getparent() is None:
+                        label = source
+                    else:
+                        label = u'{} #{}'.format(source, num)
+                    with instrumentation.stage('extract'):
+                        try:
+                            incoming = tools.extract_book_data(element)
+                        except Exception as err:
+                            incoming = FeedError.wrap(err)
+                        raw = etree.tostring(element, encoding='unicode', with_tail=False)
+                    yield 'book', label, incoming, raw
+            except Exception as err:
+                # Use broad exception, we don't want to stop the batch
+                err = FeedError.wrap(err)
+                if not extract:
+                    # Positions found by the splitter are not the file's; report the parser's.
+                    err = stream_error(filename, source) or err
+                yield 'error', source, err, None
+    except Exception as err:
+        yield 'error', filename, FeedError.wrap(err), None
+
+
+def stream_error(filename, source):
+    """Return the FeedError parsing the stream source of filename stops at, or None"""
+    try:
+        for name, fh in open_feed(filename):
+            if name == source:
+                for element in iter_book_elements(fh):
+                    pass
+                return None
+    except Exception as err:
+        return FeedError.wrap(err)
+    return None
+
+
+def chunk_records(records, chunk_size=WORKER_CHUNK_SIZE):
+    """Yield records in lists holding at most chunk_size 'book' records each"""
+    chunk, num_books = [], 0
+    for record in records:
+        chunk.append(record)
+        if record[0] == 'book':
+            num_books += 1
+            if num_books >= chunk_size:
+                yield chunk
+                chunk, num_books = [], 0
+    if chunk:
+        yield chunk
+
+
+def extract_records(records):
+    """Return records with each unparsed 'book' record parsed and extracted from its raw XML
+
+    The unit of work for parallel imports: records come from read_feed with extract False, a
+    chunk_records list at a time, and come back as read_feed would have made them, except that a
+    book whose XML does not parse comes back as a 'broken' record holding the FeedError, for
+    settle_records to end its stream with.
+    """
+    extracted = []
+    for kind, label, payload, raw in records:
+        if kind == 'book' and payload is None:
+            try:
+                element = etree.fromstring(raw)
+            except Exception as err:
+                extracted.append(('broken', label, FeedError.wrap(err), None))
+                continue
+            try:
+                payload = tools.extract_book_data(element)
+            except Exception as err:
+                payload = FeedError.wrap(err)
+            raw = etree.tostring(element, encoding='unicode', with_tail=False)
+        extracted.append((kind, label, payload, raw))
+    return extracted
+
+
+def settle_records(filename, records):
+    """Yield the extracted records of filename as read_feed(filename) would have made them
+
+    A 'broken' record stops its stream, as a parse error does when the stream is read in one
+    pass: the books after it are left out, and the error that pass reports takes its place.
+    """
+    source, broken = None, False
+    for record in records:
+        kind, label, payload, raw = record
+        if kind == 'source':
+            source, broken = label, False
+        elif kind == 'book' and broken:
+            continue
+        elif kind == 'broken':
+            broken = True
+            record = ('error', source, stream_error(filename, source) or payload, None)
+        yield record
+
+
+def open_feed(filename):
+    """Yield a (source name, file object) pair for each XML stream held in filename
+
+    Plain, gzip- and bz2-compressed XML files yield a single stream. Tar archives (compressed or
+    not) and zip archives yield one stream per regular member, read straight out of the archive
+    without unpacking anything to disk. Each file object is only valid until the next pair is
+    requested.
+    """
+    if zipfile.is_zipfile(filename):
+        with closing(zipfile.ZipFile(filename)) as archive:
+            for info in archive.infolist():
+                if info.filename.endswith('/'):
+                    continue
+                with closing(archive.open(info)) as fh:
+                    yield u'{}:{}'.format(filename, info.filename), fh
+    elif tarfile.is_tarfile(filename):
+        # Stream mode reads the archive front to back once, even when it is compressed.
+        with closing(tarfile.open(filename, mode='r|*')) as archive:
+            for member in archive:
+                if member.isfile():
+                    yield u'{}:{}'.format(filename, member.name), archive.extractfile(member)
+    else:
+        with open(filename, 'rb') as fh:
+            magic = fh.read(3)
+        if magic.startswith(b'\x1f\x8b'):
+            opener = gzip.GzipFile
+        elif magic == b'BZh':
+            opener = bz2.BZ2File
+        else:
+            opener = open
+        with closing(opener(filename, 'rb')) as fh:
+            yield filename, fh
+
+
+def iter_book_elements(fh):
+    """Yield every <book> element of an XML stream, one at a time
+
+    A file may hold a single <book> as its root or any number of them under a catalog root. Once
+    the caller asks for the next element, the previous one is cleared and dropped from its parent
+    along with its earlier siblings, so memory stays flat however many books the stream holds.
+    """
+    for event, element in etree.iterparse(fh, events=('end',), tag='book'):
+        yield element
+        element.clear()
+        while element.getprevious() is not None:
+            del element.getparent()[0]
+
+
+def iter_book_fragments(fh, block_size=SPLIT_BLOCK_SIZE):
+    """Yield (is_root, xml) for every <book> element of an XML stream, without parsing the books
+
+    Only the markup that can be or hide a <book> tag is looked at inside books; the bytes between
+    them go through a parser of their own, so a stream that is not well-formed there fails here
+    much as it fails in iter_book_elements. Each book's bytes come after the stream's XML
+    declaration and DOCTYPE, which give the encoding and entities to parse them with. A book
+    left open at the end of the stream is yielded as it is, to fail when it is parsed.
+    """
+    buf = fh.read(block_size)
+    if b'\x00' in buf:
+        # UTF-16 or UTF-32: the markup is not in bytes to search for, so parse the stream.
+        for element in iter_book_elements(_Prefixed(buf, fh)):
+            yield element.getparent() is None, etree.tostring(element, with_tail=False)
+        return
+    skeleton = _OpenElements()
+    parser = etree.XMLParser(target=skeleton)
+    prolog = b''
+    pos, mark, start, depth, is_root = 0, 0, None, 0, False
+    eof = not buf
+    while True:
+        match = MARKUP.search(buf, pos)
+        end = None if match is None else _markup_end(buf, match)
+        if end is None:
+            if eof:
+                break
+            # Everything before keep is scanned; a match may still start in the rest.
+            keep = match.start() if match else max(pos, len(buf) - MAX_MARKUP_PREFIX)
+            if start is None:
+                parser.feed(buf[mark:keep])
+                buf, pos, mark = buf[keep:], 0, 0
+            else:
+                buf, pos, start = buf[start:], keep - start, 0
+            data = fh.read(block_size)
+            eof = not data
+            buf += data
+            continue
+
+        pos = end
+        if match.group(1) is None:
+            if start is None and PROLOG.match(buf, match.start()):
+                prolog += buf[match.start():end]
+        elif not match.group(1):
+            if depth == 0:
+                start = match.start()
+                # What lies between books is parsed on its own, with a stand-in for each book.
+                # Whitespace inside an element cannot make the stream fail, so it is skipped.
+                gap = buf[mark:start]
+                if skeleton.depth == 0 or (gap and not gap.isspace()):
+                    parser.feed(gap + b'<book/>')
+                is_root = skeleton.depth == 0
+            if buf[end - 2:end] == b'/>':
+                if depth == 0:
+                    yield is_root, prolog + buf[start:end]
+                    start, mark = None, end
+                continue
+            # Most books end at the first </book>, with nothing in between to look at.
+            close = buf.find(b'</book>', end) if depth == 0 else -1
+            if close >= 0 and not HIDDEN.search(buf, end, close):
+                pos = mark = close + len(b'</book>')
+                yield is_root, prolog + buf[start:pos]
+                start = None
+            else:
+                depth += 1
+        elif depth:
+            depth -= 1
+            if depth == 0:
+                yield is_root, prolog + buf[start:end]
+                start, mark = None, end
+
+    if start is not None:
+        yield is_root, prolog + buf[start:]
+    else:
+        parser.feed(buf[mark:])
+        parser.close()
+
+
+def _markup_end(buf, match):
+    """Return the offset just past the markup match starts, or None if buf stops inside it"""
+    prefix = match.group(0)
+    if match.group(1) is not None:
+        tag = TAG_END.match(buf, match.end())
+        return tag.end() if tag else None
+    if prefix == b'<!DOCTYPE':
+        doctype = DOCTYPE_END.match(buf, match.end())
+        return doctype.end() if doctype else None
+    close = MARKUP_ENDS[prefix]
+    found = buf.find(close, match.end())
+    return None if found < 0 else found + len(close)
+
+
+class _OpenElements(object):
+    """Parser target counting the elements open so far, without building a tree"""
+
+    def __init__(self):
+        self.depth = 0
+
+    def start(self, tag, attrib):
+        self.depth += 1
+
+    def end(self, tag):
+        self.depth -= 1
+
+    def data(self, data):
+        pass
+
+    def close(self):
+        return None
+
+
+class _Prefixed(object):
+    """File object reading data, then the rest of fh"""
+
+    def __init__(self, data, fh):
+        self.data = data
+        self.fh = fh
+
+    def read(self, size=-1):
+        if not self.data:
+            return self.fh.read(size)
+        if size < 0:
+            data, self.data = self.data + self.fh.read(), b''
+        else:
+            data, self.data = self.data[:size], self.data[size:]
+        return data
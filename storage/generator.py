@@ -0,0 +1,172 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Synthetic publisher catalogs for benchmarks and load tests
+
+Book n of a catalog is worked out from the seed and n alone, so catalogs of any size are written
+in a single pass with flat memory use, and the update feed can restate any earlier book without
+keeping the catalog around.
+"""
+import os
+import random
+
+from lxml import etree
+
+LAYOUTS = ('single', 'per-book')
+
+# (scheme, weight) pairs: how often each scheme is picked for an alias.
+DEFAULT_SCHEMES = (('ISBN-13', 5), ('ISBN-10', 3), ('ASIN', 1), ('Proprietary', 1))
+
+WORDS = (
+    'advanced', 'beginning', 'cloud', 'cookbook', 'data', 'design', 'developer', 'distributed',
+    'essential', 'functional', 'guide', 'hacks', 'head', 'first', 'java', 'javascript',
+    'learning', 'machine', 'mastering', 'network', 'nutshell', 'patterns', 'perl', 'practical',
+    'programming', 'python', 'recipes', 'reference', 'security', 'systems', 'testing', 'web')
+
+
+class Catalog(object):
+    """A deterministic synthetic catalog of num_books books
+
+    Each book has about aliases_per_book aliases with schemes picked from the (scheme, weight)
+    pairs. A conflict_rate share of the books take one alias value from an earlier book, and a
+    duplicate_rate share of the records are delivered twice. The update feed restates an
+    update_ratio share of the books with a new version, title and alias.
+    """
+
+    def __init__(self, num_books, aliases_per_book=2, schemes=DEFAULT_SCHEMES,
+                 duplicate_rate=0.01, conflict_rate=0.05, update_ratio=0.1, seed=0):
+        self.num_books = num_books
+        self.aliases_per_book = aliases_per_book
+        self.schemes = tuple(schemes)
+        self.weighted_schemes = [scheme for scheme, weight in schemes for n in range(weight)]
+        self.duplicate_rate = duplicate_rate
+        self.conflict_rate = conflict_rate
+        self.update_ratio = update_ratio
+        self.seed = seed
+
+    def settings(self):
+        """Return the settings of this catalog other than its size, as keyword arguments"""
+        return {
+            'aliases_per_book': self.aliases_per_book, 'schemes': self.schemes,
+            'duplicate_rate': self.duplicate_rate, 'conflict_rate': self.conflict_rate,
+            'update_ratio': self.update_ratio, 'seed': self.seed}
+
+    def _random(self, n, purpose):
+        return random.Random('{}/{}/{}'.format(self.seed, n, purpose))
+
+    def own_aliases(self, n):
+        """Return the aliases of book n other than its PUB_ID, none of them shared"""
+        rng = self._random(n, 'aliases')
+        num_aliases = min(9, max(1, int(rng.gauss(self.aliases_per_book, 1) + 0.5)))
+        aliases = []
+        for slot in range(num_aliases):
+            scheme = rng.choice(self.weighted_schemes)
+            aliases.append({'scheme': scheme, 'value': alias_value(scheme, n, slot)})
+        return aliases
+
+    def book(self, n):
+        """Return book n as the dict form of extract_book_data's record, plus its 'version'"""
+        rng = self._random(n, 'book')
+        words = rng.sample(WORDS, rng.randint(2, 5))
+        aliases = [{'scheme': 'PUB_ID', 'value': 'pub-{}'.format(n)}] + self.own_aliases(n)
+        if n and rng.random() < self.conflict_rate:
+            aliases.append(rng.choice(self.own_aliases(rng.randrange(n))))
+        return {
+            'publisher_id': 'pub-{}'.format(n),
+            'title': ' '.join(words).capitalize(),
+            'description': 'A book about {}.'.format(' and '.join(words)),
+            'version': '1.0',
+            'aliases': aliases}
+
+    def updated_book(self, n):
+        """Return book n as the update feed restates it"""
+        book = self.book(n)
+        book['title'] += ', 2nd edition'
+        book['description'] += ' Revised and expanded.'
+        book['version'] = '2.0'
+        book['aliases'].append({'scheme': 'ISBN-13', 'value': alias_value('ISBN-13', n, 9)})
+        return book
+
+    def initial_books(self):
+        """Yield the books of the initial feed, re-delivered records included"""
+        for n in range(self.num_books):
+            yield self.book(n)
+            rng = self._random(n, 'duplicate')
+            if rng.random() < self.duplicate_rate:
+                yield self.book(rng.randrange(n + 1))
+
+    def update_books(self):
+        """Yield the books of the update feed"""
+        for n in range(self.num_books):
+            if self._random(n, 'update').random() < self.update_ratio:
+                yield self.updated_book(n)
+
+
+def alias_value(scheme, n, slot):
+    """Return a value for alias slot (0 to 9) of book n that looks like scheme and is its own"""
+    if scheme == 'ISBN-13':
+        return '97{}{:010d}'.format(slot, n)
+    if scheme == 'ISBN-10':
+        return '{}{:09d}'.format(slot, n)
+    return '{}{}-{:08d}'.format(scheme[:1], slot, n)
+
+
+def book_element(book):
+    """Return the <book> element extract_book_data reads book from"""
+    element = etree.Element('book', id=book['publisher_id'])
+    etree.SubElement(element, 'title').text = book['title']
+    etree.SubElement(element, 'version').text = book['version']
+    etree.SubElement(element, 'description').text = book['description']
+    aliases_element = etree.SubElement(element, 'aliases')
+    for alias in book['aliases']:
+        if alias != {'scheme': 'PUB_ID', 'value': book['publisher_id']}:
+            etree.SubElement(aliases_element, 'alias', scheme=alias['scheme'], value=alias['value'])
+    return element
+
+
+def parse_schemes(text):
+    """Turn 'ISBN-13:5,ISBN-10:3,ASIN' into (scheme, weight) pairs; the weight defaults to 1"""
+    schemes = []
+    for item in text.split(','):
+        scheme, sep, weight = item.strip().rpartition(':')
+        if not sep:
+            scheme, weight = weight, '1'
+        schemes.append((scheme, int(weight)))
+    return tuple(schemes)
+
+
+def write_feed(directory, books, layout='single'):
+    """Write books under directory; return the list of files written and the number of books
+
+    The 'single' layout writes one catalog.xml holding every book, 'per-book' one file per book
+    record, as the publisher feeds in data/ are.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if layout == 'per-book':
+        paths = []
+        for num, book in enumerate(books):
+            paths.append(os.path.join(directory, 'book-{:07d}.xml'.format(num)))
+            with open(paths[-1], 'wb') as fh:
+                fh.write(etree.tostring(book_element(book), pretty_print=True))
+        return paths, len(paths)
+    path = os.path.join(directory, 'catalog.xml')
+    num_written = 0
+    with open(path, 'wb') as fh:
+        with etree.xmlfile(fh, encoding='utf-8') as xf:
+            xf.write_declaration()
+            with xf.element('catalog'):
+                for book in books:
+                    xf.write(book_element(book), pretty_print=True)
+                    num_written += 1
+    return [path], num_written
+
+
+def write_catalog(directory, catalog, layout='single'):
+    """Write the initial and update feeds of catalog
+
+    Return {'initial': (paths, number of books), 'update': (paths, number of books)}.
+    """
+    return {
+        'initial': write_feed(os.path.join(directory, 'initial'), catalog.initial_books(), layout),
+        'update': write_feed(os.path.join(directory, 'update'), catalog.update_books(), layout)}
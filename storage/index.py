@@ -0,0 +1,188 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import math
+import sys
+from collections import OrderedDict
+
+from storage.models import Alias
+from storage.records import intern_scheme
+
+DEFAULT_MAX_ENTRIES = 1000000
+WARM_CHUNK_SIZE = 10000
+
+# Rough cost of one entry beyond its strings: the key tuple, the pairs tuple and the
+# OrderedDict's own bookkeeping.
+ENTRY_OVERHEAD = 300
+
+
+class BloomFilter(object):
+    """Compact set membership test that can only answer "definitely absent" or "maybe present"
+
+    Sized for `capacity` keys at a false positive rate under `error_rate`. Past that many keys it
+    grows instead of filling up: each time it holds as many keys as it was sized for, it starts
+    a slice of twice the capacity at half the error rate of the one before. Lookups check every
+    slice, so the false positive rate stays around `error_rate` however many keys are added.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        self.error_rate = error_rate
+        # Keys added to the last slice, and how many it was sized for.
+        self.count = 0
+        self.capacity = max(capacity, 1000)
+        # (num_bits, num_hashes, bits) of each slice, oldest first; keys go to the last one.
+        self.slices = []
+        self._add_slice()
+
+    def _add_slice(self):
+        # Error rates of error_rate / 2, / 4, / 8... add up to error_rate.
+        error_rate = self.error_rate * 0.5 ** (len(self.slices) + 1)
+        num_bits = int(-self.capacity * math.log(error_rate) / math.log(2) ** 2)
+        num_hashes = max(1, int(round(num_bits / float(self.capacity) * math.log(2))))
+        self.slices.append((num_bits, num_hashes, bytearray((num_bits + 7) // 8)))
+
+    @staticmethod
+    def _positions(key, num_bits, num_hashes):
+        # Double hashing: k positions out of two independent hashes.
+        h1 = hash(key)
+        h2 = hash((key, 'bloom')) | 1
+        for i in range(num_hashes):
+            yield (h1 + i * h2) % num_bits
+
+    def add(self, key):
+        if self.count >= self.capacity:
+            self.count = 0
+            self.capacity *= 2
+            self._add_slice()
+        self.count += 1
+        num_bits, num_hashes, bits = self.slices[-1]
+        for position in self._positions(key, num_bits, num_hashes):
+            bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for num_bits, num_hashes, bits in self.slices:
+            for position in self._positions(key, num_bits, num_hashes):
+                if not bits[position >> 3] & (1 << (position & 7)):
+                    break
+            else:
+                return True
+        return False
+
+
+class AliasIndex(object):
+    """Importer-side map of (scheme, value) to the (alias id, book id) pairs holding it
+
+    The index is warmed with one streaming pass over Alias, then kept up to date by the import
+    path as it writes. It holds at most `max_entries` keys and roughly `max_bytes` bytes, evicting
+    the least recently used keys beyond that. A Bloom filter over every key ever seen answers
+    "never seen" without touching the database, and until the first eviction a key missing from
+    the index is known to be absent as well.
+
+    Only this process's writes are tracked; aliases another process adds while the index is in
+    use are not seen.
+    """
+
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.num_bytes = 0
+        self.bloom = None
+        # True while nothing has been evicted, i.e. the index holds every alias there is.
+        self.complete = False
+        self.hits = 0
+        self.misses = 0
+        self.absent = 0
+        self.evictions = 0
+
+    def warm(self, chunk_size=WARM_CHUNK_SIZE):
+        """Load every Alias, chunk_size rows at a time, and start answering lookups"""
+        self.entries.clear()
+        self.num_bytes = 0
+        self.bloom = BloomFilter(2 * Alias.objects.count())
+        self.complete = True
+        last_id = 0
+        while True:
+            rows = list(Alias.objects.filter(id__gt=last_id).order_by('id').values_list(
+                'id', 'book_id', 'scheme', 'value')[:chunk_size])
+            for alias_id, book_id, scheme, value in rows:
+                self.add(alias_id, book_id, scheme, value)
+            if len(rows) < chunk_size:
+                break
+            last_id = rows[-1][0]
+        return self
+
+    def lookup(self, scheme, value):
+        """Return the (alias id, book id) pairs holding (scheme, value), or None if unknown
+
+        None means the index cannot tell and the caller has to ask the database, after which
+        it should remember() the answer.
+        """
+        key = (scheme, value)
+        if self.bloom is None:
+            self.misses += 1
+            return None
+        if key not in self.bloom:
+            self.absent += 1
+            return ()
+        pairs = self.entries.pop(key, None)
+        if pairs is not None:
+            self.entries[key] = pairs
+            self.hits += 1
+            return pairs
+        if self.complete:
+            self.absent += 1
+            return ()
+        self.misses += 1
+        return None
+
+    def remember(self, scheme, value, pairs):
+        """Record what the database said about (scheme, value) after a lookup returned None"""
+        if self.bloom is not None:
+            self._store((intern_scheme(scheme), value), tuple(pairs))
+
+    def add(self, alias_id, book_id, scheme, value):
+        """Record a newly written Alias"""
+        if self.bloom is None:
+            return
+        key = (intern_scheme(scheme), value)
+        self.bloom.add(key)
+        pairs = self.entries.get(key)
+        if pairs is not None:
+            self._store(key, pairs + ((alias_id, book_id),))
+        elif self.complete:
+            self._store(key, ((alias_id, book_id),))
+
+    def forget(self):
+        """Drop every entry, e.g. after a rolled back write; the Bloom filter stays valid"""
+        self.entries.clear()
+        self.num_bytes = 0
+        self.complete = False
+
+    def _store(self, key, pairs):
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.num_bytes -= _entry_size(key, old)
+        self.entries[key] = pairs
+        self.num_bytes += _entry_size(key, pairs)
+        while self.entries and (
+                len(self.entries) > self.max_entries or
+                (self.max_bytes is not None and self.num_bytes > self.max_bytes)):
+            evicted_key, evicted = self.entries.popitem(last=False)
+            self.num_bytes -= _entry_size(evicted_key, evicted)
+            self.evictions += 1
+            self.complete = False
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'absent': self.absent,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.num_bytes,
+        }
+
+
+def _entry_size(key, pairs):
+    return sys.getsizeof(key[1]) + ENTRY_OVERHEAD + 64 * len(pairs)
@@ -0,0 +1,261 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Per-stage timing, query counts and throughput of the import pipeline
+
+Instrumentation is off until start() installs a Recorder. While it is off, stage() returns a
+shared context manager that does nothing and iterate() returns its iterable as it is, so
+instrumented code pays one function call per stage.
+
+While it is on, every run of a stage adds its wall and CPU time to histograms of power-of-two
+microsecond buckets, and counts the SQL queries it ran and their time. A stage run inside
+another one is counted in both. Time spent outside every stage, such as committing and
+printing, is reported as 'other'.
+"""
+import time
+from collections import OrderedDict
+
+from django.db import connection
+
+# Seconds between two progress lines.
+DEFAULT_PROGRESS_INTERVAL = 10
+
+try:
+    cpu_time = time.process_time
+except AttributeError:
+    # On Unix, Python 2's clock() is the processor time of the process.
+    cpu_time = time.clock
+
+# Columns of Recorder.report().
+REPORT_HEADER = '{:<16} {:>8} {:>10} {:>10} {:>9} {:>9} {:>8} {:>10}'
+REPORT_ROW = '{:<16} {:>8} {:>10.3f} {:>10.3f} {:>9.3f} {:>9.3f} {:>8} {:>10.3f}'
+
+_recorder = None
+
+
+class _NullStage(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+_NULL_STAGE = _NullStage()
+
+
+def stage(name):
+    """Return a context manager timing the enclosed block as stage name"""
+    if _recorder is None:
+        return _NULL_STAGE
+    return _Stage(_recorder, name)
+
+
+def iterate(name, iterable):
+    """Return iterable, with the time taken to produce each of its items counted as stage name"""
+    if _recorder is None:
+        return iterable
+    return _iterate(name, iter(iterable))
+
+
+def _iterate(name, iterator):
+    while True:
+        with stage(name):
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+        yield item
+
+
+def start(progress_interval=DEFAULT_PROGRESS_INTERVAL):
+    """Turn instrumentation on; return the Recorder collecting the figures"""
+    global _recorder
+    _recorder = Recorder(progress_interval)
+    return _recorder
+
+
+def stop():
+    """Turn instrumentation off; return the Recorder that was collecting, if any"""
+    global _recorder
+    recorder, _recorder = _recorder, None
+    if recorder is not None:
+        recorder.finish()
+    return recorder
+
+
+def add_books(num_books):
+    """Count num_books more books stored; return a progress line if one is due, else None"""
+    if _recorder is None:
+        return None
+    return _recorder.add_books(num_books)
+
+
+class Histogram(object):
+    """Counts of durations in buckets of powers of two microseconds, with their total and max"""
+    __slots__ = ('buckets', 'count', 'total', 'max')
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        # Bucket b holds durations under 2 ** b microseconds.
+        bucket = int(seconds * 1000000).bit_length()
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction):
+        """Return the upper bound, in seconds, of the bucket holding the fraction percentile"""
+        rank = fraction * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return min(2 ** bucket / 1000000.0, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            'total_s': round(self.total, 6),
+            'mean_ms': round(self.total * 1000 / self.count, 3) if self.count else None,
+            'p50_ms': round(self.percentile(0.5) * 1000, 3),
+            'p95_ms': round(self.percentile(0.95) * 1000, 3),
+            'max_ms': round(self.max * 1000, 3),
+            'buckets_us': OrderedDict(
+                ('<{}'.format(2 ** bucket), self.buckets[bucket])
+                for bucket in sorted(self.buckets)),
+        }
+
+
+class StageStats(object):
+    """Figures of every run of one stage"""
+    __slots__ = ('calls', 'wall', 'cpu', 'queries', 'query_time')
+
+    def __init__(self):
+        self.calls = 0
+        self.wall = Histogram()
+        self.cpu = Histogram()
+        self.queries = 0
+        self.query_time = 0.0
+
+    def summary(self):
+        return {
+            'calls': self.calls,
+            'wall': self.wall.summary(),
+            'cpu': self.cpu.summary(),
+            'queries': self.queries,
+            'query_s': round(self.query_time, 6),
+        }
+
+
+class Recorder(object):
+    """The figures collected while instrumentation is on
+
+    Queries are counted through Django's debug cursor, which the recorder switches on for as
+    long as it runs. The queries it keeps are dropped as each outermost stage ends, so memory
+    does not grow with the size of the import.
+    """
+
+    def __init__(self, progress_interval=DEFAULT_PROGRESS_INTERVAL):
+        self.stages = OrderedDict()
+        self.depth = 0
+        # Wall time spent in outermost stages.
+        self.staged = 0.0
+        self.books = 0
+        self.progress_interval = progress_interval
+        self.started = self.last_progress = time.time()
+        self.last_progress_books = 0
+        self.finished = None
+        self.use_debug_cursor = connection.use_debug_cursor
+        connection.use_debug_cursor = True
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.time()
+            connection.use_debug_cursor = self.use_debug_cursor
+            del connection.queries[:]
+
+    def add_books(self, num_books):
+        self.books += num_books
+        now = time.time()
+        if now - self.last_progress < self.progress_interval:
+            return None
+        line = ('[progress] {books} books in {elapsed:.0f} s: {rate:.1f} books/sec overall, '
+                '{recent:.1f} books/sec lately').format(
+            books=self.books, elapsed=now - self.started,
+            rate=self.books / (now - self.started),
+            recent=(self.books - self.last_progress_books) / (now - self.last_progress))
+        self.last_progress, self.last_progress_books = now, self.books
+        return line
+
+    def record(self, name, wall, cpu, queries, query_time):
+        if self.depth == 1:
+            self.staged += wall
+        stats = self.stages.get(name)
+        if stats is None:
+            stats = self.stages[name] = StageStats()
+        stats.calls += 1
+        stats.wall.add(wall)
+        stats.cpu.add(cpu)
+        stats.queries += queries
+        stats.query_time += query_time
+
+    def summary(self):
+        """Return every figure as a dict of plain values, ready for json.dump"""
+        elapsed = (self.finished or time.time()) - self.started
+        return {
+            'elapsed_s': round(elapsed, 3),
+            'books': self.books,
+            'books_per_sec': round(self.books / elapsed, 1) if elapsed else None,
+            'other_s': round(max(elapsed - self.staged, 0), 3),
+            'stages': OrderedDict(
+                (name, stats.summary()) for name, stats in self.stages.items()),
+        }
+
+    def report(self):
+        """Return lines tabulating the figures of each stage"""
+        summary = self.summary()
+        lines = [REPORT_HEADER.format(
+            'stage', 'calls', 'wall s', 'cpu s', 'p50 ms', 'p95 ms', 'queries', 'query s')]
+        for name, stage_summary in summary['stages'].items():
+            lines.append(REPORT_ROW.format(
+                name, stage_summary['calls'], stage_summary['wall']['total_s'],
+                stage_summary['cpu']['total_s'], stage_summary['wall']['p50_ms'],
+                stage_summary['wall']['p95_ms'], stage_summary['queries'],
+                stage_summary['query_s']))
+        lines.append('{:<16} {:>8} {:>10.3f}'.format('other', '', summary['other_s']))
+        lines.append('{books} books in {elapsed:.3f} s: {rate} books/sec'.format(
+            books=summary['books'], elapsed=summary['elapsed_s'],
+            rate=summary['books_per_sec']))
+        return lines
+
+
+class _Stage(object):
+    __slots__ = ('recorder', 'name', 'wall', 'cpu', 'first_query')
+
+    def __init__(self, recorder, name):
+        self.recorder = recorder
+        self.name = name
+
+    def __enter__(self):
+        self.recorder.depth += 1
+        self.first_query = len(connection.queries)
+        self.cpu = cpu_time()
+        self.wall = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        wall = time.time() - self.wall
+        cpu = cpu_time() - self.cpu
+        queries = connection.queries[self.first_query:]
+        self.recorder.record(
+            self.name, wall, cpu, len(queries), sum(float(query['time']) for query in queries))
+        self.recorder.depth -= 1
+        if not self.recorder.depth:
+            del connection.queries[:]
+        return False
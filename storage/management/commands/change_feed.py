@@ -0,0 +1,62 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import os
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import pluralize
+
+from storage import changes
+from storage.serializers import serialize_book, to_json
+
+
+class Command(BaseCommand):
+    help = ('Write the books modified since a cursor as JSON lines, oldest change first, and '
+            'print the cursor to continue from')
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--cursor', dest='cursor', default=None,
+            help='Cursor returned by an earlier run; start from the beginning without one'),
+        make_option(
+            '--cursor-file', dest='cursor_file', default=None,
+            help='File to read the cursor from, if it exists, and to save the next one to once '
+                 'every change has been written'),
+        make_option(
+            '--output', dest='output', default='-',
+            help='File to write the changes to [default: standard output]'),
+        make_option(
+            '--page-size', type='int', dest='page_size', default=changes.DEFAULT_PAGE_SIZE,
+            help='Books read per query [default: %default]'),
+    )
+
+    def handle(self, *args, **options):
+        cursor = options['cursor']
+        cursor_file = options['cursor_file']
+        if cursor is None and cursor_file and os.path.exists(cursor_file):
+            with open(cursor_file) as fh:
+                cursor = fh.read().strip() or None
+        if cursor:
+            try:
+                changes.decode_cursor(cursor)
+            except ValueError as err:
+                raise CommandError(err)
+
+        out = sys.stdout if options['output'] == '-' else open(options['output'], 'w')
+        num_books = 0
+        try:
+            for books, cursor in changes.iter_changes(cursor, options['page_size']):
+                for book in books:
+                    out.write(to_json(serialize_book(book)) + '\n')
+                num_books += len(books)
+        finally:
+            if out is not sys.stdout:
+                out.close()
+
+        if cursor_file and cursor:
+            with open(cursor_file, 'w') as fh:
+                fh.write(cursor + '\n')
+        # Standard output may hold the changes themselves.
+        self.stderr.write('{num} changed book{s}; next cursor: {cursor}'.format(
+            num=num_books, s=pluralize(num_books), cursor=cursor or '(none)'))
@@ -0,0 +1,54 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import gzip
+import sys
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import pluralize
+
+from storage import export
+
+
+class Command(BaseCommand):
+    help = ('Write every book with its aliases (and conflicts, in JSONL) to a file, streaming it '
+            'in id order')
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--format', type='choice', choices=export.FORMATS, dest='format', default='jsonl',
+            help='jsonl, one JSON book per line, or xml, <book> elements process_data_file can '
+                 'import again [default: %default]'),
+        make_option(
+            '--output', dest='output', default='-',
+            help='File to write to [default: standard output]'),
+        make_option(
+            '--gzip', action='store_true', dest='gzip', default=False,
+            help='Compress the output with gzip'),
+        make_option(
+            '--chunk-size', type='int', dest='chunk_size', default=export.DEFAULT_CHUNK_SIZE,
+            help='Books read per query [default: %default]'),
+    )
+
+    def handle(self, *args, **options):
+        to_stdout = options['output'] == '-'
+        if to_stdout:
+            fh = getattr(sys.stdout, 'buffer', sys.stdout)
+        else:
+            fh = open(options['output'], 'wb')
+        out = gzip.GzipFile(fileobj=fh, mode='wb') if options['gzip'] else fh
+        try:
+            written, skipped = export.export_catalog(
+                out, options['format'], chunk_size=options['chunk_size'])
+        finally:
+            # Closing the GzipFile writes its trailer but leaves fh open.
+            if out is not fh:
+                out.close()
+            if not to_stdout:
+                fh.close()
+
+        # Standard output may hold the export itself.
+        self.stderr.write('{num} book{s} exported.'.format(num=written, s=pluralize(written)))
+        if skipped:
+            self.stderr.write('{num} book{s} without a publisher id skipped.'.format(
+                num=skipped, s=pluralize(skipped)))
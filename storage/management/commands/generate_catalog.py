@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.template.defaultfilters import pluralize
+
+from storage import generator
+
+# Shared with run_benchmarks, which generates its catalogs the same way.
+CATALOG_OPTIONS = (
+    make_option(
+        '--aliases-per-book', type='int', dest='aliases_per_book', default=2,
+        help='Average number of aliases per book, besides its PUB_ID [default: %default]'),
+    make_option(
+        '--schemes', dest='schemes', default=','.join(
+            '{}:{}'.format(scheme, weight) for scheme, weight in generator.DEFAULT_SCHEMES),
+        help='Alias schemes with their relative weights [default: %default]'),
+    make_option(
+        '--duplicate-rate', type='float', dest='duplicate_rate', default=0.01,
+        help='Share of records delivered twice [default: %default]'),
+    make_option(
+        '--conflict-rate', type='float', dest='conflict_rate', default=0.05,
+        help='Share of books sharing an alias with an earlier book [default: %default]'),
+    make_option(
+        '--update-ratio', type='float', dest='update_ratio', default=0.1,
+        help='Share of books restated in the update feed [default: %default]'),
+    make_option(
+        '--layout', type='choice', choices=generator.LAYOUTS, dest='layout', default='single',
+        help='single, one catalog.xml per feed, or per-book, one file per book '
+             '[default: %default]'),
+    make_option(
+        '--seed', type='int', dest='seed', default=0,
+        help='Seed of the catalog; the same seed and options give the same files '
+             '[default: %default]'),
+)
+
+
+def catalog_from_options(num_books, options):
+    """Return the generator.Catalog of num_books books the CATALOG_OPTIONS describe"""
+    try:
+        schemes = generator.parse_schemes(options['schemes'])
+    except ValueError:
+        raise CommandError('--schemes takes scheme:weight pairs separated by commas')
+    return generator.Catalog(
+        num_books, aliases_per_book=options['aliases_per_book'], schemes=schemes,
+        duplicate_rate=options['duplicate_rate'], conflict_rate=options['conflict_rate'],
+        update_ratio=options['update_ratio'], seed=options['seed'])
+
+
+class Command(BaseCommand):
+    args = '<directory>'
+    help = ('Write a synthetic catalog to <directory>/initial and its update feed to '
+            '<directory>/update, ready for process_data_file')
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--books', type='int', dest='books', default=10000,
+            help='Number of books [default: %default]'),
+    ) + CATALOG_OPTIONS
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the directory to write the catalog to')
+        catalog = catalog_from_options(options['books'], options)
+        written = generator.write_catalog(args[0], catalog, layout=options['layout'])
+        for feed in ('initial', 'update'):
+            paths, num_books = written[feed]
+            print('{feed}: {num} book{s1} in {files} file{s2}.'.format(
+                feed=feed, num=num_books, s1=pluralize(num_books),
+                files=len(paths), s2=pluralize(len(paths))))
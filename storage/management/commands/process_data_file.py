@@ -2,37 +2,299 @@
 
 # Created by David Rideout <drideout@safaribooksonline.com> on 2/7/14 4:56 PM
 # Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import cProfile
+import json
+import multiprocessing
+from collections import Counter, deque
+from itertools import groupby
+from operator import itemgetter
+from optparse import make_option
 
-from lxml import etree
-
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection
 from django.template.defaultfilters import pluralize
 
+from storage import bulkload, deadletter, feeds, instrumentation, manifest
+from storage.models import FailedRecord
+from storage.index import AliasIndex, DEFAULT_MAX_ENTRIES
 import storage.tools as tools
 
+# Record closing the records of each file.
+END_RECORD = ('end', None, None, None)
+# Chunks of feeds.WORKER_CHUNK_SIZE books each worker may have in hand or waiting for the writer.
+PENDING_CHUNKS_PER_WORKER = 2
+
 
 class Command(BaseCommand):
     args = '<filename filename2 filename3 ...>'
-    help = 'Process an xml file '
+    help = ('Process xml files holding one or many <book> elements; files may be gzip or bz2 '
+            'compressed, or tar/zip archives of such files')
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', type='int', dest='batch_size', default=None,
+            help='Number of books stored per batch [default: {}, or {} with --bulk-load]'.format(
+                tools.DEFAULT_BATCH_SIZE, bulkload.BULK_BATCH_SIZE)),
+        make_option(
+            '--workers', type='int', dest='workers', default=1,
+            help='Number of processes parsing and extracting the books of the input files; this '
+                 'process only finds where each book starts and ends, and stays the only one '
+                 'writing to the database [default: %default]'),
+        make_option(
+            '--force', action='store_true', dest='force', default=False,
+            help='Import files again even if the manifest says they were imported already'),
+        make_option(
+            '--alias-index', action='store_true', dest='alias_index', default=False,
+            help='Keep an in-memory index of existing aliases to skip most lookup queries'),
+        make_option(
+            '--alias-index-entries', type='int', dest='alias_index_entries',
+            default=DEFAULT_MAX_ENTRIES,
+            help='Most (scheme, value) keys the alias index holds [default: %default]'),
+        make_option(
+            '--alias-index-bytes', type='int', dest='alias_index_bytes', default=None,
+            help='Approximate memory budget of the alias index, in bytes'),
+        make_option(
+            '--bulk-load', action='store_true', dest='bulk_load', default=False,
+            help='Switch SQLite to WAL with lighter syncing and a larger cache while importing, '
+                 'and store larger batches; the settings are restored afterwards'),
+        make_option(
+            '--drop-indexes', action='store_true', dest='drop_indexes', default=False,
+            help='For a first import into an empty database: --bulk-load, with the alias index, '
+                 'and the title, value and last-modified indexes built once at the end'),
+        make_option(
+            '--stats', action='store_true', dest='stats', default=False,
+            help='Time each stage of the import, count its queries, print books/sec as it goes '
+                 'and a table of the figures at the end; with --workers, parsing and extraction '
+                 'happen in the workers and are not timed'),
+        make_option(
+            '--stats-json', dest='stats_json', default=None,
+            help='Save the --stats figures to this JSON file; implies --stats'),
+        make_option(
+            '--progress-interval', type='int', dest='progress_interval',
+            default=instrumentation.DEFAULT_PROGRESS_INTERVAL,
+            help='Seconds between two --stats progress lines [default: %default]'),
+        make_option(
+            '--profile', dest='profile', default=None,
+            help='Run the import under cProfile and save the pstats data to this file'),
+    )
 
     def handle(self, *args, **options):
-        errors = []
+        self.errors = []
+        # Messages of file-level errors, by manifest entry, until the file is finished.
+        self.failures = {}
+        self.alias_index = None
+        bulk = options['bulk_load'] or options['drop_indexes']
+        batch_size = options['batch_size'] or (
+            bulkload.BULK_BATCH_SIZE if bulk else tools.DEFAULT_BATCH_SIZE)
+        # Without the value index, only the alias index keeps lookups from scanning every alias.
+        if options['alias_index'] or options['drop_indexes']:
+            self.alias_index = AliasIndex(
+                max_entries=options['alias_index_entries'],
+                max_bytes=options['alias_index_bytes']).warm()
         print('Processing {} titles\n'.format(len(args)))
+
+        entries = []
         for filename in args:
-            with open(filename, 'rb') as fh:
-                print('Importing {} into database.'.format(filename))
+            started = manifest.start(filename, force=options['force'])
+            if started is None:
+                print('Skipping {}, already imported.'.format(filename))
+                continue
+            entry, skip = started
+            if skip:
+                print('Resuming {} after {} books.'.format(filename, skip))
+            entries.append((filename, entry, skip))
+
+        records = self.read_records(entries, options['workers'])
+        stats = options['stats'] or options['stats_json']
+        if stats:
+            instrumentation.start(progress_interval=options['progress_interval'])
+        profiler = None
+        if options['profile']:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        try:
+            if bulk:
                 try:
-                    book_node = etree.parse(fh).getroot()
-                    book, update_type, conflicts = tools.process_book_element(book_node)
-                    print('... {action} "{title}"'.format(action=update_type, title=book.title))
-                    if conflicts:
-                        s = pluralize(conflicts)
-                        print('... with {num} conflict{s}.'.format(num=conflicts, s=s))
-                except Exception as err:
-                    # Use broad exception, we don't want to stop the batch
-                    print('!!! Error, skipping {}'.format(filename))
-                    errors.append({'filename': filename, 'message': err.message})
+                    with bulkload.bulk_load(drop_indexes=options['drop_indexes']):
+                        self.import_records(records, batch_size)
+                except ValueError as err:
+                    raise CommandError(err)
+            else:
+                self.import_records(records, batch_size)
+        finally:
+            if profiler is not None:
+                profiler.disable()
+                profiler.dump_stats(options['profile'])
+            recorder = instrumentation.stop()
 
         print('\nThe following files were skipped due to errors')
-        for err in errors:
+        for err in self.errors:
             print(u'    {file} : {msg}'.format(file=err['filename'], msg=err['message']))
+
+        if self.alias_index is not None:
+            print('\nAlias index: {hits} hits, {absent} known absent, {misses} misses, '
+                  '{evictions} evictions, {entries} entries'.format(**self.alias_index.stats()))
+
+        if recorder is not None:
+            print('\nImport statistics')
+            for line in recorder.report():
+                print(line)
+            if options['stats_json']:
+                with open(options['stats_json'], 'w') as fh:
+                    json.dump(recorder.summary(), fh, indent=2)
+                print('Statistics saved to {}'.format(options['stats_json']))
+        if profiler is not None:
+            print('Profile saved to {0}; read it with python -m pstats {0}'.format(
+                options['profile']))
+
+    def read_records(self, entries, workers):
+        """Yield (manifest entry, record) for the feeds.read_feed records of every file, in order
+
+        Books an interrupted import already committed are left out, and each file's records are
+        followed by an ('end', None, None, None) record.
+        """
+        if workers <= 1:
+            for filename, entry, skip in entries:
+                for record in self.skip_committed(feeds.read_feed(filename), skip):
+                    yield entry, record
+                yield entry, END_RECORD
+            return
+        chunks = self.read_in_pool(self.read_chunks(entries), workers)
+        records = ((key, record) for key, chunk in chunks for record in chunk)
+        for (filename, entry), keyed in groupby(records, key=itemgetter(0)):
+            for record in feeds.settle_records(filename, (record for key, record in keyed)):
+                yield entry, record
+
+    def read_chunks(self, entries):
+        """Yield ((filename, manifest entry), records) chunks of every file, books not parsed yet
+
+        Only the book boundaries are found here; the workers parse the books.
+        """
+        for filename, entry, skip in entries:
+            records = self.skip_committed(feeds.read_feed(filename, extract=False), skip)
+            for chunk in feeds.chunk_records(records, feeds.WORKER_CHUNK_SIZE):
+                yield (filename, entry), chunk
+            yield (filename, entry), [END_RECORD]
+
+    def skip_committed(self, records, skip):
+        """Yield records, leaving out the first skip books"""
+        for record in records:
+            if record[0] == 'book' and skip:
+                skip -= 1
+                continue
+            yield record
+
+    def read_in_pool(self, chunks, workers):
+        """Yield the (key, records) chunks with their books parsed and extracted by a worker pool
+
+        Chunks come back in order. At most PENDING_CHUNKS_PER_WORKER chunks per worker are read
+        ahead of the one being stored, so memory does not grow with the size of the feeds.
+        """
+        # Workers only extract; don't let them inherit the writer's database connection.
+        connection.close()
+        pool = multiprocessing.Pool(workers)
+        try:
+            pending = deque()
+            for key, chunk in chunks:
+                pending.append((key, pool.apply_async(feeds.extract_records, (chunk,))))
+                if len(pending) >= workers * PENDING_CHUNKS_PER_WORKER:
+                    key, result = pending.popleft()
+                    yield key, result.get()
+            while pending:
+                key, result = pending.popleft()
+                yield key, result.get()
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+
+    def import_records(self, records, batch_size):
+        """Store the books among records a batch at a time, reporting each record in order"""
+        queued, batch = [], []
+        for entry, record in records:
+            queued.append((entry, record))
+            if record[0] == 'book':
+                batch.append(record[2])
+                if len(batch) >= batch_size:
+                    self.commit(queued, batch)
+                    queued, batch = [], []
+        self.commit(queued, batch)
+
+    def commit(self, queued, batch):
+        """Store a batch and record it in the manifest as one transaction, then report it
+
+        The transaction is run again while another importer holds the database lock.
+        """
+        results = tools.retry_when_locked(self.store_and_record, queued, batch)
+        for entry, record in queued:
+            if record[0] == 'end':
+                self.failures.pop(entry.pk, None)
+        self.report([record for entry, record in queued], results)
+        progress = instrumentation.add_books(len(batch))
+        if progress is not None:
+            print(progress)
+
+    def store_and_record(self, queued, batch):
+        try:
+            with tools.write_transaction():
+                results = self.store(batch)
+                with instrumentation.stage('manifest'):
+                    self.record_progress(queued, results)
+        except DatabaseError:
+            if self.alias_index is not None:
+                # It may hold rows that were just rolled back.
+                self.alias_index.forget()
+            raise
+        return results
+
+    def record_progress(self, queued, results):
+        """Count each file's books and errors in the manifest and dead-letter the failures
+
+        Also finishes the files that ended in this batch.
+        """
+        entries, books, errors, ended = {}, Counter(), Counter(), []
+        results = iter(results)
+        for entry, (kind, label, payload, raw) in queued:
+            entries[entry.pk] = entry
+            if kind == 'book':
+                books[entry.pk] += 1
+                result = next(results)
+                if isinstance(result, Exception):
+                    errors[entry.pk] += 1
+                    stage = FailedRecord.EXTRACT if result is payload else FailedRecord.STORE
+                    deadletter.record_failure(label, stage, result, raw)
+            elif kind == 'error':
+                errors[entry.pk] += 1
+                self.failures[entry.pk] = deadletter.error_message(payload)
+                deadletter.record_failure(label, FailedRecord.PARSE, payload)
+            elif kind == 'end':
+                ended.append(entry)
+        for pk, entry in entries.items():
+            manifest.record_progress(entry, books[pk], errors[pk])
+        for entry in ended:
+            manifest.finish(entry, self.failures.get(entry.pk, ''))
+
+    def store(self, batch):
+        return tools.store_books_with_conflicts(batch, alias_index=self.alias_index)
+
+    def report(self, records, results):
+        """Print records as if each book had been stored as soon as it was read"""
+        results = iter(results)
+        for kind, label, payload, raw in records:
+            if kind == 'source':
+                print('Importing {} into database.'.format(label))
+            elif kind == 'error':
+                self.report_error(label, payload)
+            elif kind == 'book':
+                result = next(results)
+                if isinstance(result, Exception):
+                    self.report_error(label, result)
+                    continue
+                book, update_type, conflicts = result
+                print('... {action} "{title}"'.format(action=update_type, title=book.title))
+                if conflicts:
+                    s = pluralize(conflicts)
+                    print('... with {num} conflict{s}.'.format(num=conflicts, s=s))
+
+    def report_error(self, label, err):
+        print('!!! Error, skipping {}'.format(label))
+        self.errors.append({'filename': label, 'message': deadletter.error_message(err)})
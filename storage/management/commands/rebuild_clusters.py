@@ -0,0 +1,33 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import pluralize
+
+from storage import bulkload, clusters
+
+
+class Command(BaseCommand):
+    help = 'Recompute the cluster of every book from the aliases books share'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--chunk-size', type='int', dest='chunk_size', default=clusters.DEFAULT_CHUNK_SIZE,
+            help='Rows read per query and books updated per transaction [default: %default]'),
+        make_option(
+            '--bulk-load', action='store_true', dest='bulk_load', default=False,
+            help='Switch SQLite to WAL with lighter syncing and a larger cache while running'),
+    )
+
+    def handle(self, *args, **options):
+        if options['bulk_load']:
+            with bulkload.bulk_load():
+                num_clusters, num_updated = clusters.rebuild_clusters(
+                    chunk_size=options['chunk_size'])
+        else:
+            num_clusters, num_updated = clusters.rebuild_clusters(
+                chunk_size=options['chunk_size'])
+        print('{num} cluster{s1}; {updated} book{s2} updated.'.format(
+            num=num_clusters, s1=pluralize(num_clusters),
+            updated=num_updated, s2=pluralize(num_updated)))
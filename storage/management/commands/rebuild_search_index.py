@@ -0,0 +1,29 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import pluralize
+
+from storage import bulkload, search
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the full-text search index of book titles and descriptions'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--chunk-size', type='int', dest='chunk_size', default=search.DEFAULT_CHUNK_SIZE,
+            help='Books re-indexed per transaction [default: %default]'),
+        make_option(
+            '--bulk-load', action='store_true', dest='bulk_load', default=False,
+            help='Switch SQLite to WAL with lighter syncing and a larger cache while running'),
+    )
+
+    def handle(self, *args, **options):
+        if options['bulk_load']:
+            with bulkload.bulk_load():
+                num_indexed = search.rebuild_search_index(chunk_size=options['chunk_size'])
+        else:
+            num_indexed = search.rebuild_search_index(chunk_size=options['chunk_size'])
+        print('{num} book{s} indexed.'.format(num=num_indexed, s=pluralize(num_indexed)))
@@ -0,0 +1,97 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from optparse import make_option
+
+from lxml import etree
+
+from django.core.management.base import BaseCommand
+from django.db.models import F
+from django.template.defaultfilters import pluralize
+from django.utils import timezone
+
+from storage import deadletter
+from storage.models import FailedRecord
+import storage.tools as tools
+
+
+class Command(BaseCommand):
+    args = '[failed record id ...]'
+    help = 'Re-import dead-lettered <book> records, a batch at a time'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--batch-size', type='int', dest='batch_size', default=tools.DEFAULT_BATCH_SIZE,
+            help='Number of records replayed per batch [default: %default]'),
+        make_option(
+            '--source', dest='source', default=None,
+            help='Only replay records read from sources starting with this path'),
+    )
+
+    def handle(self, *args, **options):
+        pending = FailedRecord.objects.filter(resolved_time=None)
+        if args:
+            pending = pending.filter(pk__in=args)
+        if options['source']:
+            pending = pending.filter(source__startswith=options['source'])
+
+        self.num_resolved = self.num_failed = 0
+        last_id = 0
+        while True:
+            failures = list(pending.exclude(raw_xml='').filter(id__gt=last_id).order_by('id')[
+                :options['batch_size']])
+            if not failures:
+                break
+            last_id = failures[-1].id
+            self.replay(failures)
+
+        print('\nReplayed {} record{}: {} imported, {} still failing.'.format(
+            self.num_resolved + self.num_failed, pluralize(self.num_resolved + self.num_failed),
+            self.num_resolved, self.num_failed))
+        unreadable = pending.filter(raw_xml='').count()
+        if unreadable:
+            print('{} failure{} happened before a <book> could be read; run process_data_file on '
+                  'those files again.'.format(unreadable, pluralize(unreadable)))
+
+    def replay(self, failures):
+        """Extract and store a batch of failed records, updating their dead-letter entries
+
+        The batch is run again while another importer holds the database lock.
+        """
+        incomings = []
+        for failure in failures:
+            try:
+                incomings.append(tools.extract_book_data(etree.fromstring(failure.raw_xml)))
+            except Exception as err:
+                incomings.append(err)
+
+        results = tools.retry_when_locked(self.store_and_record, failures, incomings)
+        for failure, result in zip(failures, results):
+            if isinstance(result, Exception):
+                self.num_failed += 1
+                print(u'!!! Still failing {}'.format(failure.source))
+                continue
+            self.num_resolved += 1
+            book, update_type, conflicts = result
+            print(u'... {action} "{title}" from {source}'.format(
+                action=update_type, title=book.title, source=failure.source))
+
+    def store_and_record(self, failures, incomings):
+        """Store a batch and update its dead-letter entries as one transaction"""
+        with tools.write_transaction():
+            results = tools.store_books_with_conflicts(incomings)
+            resolved = []
+            for failure, incoming, result in zip(failures, incomings, results):
+                if not isinstance(result, Exception):
+                    resolved.append(failure.pk)
+                    continue
+                FailedRecord.objects.filter(pk=failure.pk).update(
+                    stage=FailedRecord.EXTRACT if result is incoming else FailedRecord.STORE,
+                    exception=deadletter.error_name(result),
+                    message=deadletter.error_message(result),
+                    attempts=F('attempts') + 1)
+            now = timezone.now()
+            for start in range(0, len(resolved), tools.MAX_QUERY_PARAMS):
+                FailedRecord.objects.filter(
+                    pk__in=resolved[start:start + tools.MAX_QUERY_PARAMS]).update(
+                    resolved_time=now)
+        return results
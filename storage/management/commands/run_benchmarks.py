@@ -0,0 +1,77 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import json
+import shutil
+import tempfile
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from storage import benchmarks
+from storage.management.commands.generate_catalog import CATALOG_OPTIONS, catalog_from_options
+
+
+class Command(BaseCommand):
+    help = ('Import synthetic catalogs of each size into scratch databases and measure import '
+            'throughput, conflict detection, admin rendering and peak memory; the configured '
+            'database is not touched')
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--sizes', dest='sizes', default=','.join(str(n) for n in benchmarks.DEFAULT_SIZES),
+            help='Numbers of books to benchmark, separated by commas [default: %default]'),
+        make_option(
+            '--output', dest='output', default=None,
+            help='JSON file to save the results to [default: benchmark-<time>.json]'),
+        make_option(
+            '--compare', dest='compare', default=None,
+            help='JSON results of an earlier run to compare these with'),
+        make_option(
+            '--workdir', dest='workdir', default=None,
+            help='Directory for the feeds and scratch databases [default: a temporary one]'),
+        make_option(
+            '--bulk-load', action='store_true', dest='bulk_load', default=False,
+            help='Import with process_data_file --bulk-load'),
+        make_option(
+            '--alias-index', action='store_true', dest='alias_index', default=False,
+            help='Import with process_data_file --alias-index'),
+    ) + CATALOG_OPTIONS
+
+    def handle(self, *args, **options):
+        try:
+            sizes = [int(size) for size in options['sizes'].split(',')]
+        except ValueError:
+            raise CommandError('--sizes takes numbers separated by commas')
+        previous = None
+        if options['compare']:
+            with open(options['compare']) as fh:
+                previous = json.load(fh)
+        output = options['output'] or 'benchmark-{}.json'.format(time.strftime('%Y%m%d-%H%M%S'))
+        import_options = dict(
+            (name, True) for name in ('bulk_load', 'alias_index') if options[name])
+
+        workdir = options['workdir'] or tempfile.mkdtemp(prefix='figgy-benchmark-')
+        try:
+            results = benchmarks.run_benchmarks(
+                sizes, workdir, catalog_from_options(sizes[0], options),
+                layout=options['layout'], import_options=import_options)
+        finally:
+            if not options['workdir']:
+                shutil.rmtree(workdir, ignore_errors=True)
+
+        with open(output, 'w') as fh:
+            json.dump(results, fh, indent=2, sort_keys=True)
+        for result in results['sizes']:
+            print('{books} books: {rate} books/sec imported, {update} books/sec updated, '
+                  '{elements} books/sec one by one, peak RSS {rss} kB'.format(
+                      books=result['books'],
+                      rate=result['process_data_file']['books_per_sec'],
+                      update=result['process_data_file_update']['books_per_sec'],
+                      elements=result['process_book_element']['books_per_sec'],
+                      rss=result['peak_rss_kb']))
+        print('Results saved to {}.'.format(output))
+        if previous is not None:
+            print('\nCompared with {}:'.format(options['compare']))
+            for line in benchmarks.compare(previous, results):
+                print(line)
@@ -0,0 +1,30 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.template.defaultfilters import pluralize
+
+from storage import scanner
+
+
+class Command(BaseCommand):
+    help = 'Find every alias shared by more than one book and bring Conflicts up to date'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--incremental', action='store_true', dest='incremental', default=False,
+            help='Only re-check aliases modified since the last finished scan'),
+        make_option(
+            '--chunk-size', type='int', dest='chunk_size', default=scanner.DEFAULT_CHUNK_SIZE,
+            help='Rows handled per transaction [default: %default]'),
+    )
+
+    def handle(self, *args, **options):
+        scan = scanner.scan_conflicts(
+            incremental=options['incremental'], chunk_size=options['chunk_size'])
+        print('{mode} scan: inserted {inserted} conflict{s1}, deleted {deleted} stale '
+              'conflict{s2}.'.format(
+                  mode=scan.get_mode_display(),
+                  inserted=scan.num_inserted, s1=pluralize(scan.num_inserted),
+                  deleted=scan.num_deleted, s2=pluralize(scan.num_deleted)))
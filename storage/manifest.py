@@ -0,0 +1,61 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import hashlib
+import os
+
+from django.db.models import F
+
+from storage.models import ImportedFile
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_hash(path):
+    """Return the SHA-1 hex digest of a file, read a chunk at a time"""
+    digest = hashlib.sha1()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(HASH_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def start(filename, force=False):
+    """Return the (ImportedFile, books to skip) to import filename with, or None to skip it
+
+    A file whose content was already imported successfully is skipped unless force is set. One
+    whose import was interrupted resumes after the books its committed batches covered. A file
+    that cannot be read gets an entry nonetheless; reading it reports the error.
+    """
+    path = os.path.abspath(filename)
+    try:
+        stat = os.stat(path)
+        size, mtime = stat.st_size, stat.st_mtime
+        # Unchanged size and mtime on the same path is taken to mean unchanged content.
+        done = ImportedFile.objects.filter(
+            path=path, size=size, mtime=mtime, status=ImportedFile.DONE).first()
+        digest = done.content_hash if done else content_hash(path)
+    except (IOError, OSError):
+        size, mtime, digest = 0, 0, ''
+
+    previous = ImportedFile.objects.filter(
+        size=size, content_hash=digest).exclude(content_hash='').order_by('-id').first()
+    if previous is not None and previous.status == ImportedFile.DONE and not force:
+        return None
+    if previous is not None and previous.status == ImportedFile.STARTED and not force:
+        return previous, previous.books_committed
+    entry = ImportedFile.objects.create(path=path, size=size, mtime=mtime, content_hash=digest)
+    return entry, 0
+
+
+def record_progress(entry, num_books, num_errors):
+    """Add a committed batch's books and errors to a manifest entry"""
+    ImportedFile.objects.filter(pk=entry.pk).update(
+        books_committed=F('books_committed') + num_books,
+        num_errors=F('num_errors') + num_errors)
+
+
+def finish(entry, message=''):
+    """Mark a manifest entry done, or failed with message"""
+    status = ImportedFile.FAILED if message else ImportedFile.DONE
+    ImportedFile.objects.filter(pk=entry.pk).update(status=status, message=message)
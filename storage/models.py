@@ -2,6 +2,8 @@
 
 from django.db import models
 
+from storage import validation
+
 
 class BaseModel(models.Model):
     """Base class for all models"""
@@ -12,12 +14,10 @@ class BaseModel(models.Model):
 
     def save(self, *args, **kwargs):
 
-        # SQLite does not honor CharField max_length; calling full_clean is one work-around to force
-        # the validation. However, this will raise a ValidationError, where as I believe most other
-        # backends will properly raise a DatabaseError.
-        # This is a temporary fix until we figure out what's next. While it works okay for
-        # processing XML files, it may not be appropriate in other cases.
-        self.full_clean()
+        # SQLite does not honor CharField max_length, so the compiled field checks enforce it
+        # (and blank, null and choices) before every write, raising the ValidationError that
+        # full_clean would. Unlike full_clean they leave uniqueness to the database.
+        validation.validate_instance(self, kwargs.get('update_fields'))
         super(BaseModel, self).save(*args, **kwargs)
 
     class Meta:
@@ -32,6 +32,21 @@ class Book(BaseModel):
     description = models.TextField(
         blank=True, null=True, default=None,
         help_text='Very short description of this book.')
+    fingerprint = models.CharField(
+        max_length=40, blank=True, default='', editable=False,
+        help_text='Hash of the publisher record this book was last imported from.')
+    version = models.CharField(
+        max_length=40, null=True, blank=True, default=None, editable=False,
+        help_text='Version of the publisher record this book was last imported from; older '
+                  'and equal versions arriving later are skipped.')
+    publisher_id = models.CharField(
+        max_length=255, null=True, blank=True, default=None, unique=True, editable=False,
+        help_text='Publisher id of the record that created this book, unless another book held '
+                  'it already. Unique, so concurrent imports cannot both create the book.')
+    cluster_id = models.PositiveIntegerField(
+        null=True, blank=True, default=None, db_index=True, editable=False,
+        help_text='Smallest book id among the books linked to this one by shared aliases, '
+                  'directly or transitively; empty if it shares none.')
 
     def __unicode__(self):
         return u'Book "{}"'.format(self.title)
@@ -59,6 +74,8 @@ class Alias(BaseModel):
 
     class Meta:
         unique_together = ('book', 'scheme', 'value')
+        # Conflict detection and PUB_ID lookups always match on both columns.
+        index_together = [('scheme', 'value')]
 
     def __unicode__(self):
         return u'"{title}": {scheme} / {value}'.format(
@@ -89,3 +106,101 @@ class Conflict(BaseModel):
             title=self.book.title,
             scheme=self.alias.scheme,
             value=self.alias.value)
+
+
+class ImportedFile(BaseModel):
+    """Manifest entry for a file given to process_data_file
+
+    Identifies the file by path, size, mtime and content hash and records how far its import
+    got, so re-runs can skip files already imported and resume interrupted ones.
+    """
+    STARTED = 'started'
+    DONE = 'done'
+    FAILED = 'failed'
+    STATUS_CHOICES = (
+        (STARTED, 'Started'),
+        (DONE, 'Done'),
+        (FAILED, 'Failed'),
+    )
+
+    path = models.CharField(
+        max_length=1024, db_index=True,
+        help_text='Absolute path of the imported file')
+    size = models.BigIntegerField()
+    mtime = models.FloatField()
+    content_hash = models.CharField(
+        max_length=40, db_index=True, blank=True,
+        help_text='SHA-1 of the file content; blank if the file could not be read')
+    status = models.CharField(
+        max_length=10, choices=STATUS_CHOICES, default=STARTED)
+    books_committed = models.PositiveIntegerField(
+        default=0,
+        help_text='Number of books read from the file whose batch has been committed')
+    num_errors = models.PositiveIntegerField(default=0)
+    message = models.TextField(
+        blank=True, default='',
+        help_text='Why the file could not be read to the end, if it failed')
+
+    def __unicode__(self):
+        return u'{path} ({status})'.format(path=self.path, status=self.status)
+
+
+class FailedRecord(BaseModel):
+    """Dead-letter entry for a record that could not be imported
+
+    Holds the raw <book> XML (when the failure got that far) with the exception that rejected it
+    and the pipeline stage it failed in, so the record can be replayed once the cause is fixed.
+    """
+    PARSE = 'parse'
+    EXTRACT = 'extract'
+    STORE = 'store'
+    STAGE_CHOICES = (
+        (PARSE, 'Parse'),
+        (EXTRACT, 'Extract'),
+        (STORE, 'Store'),
+    )
+
+    source = models.CharField(
+        max_length=1024, db_index=True,
+        help_text='File (and book number) the record was read from')
+    stage = models.CharField(max_length=10, choices=STAGE_CHOICES)
+    raw_xml = models.TextField(
+        blank=True, default='',
+        help_text='The <book> element as received; blank if the file could not be parsed')
+    exception = models.CharField(max_length=255)
+    message = models.TextField(blank=True, default='')
+    attempts = models.PositiveIntegerField(default=1)
+    resolved_time = models.DateTimeField(
+        null=True, blank=True, default=None, db_index=True,
+        help_text='When a replay imported the record')
+
+    def __unicode__(self):
+        return u'{source}: {exception} ({stage})'.format(
+            source=self.source, exception=self.exception, stage=self.stage)
+
+
+class ConflictScan(BaseModel):
+    """Record of a scan_conflicts run
+
+    The watermark is the newest Alias last_modified_time the scan covered; an incremental scan
+    only re-checks aliases modified after the watermark of the last finished scan.
+    """
+    FULL = 'full'
+    INCREMENTAL = 'incremental'
+    MODE_CHOICES = (
+        (FULL, 'Full'),
+        (INCREMENTAL, 'Incremental'),
+    )
+
+    mode = models.CharField(max_length=12, choices=MODE_CHOICES)
+    watermark = models.DateTimeField(null=True, blank=True, default=None)
+    finished_time = models.DateTimeField(null=True, blank=True, default=None, db_index=True)
+    num_inserted = models.PositiveIntegerField(default=0)
+    num_deleted = models.PositiveIntegerField(default=0)
+
+    def __unicode__(self):
+        return u'{mode} scan of {time}'.format(mode=self.mode, time=self.created_time)
+
+
+# Connects the signal handlers keeping the storage cache in step with these models.
+import storage.caching  # noqa
@@ -0,0 +1,85 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import hashlib
+
+from django.core.cache import cache
+from django.core.paginator import Paginator
+from django.db import DatabaseError, connection
+from django.db.models import Q
+from django.db.models.sql.datastructures import EmptyResultSet
+
+# How long an exact count is reused before it is run again, in seconds.
+COUNT_CACHE_TIMEOUT = 300
+
+
+def estimated_count(queryset):
+    """Return the number of rows in queryset, estimated or cached rather than counted each time
+
+    An unfiltered queryset is answered from the planner statistics (sqlite_stat1 once ANALYZE has
+    run, pg_class.reltuples on PostgreSQL). Anything else, or a table without statistics, is
+    counted exactly and the answer cached for COUNT_CACHE_TIMEOUT seconds.
+    """
+    query = queryset.query
+    try:
+        sql = u'{}'.format(query)
+    except EmptyResultSet:
+        # queryset.none(), or a filter on an empty list: there is no SQL to run.
+        return 0
+    if not query.where and not query.having and not query.distinct:
+        estimate = _table_estimate(queryset.model._meta.db_table)
+        if estimate is not None:
+            return estimate
+    key = 'storage.count.{}'.format(hashlib.sha1(sql.encode('utf-8')).hexdigest())
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
+
+
+def _table_estimate(table):
+    if connection.vendor == 'sqlite':
+        # The first number of an index's stat is the number of rows the index covers.
+        sql = 'SELECT stat FROM sqlite_stat1 WHERE tbl = %s LIMIT 1'
+    elif connection.vendor == 'postgresql':
+        sql = 'SELECT reltuples::bigint FROM pg_class WHERE relname = %s AND reltuples > 0'
+    else:
+        return None
+    cursor = connection.cursor()
+    try:
+        cursor.execute(sql, [table])
+    except DatabaseError:
+        # No sqlite_stat1 table until ANALYZE has been run once.
+        return None
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return int(str(row[0]).split()[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """Paginator whose count comes from estimated_count instead of a COUNT(*) per request"""
+
+    def _get_count(self):
+        if self._count is None:
+            self._count = estimated_count(self.object_list)
+        return self._count
+    count = property(_get_count)
+
+
+def keyset_filter(ordering, values):
+    """Return a Q selecting the rows that come after values in ordering
+
+    ordering is a list of field names as given to order_by(), ending with a unique field, and
+    values the row to continue from, one value per field. The first field is also bounded on
+    its own so the database can start from an index range instead of testing every row.
+    """
+    fields = [(name.lstrip('-'), name.startswith('-')) for name in ordering]
+    name, descending = fields[-1]
+    after = Q(**{'{}__{}'.format(name, 'lt' if descending else 'gt'): values[-1]})
+    for (name, descending), value in reversed(list(zip(fields[:-1], values[:-1]))):
+        beyond = Q(**{'{}__{}'.format(name, 'lt' if descending else 'gt'): value})
+        after = beyond | (Q(**{name: value}) & after)
+    name, descending = fields[0]
+    return Q(**{'{}__{}'.format(name, 'lte' if descending else 'gte'): values[0]}) & after
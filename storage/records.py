@@ -0,0 +1,78 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Compact records of the books read from feeds, on their way to the database
+
+A book record is a tuple holding a tuple of alias records, instead of a dict holding a list of
+dicts: a fraction of the memory per book while a batch is held, and nothing for the garbage
+collector to track per alias. Alias schemes come from a handful of names, so each is interned
+and stored once however many aliases use it.
+
+The storage functions also take the dict these records replace, shaped like
+{'publisher_id': ..., 'title': ..., 'description': ..., 'aliases': [{'scheme': ..., 'value':
+...}, ...]}, as a form's cleaned_data would be, with an optional 'version'; book_record() turns
+either into a BookRecord.
+"""
+from collections import namedtuple
+
+# Most distinct schemes interned; past it, a feed full of made-up schemes costs no more memory
+# than it would without interning.
+MAX_INTERNED_SCHEMES = 1000
+
+_schemes = {}
+
+
+def intern_scheme(scheme):
+    """Return the one shared copy of the scheme name"""
+    try:
+        return _schemes[scheme]
+    except KeyError:
+        if len(_schemes) < MAX_INTERNED_SCHEMES:
+            _schemes[scheme] = scheme
+        return scheme
+
+
+class AliasRecord(namedtuple('AliasRecord', ['scheme', 'value'])):
+    """An alias of a book record; compares equal to the (scheme, value) pair"""
+    __slots__ = ()
+
+    def __new__(cls, scheme, value):
+        return super(AliasRecord, cls).__new__(cls, intern_scheme(scheme), value)
+
+
+class BookRecord(namedtuple(
+        'BookRecord', ['publisher_id', 'title', 'description', 'aliases', 'version'])):
+    """A book read from a feed; aliases is a tuple of AliasRecords, its PUB_ID among them
+
+    version is the publisher's version string of the record, or None if it has none.
+    """
+    __slots__ = ()
+
+    def __new__(cls, publisher_id, title, description, aliases, version=None):
+        return super(BookRecord, cls).__new__(cls, publisher_id, title, description, tuple(
+            alias if isinstance(alias, AliasRecord) else AliasRecord(*alias)
+            for alias in aliases), version)
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return the record of a dict shaped like a form's cleaned_data; 'version' is optional"""
+        return cls(data['publisher_id'], data['title'], data['description'],
+                   [AliasRecord(alias['scheme'], alias['value']) for alias in data['aliases']],
+                   data.get('version'))
+
+    def to_dict(self):
+        """Return the record as the dict from_dict takes"""
+        return {
+            'publisher_id': self.publisher_id,
+            'title': self.title,
+            'description': self.description,
+            'version': self.version,
+            'aliases': [{'scheme': alias.scheme, 'value': alias.value}
+                        for alias in self.aliases]}
+
+
+def book_record(incoming):
+    """Return incoming as a BookRecord, whether it is one already or a dict"""
+    if isinstance(incoming, BookRecord):
+        return incoming
+    return BookRecord.from_dict(incoming)
@@ -0,0 +1,160 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from collections import defaultdict
+
+from django.db import connection, transaction
+from django.db.models import Max
+from django.utils import timezone
+
+from storage import caching
+from storage.changes import SAFETY_WINDOW
+from storage.models import Alias, Conflict, ConflictScan
+from storage.tools import in_chunks, MAX_QUERY_PARAMS
+
+DEFAULT_CHUNK_SIZE = 1000
+
+# (scheme, value) pairs held more than once, walked in index order. A Book never holds the same
+# pair twice (unique_together), so COUNT(*) counts books and the (scheme, value) index covers it.
+DUPLICATED_PAIRS_SQL = (
+    'SELECT scheme, value FROM {alias} WHERE (scheme, value) > (%s, %s) '
+    'GROUP BY scheme, value HAVING COUNT(*) > 1 ORDER BY scheme, value LIMIT %s')
+
+# Conflicts whose book holds no alias matching the conflicting alias, or that point at one of
+# the book's own aliases.
+STALE_CONFLICTS_SQL = (
+    'SELECT c.id FROM {conflict} c INNER JOIN {alias} a ON a.id = c.alias_id '
+    'WHERE {where} AND (a.book_id = c.book_id OR NOT EXISTS ('
+    'SELECT 1 FROM {alias} m WHERE m.book_id = c.book_id '
+    'AND m.scheme = a.scheme AND m.value = a.value))')
+
+
+def scan_conflicts(incremental=False, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Bring the Conflict table in line with the aliases books share; return the ConflictScan
+
+    A full scan walks every (scheme, value) held by more than one book with one GROUP BY pass
+    over Alias, then checks every Conflict for staleness. An incremental scan only re-checks the
+    aliases modified since changes.SAFETY_WINDOW before the last finished scan's watermark, and
+    falls back to a full scan if there is none. Either way the work is done chunk_size rows at a
+    time, one transaction per chunk.
+    """
+    last_scan = None
+    if incremental:
+        last_scan = ConflictScan.objects.filter(
+            finished_time__isnull=False).order_by('-watermark').first()
+    scan = ConflictScan.objects.create(
+        mode=ConflictScan.INCREMENTAL if last_scan else ConflictScan.FULL,
+        watermark=Alias.objects.aggregate(watermark=Max('last_modified_time'))['watermark'])
+
+    if last_scan is not None:
+        counts = _scan_modified(last_scan.watermark, chunk_size)
+    else:
+        counts = _scan_all(chunk_size)
+    scan.num_inserted, scan.num_deleted = counts
+    scan.finished_time = timezone.now()
+    scan.save()
+    return scan
+
+
+def _scan_all(chunk_size):
+    inserted = deleted = 0
+    last_pair = ('', '')
+    while True:
+        pairs = _raw(DUPLICATED_PAIRS_SQL, list(last_pair) + [chunk_size])
+        if not pairs:
+            break
+        last_pair = pairs[-1]
+        with transaction.atomic():
+            counts = sync_pairs(set(pairs))
+        inserted += counts[0]
+        deleted += counts[1]
+
+    last_id = 0
+    last_conflict_id = Conflict.objects.aggregate(last=Max('id'))['last'] or 0
+    while last_id < last_conflict_id:
+        with transaction.atomic():
+            deleted += _delete_stale('c.id > %s AND c.id <= %s', [last_id, last_id + chunk_size])
+        last_id += chunk_size
+    return inserted, deleted
+
+
+def _scan_modified(watermark, chunk_size):
+    inserted = deleted = 0
+    modified = Alias.objects.order_by('id').values_list('id', 'book_id', 'scheme', 'value')
+    if watermark is not None:
+        # An alias is stamped before its transaction commits, so one stamped just before the
+        # watermark may have been invisible to the last scan; look back as far as the change feed.
+        modified = modified.filter(last_modified_time__gt=watermark - SAFETY_WINDOW)
+    last_id = 0
+    while True:
+        rows = list(modified.filter(id__gt=last_id)[:chunk_size])
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        with transaction.atomic():
+            num_inserted, num_deleted = sync_pairs(
+                set((scheme, value) for _, _, scheme, value in rows))
+            # A modified alias may have left a pair behind that its book still has conflicts on.
+            book_ids = sorted(set(row[1] for row in rows))
+            for start in range(0, len(book_ids), MAX_QUERY_PARAMS):
+                chunk = book_ids[start:start + MAX_QUERY_PARAMS]
+                num_deleted += _delete_stale(
+                    'c.book_id IN ({})'.format(', '.join(['%s'] * len(chunk))), chunk)
+        inserted += num_inserted
+        deleted += num_deleted
+    return inserted, deleted
+
+
+def sync_pairs(pairs):
+    """Insert the missing and delete the stale Conflicts among the aliases holding pairs
+
+    Every book holding a pair gets a Conflict on each other book's alias for it. Returns the
+    number of Conflicts inserted and deleted.
+    """
+    groups = defaultdict(list)
+    for alias_id, book_id, scheme, value in in_chunks(
+            Alias.objects.values_list('id', 'book_id', 'scheme', 'value'), 'value',
+            set(value for scheme, value in pairs)):
+        if (scheme, value) in pairs:
+            groups[(scheme, value)].append((alias_id, book_id))
+
+    expected = set()
+    for group in groups.values():
+        for _, book_id in group:
+            for alias_id, holder_id in group:
+                if holder_id != book_id:
+                    expected.add((book_id, alias_id))
+
+    existing = {}
+    alias_ids = [alias_id for group in groups.values() for alias_id, _ in group]
+    for conflict_id, book_id, alias_id in in_chunks(
+            Conflict.objects.values_list('id', 'book_id', 'alias_id'), 'alias_id', alias_ids):
+        existing[(book_id, alias_id)] = conflict_id
+
+    missing = expected.difference(existing)
+    Conflict.objects.bulk_create(
+        [Conflict(book_id=book_id, alias_id=alias_id) for book_id, alias_id in missing])
+    caching.invalidate_books(book_id for book_id, alias_id in missing)
+    stale = [conflict_id for key, conflict_id in existing.items() if key not in expected]
+    _delete_conflicts(stale)
+    return len(missing), len(stale)
+
+
+def _delete_stale(where, params):
+    """Delete the stale Conflicts matching a WHERE clause on `c`; return how many there were"""
+    stale = [row[0] for row in _raw(STALE_CONFLICTS_SQL, params, where=where)]
+    _delete_conflicts(stale)
+    return len(stale)
+
+
+def _delete_conflicts(conflict_ids):
+    for start in range(0, len(conflict_ids), MAX_QUERY_PARAMS):
+        Conflict.objects.filter(id__in=conflict_ids[start:start + MAX_QUERY_PARAMS]).delete()
+
+
+def _raw(sql, params, **fragments):
+    """Run sql, with its {alias} and {conflict} table names filled in; return all rows"""
+    cursor = connection.cursor()
+    cursor.execute(sql.format(
+        alias=Alias._meta.db_table, conflict=Conflict._meta.db_table, **fragments), params)
+    return [tuple(row) for row in cursor.fetchall()]
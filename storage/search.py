@@ -0,0 +1,84 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import re
+
+from django.db import connection, transaction
+
+from storage.models import Book
+
+# The FTS5 table created by storage/sql/book.sqlite3.sql.
+SEARCH_TABLE = 'storage_book_search'
+DEFAULT_CHUNK_SIZE = 10000
+
+# bm25 weights of the title and description columns: a word in the title counts for more.
+TITLE_WEIGHT = 10.0
+DESCRIPTION_WEIGHT = 1.0
+
+RANK_SQL = 'bm25({search}, %s, %s)'
+MATCH_SQL = '{search} MATCH %s AND {search}.rowid = {book}.id'
+
+
+def match_expression(text):
+    """Turn what a user typed into an FTS5 query, or None if it holds no words
+
+    Every word has to match, in the title or the description; the last one may be the start of a
+    word, so results come up while the user is still typing. FTS5 operators and quotes in the
+    text are taken as plain words.
+    """
+    words = re.findall(r'\w+', text, re.UNICODE)
+    if not words:
+        return None
+    return u' '.join(u'"{}"'.format(word) for word in words) + u'*'
+
+
+def search_books(text, queryset=None):
+    """Return the books of queryset (all books by default) matching text, best match first
+
+    The relevance is also available as the search_rank attribute of each book; lower is better.
+    """
+    if queryset is None:
+        queryset = Book.objects.all()
+    expression = match_expression(text)
+    if expression is None:
+        return queryset.none()
+    tables = {'search': SEARCH_TABLE, 'book': Book._meta.db_table}
+    # Joined rather than looked up per book, so SQLite runs the full-text query once and ranks
+    # each match as it comes. The join is the plan SQLite makes of a derived table of (rowid,
+    # rank) too; extra() cannot put a derived table with parameters in the FROM clause. bm25()
+    # is only allowed while the query has no GROUP BY, so the queryset must not be annotated.
+    return queryset.extra(
+        select={'search_rank': RANK_SQL.format(**tables)},
+        select_params=[TITLE_WEIGHT, DESCRIPTION_WEIGHT],
+        tables=[SEARCH_TABLE],
+        where=[MATCH_SQL.format(**tables)],
+        params=[expression],
+        order_by=['search_rank', 'id'])
+
+
+def rebuild_search_index(chunk_size=DEFAULT_CHUNK_SIZE):
+    """Re-index every book, chunk_size books per transaction; return the number indexed
+
+    Imports can keep running meanwhile: each chunk only holds the write lock for as long as it
+    takes to re-index its own range of ids, and the triggers index whatever imports write.
+    """
+    sql = {'search': SEARCH_TABLE, 'book': Book._meta.db_table}
+    delete = 'DELETE FROM {search} WHERE rowid > %s AND rowid <= %s'.format(**sql)
+    insert = ('INSERT INTO {search} (rowid, title, description) '
+              'SELECT id, title, description FROM {book} WHERE id > %s AND id <= %s').format(**sql)
+    last_id = 0
+    num_indexed = 0
+    while True:
+        ids = list(Book.objects.filter(id__gt=last_id).order_by('id').values_list(
+            'id', flat=True)[:chunk_size])
+        if not ids:
+            break
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(delete, [last_id, ids[-1]])
+            cursor.execute(insert, [last_id, ids[-1]])
+        num_indexed += cursor.rowcount
+        last_id = ids[-1]
+        if len(ids) < chunk_size:
+            break
+    return num_indexed
@@ -0,0 +1,37 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+
+# What serialize_book reads from each book; prefetch it to serialize many books at once.
+BOOK_PREFETCH = ('aliases', 'conflicted_books__alias')
+
+
+def serialize_book(book):
+    """Return a book with its aliases and conflicts as plain, JSON-ready data
+
+    Conflicts name the other book and the alias the two share, not the other book's title, so a
+    book's data only changes when its own rows do.
+    """
+    return {
+        'id': book.id,
+        'title': book.title,
+        'description': book.description,
+        'version': book.version,
+        'cluster_id': book.cluster_id,
+        'last_modified': book.last_modified_time,
+        'aliases': sorted(
+            ({'scheme': alias.scheme, 'value': alias.value} for alias in book.aliases.all()),
+            key=lambda alias: (alias['scheme'], alias['value'])),
+        'conflicts': sorted(
+            ({'book_id': conflict.alias.book_id, 'scheme': conflict.alias.scheme,
+              'value': conflict.alias.value} for conflict in book.conflicted_books.all()),
+            key=lambda conflict: (conflict['book_id'], conflict['scheme'], conflict['value'])),
+    }
+
+
+def to_json(data):
+    """Encode data compactly on one line, dates as ISO 8601"""
+    return json.dumps(data, cls=DjangoJSONEncoder, separators=(',', ':'), sort_keys=True)
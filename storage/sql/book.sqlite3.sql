@@ -0,0 +1,12 @@
+-- Full-text index over Book title and description, read through storage.search. The rowid of
+-- each row is the book id; the triggers keep it in step with every write to storage_book,
+-- the importer's bulk inserts and raw updates included. Django runs each statement up to a
+-- line ending in a semicolon, so each trigger body is kept on its last line.
+CREATE VIRTUAL TABLE "storage_book_search" USING fts5(
+    "title", "description", tokenize = 'unicode61 remove_diacritics 2');
+CREATE TRIGGER "storage_book_search_insert" AFTER INSERT ON "storage_book" BEGIN
+    INSERT INTO "storage_book_search" ("rowid", "title", "description") VALUES (new."id", new."title", new."description"); END;
+CREATE TRIGGER "storage_book_search_update" AFTER UPDATE OF "title", "description" ON "storage_book" BEGIN
+    DELETE FROM "storage_book_search" WHERE "rowid" = old."id"; INSERT INTO "storage_book_search" ("rowid", "title", "description") VALUES (new."id", new."title", new."description"); END;
+CREATE TRIGGER "storage_book_search_delete" AFTER DELETE ON "storage_book" BEGIN
+    DELETE FROM "storage_book_search" WHERE "rowid" = old."id"; END;
@@ -0,0 +1,76 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Query budgets for tests: the most SQL queries an operation may run for an input size
+
+assertNumQueries pins an exact count, which breaks on every harmless change, and says nothing
+about how the count grows. A budget is an upper bound, checked at several input sizes, so that
+an operation whose queries start growing with the number of aliases or books fails the test.
+When it does, the queries it ran are listed grouped by statement, with their literals taken out,
+most repeated first.
+"""
+import ast
+import re
+from collections import Counter
+from contextlib import contextmanager
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+# How Django's debug cursor records a query on backends that do not interpolate its parameters,
+# SQLite among them.
+QUERY_PARAMS_RE = re.compile(r"""^QUERY = (u?'.*?'|u?".*?") - PARAMS = """, re.DOTALL)
+# Quoted strings and numbers that are not part of a name.
+LITERAL_RE = re.compile(r"'(?:[^']|'')*'|(?<![\w.])-?\d+(?:\.\d+)?(?![\w.])")
+# Lists of placeholders, as in IN (?, ?, ?) or multi-row VALUES.
+LIST_RE = re.compile(r'\(\?(?:, \?)*\)(?:, \(\?(?:, \?)*\))*')
+# Rows after the first of Django's bulk INSERT on SQLite: ... UNION ALL SELECT ?, ? ...
+UNION_RE = re.compile(r'(?: UNION ALL SELECT \?(?:, \?)*)+')
+# Names Django makes up for savepoints.
+SAVEPOINT_RE = re.compile(r'"s\d+_x\d+"')
+
+
+def normalize(sql):
+    """Return sql with its parameters, literals and savepoint names replaced by ?
+
+    Lists of placeholders become (...) and the rows of a bulk INSERT after the first one
+    UNION ALL ..., so the same statement over more rows reads the same.
+    """
+    match = QUERY_PARAMS_RE.match(sql)
+    if match:
+        sql = ast.literal_eval(match.group(1))
+    sql = LITERAL_RE.sub('?', SAVEPOINT_RE.sub('?', sql.replace('%s', '?')))
+    return UNION_RE.sub(' UNION ALL ...', LIST_RE.sub('(...)', sql))
+
+
+def group_queries(queries):
+    """Return (count, normalized SQL) pairs for the captured queries, most repeated first"""
+    counts = Counter(normalize(query['sql']) for query in queries)
+    return sorted(((count, sql) for sql, count in counts.items()),
+                  key=lambda pair: (-pair[0], pair[1]))
+
+
+def describe_queries(queries):
+    """Return the captured queries as text, one line per distinct statement"""
+    return '\n'.join('{:>5} x {}'.format(count, sql) for count, sql in group_queries(queries))
+
+
+class QueryBudgetMixin(object):
+    """TestCase mixin for assertQueryBudget"""
+
+    @contextmanager
+    def assertQueryBudget(self, budget, operation='The block'):
+        """Fail if the enclosed block runs more than budget queries, listing the ones it ran"""
+        with CaptureQueriesContext(connection) as context:
+            yield context
+        if len(context) > budget:
+            self.fail('{} ran {} queries, over its budget of {}:\n{}'.format(
+                operation, len(context), budget, describe_queries(context.captured_queries)))
+
+
+def query_plan(queryset):
+    """Return the lines of SQLite's EXPLAIN QUERY PLAN for queryset, as one string"""
+    sql, params = queryset.query.sql_with_params()
+    cursor = connection.cursor()
+    cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+    return '\n'.join(row[-1] for row in cursor.fetchall())
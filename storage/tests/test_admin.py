@@ -0,0 +1,154 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from storage.admin import BookAdmin
+from storage.models import Alias, Book, Conflict
+from storage.pagination import keyset_filter
+from storage.tests.querybudget import query_plan
+
+
+class TestBookAdmin(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        self.client.login(username='admin', password='admin')
+
+    def add_books(self, num):
+        """Add num books, each sharing an ISBN with the previous one and conflicting with it"""
+        previous = None
+        for n in range(num):
+            book = Book.objects.create(title='Book {:03}'.format(n))
+            Alias.objects.create(book=book, scheme='PUB_ID', value='pub-{}'.format(n))
+            alias = Alias.objects.create(book=book, scheme='ISBN-10', value=str(n))
+            if previous is not None:
+                shared = Alias.objects.create(book=book, scheme='ISBN-10', value=previous[1])
+                Conflict.objects.create(book=book, alias=previous[0])
+                Conflict.objects.create(book=previous[0].book, alias=shared)
+            previous = (alias, str(n))
+
+    def count_queries(self, url):
+        # The first request also fills per-process caches such as the content types.
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_storage_admin_changelist_constant_queries(self):
+        """The Book changelist should run as many queries for 50 rows as for 2"""
+        url = reverse('admin:storage_book_changelist')
+        self.add_books(2)
+        response, few = self.count_queries(url)
+        self.assertContains(response, 'Book 000: ISBN-10/0')
+
+        Book.objects.all().delete()
+        cache.clear()
+        self.add_books(50)
+        response, many = self.count_queries(url)
+        self.assertEqual(few, many)
+        self.assertContains(response, 'Book 023: ISBN-10/23')
+        self.assertContains(response, 'Book 025: ISBN-10/24')
+
+    def test_storage_admin_changelist_counts(self):
+        """The alias and conflict counts should come from the prefetched rows"""
+        self.add_books(3)
+        url = reverse('admin:storage_book_changelist')
+        response, num_queries = self.count_queries(url)
+        cl = response.context['cl']
+        self.assertEqual([book.title for book in cl.result_list],
+                         ['Book 000', 'Book 001', 'Book 002'])
+        model_admin = cl.model_admin
+        self.assertEqual([model_admin.num_aliases(book) for book in cl.result_list], [2, 3, 3])
+        self.assertEqual([model_admin.num_conflicts(book) for book in cl.result_list], [1, 2, 1])
+        self.assertNotIn('GROUP BY', str(cl.queryset.query))
+
+    def test_storage_admin_change_form_constant_queries(self):
+        """The change form should not query per conflict or alias inline"""
+        self.add_books(3)
+        book = Book.objects.get(title='Book 001')
+        url = reverse('admin:storage_book_change', args=[book.pk])
+        response, few = self.count_queries(url)
+        self.assertContains(response, 'Book 000')
+
+        for n in range(20):
+            other = Book.objects.create(title='Other {}'.format(n))
+            Conflict.objects.create(
+                book=book, alias=Alias.objects.create(book=other, scheme='ISBN-10', value='1'))
+            Alias.objects.create(book=book, scheme='Proprietary', value=str(n))
+        response, many = self.count_queries(url)
+        self.assertEqual(few, many)
+        self.assertContains(response, 'Other 19')
+
+    def test_storage_admin_changelist_keyset_pages(self):
+        """The changelist should page through every book by keyset, in title order"""
+        for n in range(7):
+            Book.objects.create(title='Same' if n % 2 else 'Title {}'.format(n % 3))
+        expected = list(Book.objects.order_by('title', 'id').values_list('id', flat=True))
+        url = reverse('admin:storage_book_changelist')
+        seen = []
+        BookAdmin.list_per_page = 3
+        try:
+            response = self.client.get(url)
+            while True:
+                cl = response.context['cl']
+                seen.extend(book.id for book in cl.result_list)
+                if not cl.next_page_url:
+                    break
+                self.assertContains(response, 'Next page')
+                response = self.client.get(url + cl.next_page_url)
+        finally:
+            BookAdmin.list_per_page = 100
+        self.assertEqual(seen, expected)
+        self.assertContains(response, 'First page')
+        self.assertEqual(cl.result_count, 7)
+
+        # An unknown or malformed row to continue after is a bad lookup, not an error.
+        for after in ('999', 'abc'):
+            response = self.client.get(url, {'after': after})
+            self.assertRedirects(response, url + '?e=1')
+
+    def test_storage_admin_changelist_keyset_plan(self):
+        """A keyset page should be read from the title index, without sorting the table"""
+        self.add_books(3)
+        book = Book.objects.get(title='Book 001')
+        url = reverse('admin:storage_book_changelist')
+        cl = self.client.get(url, {'after': book.pk}).context['cl']
+        self.assertEqual([row.title for row in cl.result_list], ['Book 002'])
+        ordering = cl.queryset.query.order_by
+        page = cl.queryset.filter(keyset_filter(ordering, [book.title, book.pk]))
+        plan = query_plan(page[:cl.list_per_page + 1])
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql LIKE %s",
+                       ['%"storage_book" ("title")'])
+        self.assertIn('USING INDEX {} (title>?)'.format(cursor.fetchone()[0]), plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+    def test_storage_admin_search_ranked(self):
+        """Searching should find the search words in titles and descriptions, best match first"""
+        Book.objects.create(title='Learning Perl', description='Not a Python book')
+        Book.objects.create(title='Python Cookbook')
+        Book.objects.create(title='Java in a Nutshell')
+        Book.objects.create(title='python in a nutshell')
+        url = reverse('admin:storage_book_changelist')
+        response = self.client.get(url, {'q': 'PYTHON '})
+        cl = response.context['cl']
+        self.assertEqual([book.title for book in cl.result_list][2:], ['Learning Perl'])
+        self.assertEqual((cl.result_count, cl.full_result_count), (3, 4))
+        self.assertFalse(cl.keyset)
+
+        response = self.client.get(url, {'q': 'nutshell pyth'})
+        self.assertEqual([book.title for book in response.context['cl'].result_list],
+                         ['python in a nutshell'])
+
+        # Text without a word to search for matches nothing.
+        for query in ('"', '-'):
+            response = self.client.get(url, {'q': query})
+            self.assertEqual(list(response.context['cl'].result_list), [])
@@ -0,0 +1,59 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import glob
+
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TransactionTestCase
+
+from storage import bulkload
+from storage.models import Book
+from storage.tests.test_commands import run_command
+
+
+def index_names():
+    cursor = connection.cursor()
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL")
+    return sorted(row[0] for row in cursor.fetchall())
+
+
+class TestBulkLoad(TransactionTestCase):
+
+    def test_storage_bulkload_restores_settings(self):
+        """bulk_load should change the settings while it lasts and restore them after an error"""
+        cache_size = bulkload.pragma('cache_size')
+        with self.assertRaises(RuntimeError):
+            with bulkload.bulk_load():
+                self.assertEqual(bulkload.pragma('cache_size'), -256 * 1024)
+                self.assertEqual(bulkload.pragma('synchronous'), 1)
+                raise RuntimeError
+        self.assertEqual(bulkload.pragma('cache_size'), cache_size)
+        self.assertEqual(bulkload.pragma('synchronous'), 2)
+
+    def test_storage_bulkload_drop_indexes(self):
+        """bulk_load should build the dropped indexes again, however the load ends"""
+        indexes = index_names()
+        with self.assertRaises(RuntimeError):
+            with bulkload.bulk_load(drop_indexes=True):
+                self.assertEqual(len(indexes) - len(index_names()), 5)
+                Book.objects.create(title='Title')
+                raise RuntimeError
+        self.assertEqual(index_names(), indexes)
+
+        with self.assertRaises(ValueError):
+            with bulkload.bulk_load(drop_indexes=True):
+                pass
+        self.assertEqual(index_names(), indexes)
+
+    def test_storage_bulkload_process_data_file(self):
+        """process_data_file --drop-indexes should store what a normal import does"""
+        files = sorted(glob.glob('data/initial/*.xml'))
+        normal = run_command('process_data_file', *files)
+        titles = sorted(Book.objects.values_list('title', flat=True))
+        Book.objects.all().delete()
+        bulk = run_command('process_data_file', *files, drop_indexes=True, force=True)
+        self.assertEqual(bulk.split('\nAlias index')[0], normal)
+        self.assertEqual(sorted(Book.objects.values_list('title', flat=True)), titles)
+        with self.assertRaises(CommandError):
+            run_command('process_data_file', *files, drop_indexes=True, force=True)
@@ -0,0 +1,112 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from django.test import TestCase
+
+from storage import caching, clusters, scanner, tools
+from storage.models import Alias, Book, Conflict
+
+
+def record(publisher_id, title, *aliases):
+    return {
+        'publisher_id': publisher_id, 'title': title, 'description': '',
+        'aliases': [{'scheme': 'PUB_ID', 'value': publisher_id}] + [
+            {'scheme': scheme, 'value': value} for scheme, value in aliases]}
+
+
+class TestCaching(TestCase):
+
+    def setUp(self):
+        caching.backend().clear()
+        self.book = Book.objects.create(title='Cached')
+        self.alias = Alias.objects.create(book=self.book, scheme='ISBN-10', value='1')
+
+    def test_storage_caching_book(self):
+        """get_book should be served from the cache until the book or its rows change"""
+        before = caching.stats()
+        self.assertEqual(caching.get_book(self.book.pk)['title'], 'Cached')
+        with self.assertNumQueries(0):
+            self.assertEqual(caching.get_book(self.book.pk)['title'], 'Cached')
+        after = caching.stats()
+        self.assertEqual((after['hits'] - before['hits'], after['misses'] - before['misses']),
+                         (1, 1))
+
+        self.book.title = 'Renamed'
+        self.book.save()
+        self.assertEqual(caching.get_book(self.book.pk)['title'], 'Renamed')
+
+        other = Book.objects.create(title='Other')
+        shared = Alias.objects.create(book=other, scheme='ISBN-10', value='1')
+        Conflict.objects.create(book=self.book, alias=shared)
+        self.assertEqual(len(caching.get_book(self.book.pk)['conflicts']), 1)
+
+        # Editing the alias another book conflicts with changes that book's data too.
+        shared.value = '2'
+        shared.save()
+        self.assertEqual(caching.get_book(self.book.pk)['conflicts'][0]['value'], '2')
+
+        other.delete()
+        self.assertEqual(caching.get_book(self.book.pk)['conflicts'], [])
+        self.assertEqual(caching.get_book(other.pk), None)
+
+    def test_storage_caching_resolve(self):
+        """resolve should cache lookups, unknown identifiers included, until aliases change"""
+        self.assertEqual(caching.resolve('ISBN-10', '1'), [self.book.pk])
+        self.assertEqual(caching.resolve('ISBN-10', '2'), [])
+        with self.assertNumQueries(0):
+            self.assertEqual(caching.resolve_many([('ISBN-10', '1'), ('ISBN-10', '2')]),
+                             {('ISBN-10', '1'): [self.book.pk], ('ISBN-10', '2'): []})
+        # A number is not the identifier spelled with its digits, so it must not share a key.
+        self.assertRaises(TypeError, caching.resolve_many, [('ISBN-10', 1)])
+        self.assertEqual(caching.resolve_many([(b'ISBN-10', u'1')]),
+                         {(b'ISBN-10', u'1'): [self.book.pk]})
+
+        evictions = caching.stats()['evictions']
+        self.alias.value = '2'
+        self.alias.save()
+        self.assertTrue(caching.stats()['evictions'] > evictions)
+        self.assertEqual(caching.resolve('ISBN-10', '1'), [])
+        self.assertEqual(caching.resolve('ISBN-10', '2'), [self.book.pk])
+
+        # The value it held is known from when the row was loaded or last saved.
+        with self.assertNumQueries(1):
+            self.alias.save()
+        alias = Alias.objects.get(pk=self.alias.pk)
+        alias.value = '3'
+        with self.assertNumQueries(2):
+            alias.save()
+        self.assertEqual(caching.resolve('ISBN-10', '2'), [])
+        self.assertEqual(caching.resolve('ISBN-10', '3'), [self.book.pk])
+        alias.value = '2'
+        alias.save()
+        self.assertEqual(caching.resolve('ISBN-10', '3'), [])
+
+        self.alias.delete()
+        self.assertEqual(caching.resolve('ISBN-10', '2'), [])
+
+    def test_storage_caching_import_paths(self):
+        """Both import paths should invalidate what they change, bulk inserts included"""
+        self.assertEqual(caching.resolve('ISBN-10', '1'), [self.book.pk])
+        self.assertEqual(caching.resolve('ISBN-13', '9'), [])
+        self.assertEqual(caching.get_book(self.book.pk)['conflicts'], [])
+
+        results = tools.store_books_with_conflicts([
+            record('A', 'Batch', ('ISBN-10', '1'), ('ISBN-13', '9'))])
+        batch = results[0][0]
+        self.assertEqual(caching.resolve('ISBN-10', '1'), [self.book.pk, batch.pk])
+        self.assertEqual(caching.resolve('ISBN-13', '9'), [batch.pk])
+        self.assertEqual(caching.get_book(batch.pk)['cluster_id'], self.book.pk)
+
+        # A conflict found by the scanner for the first book, and its new cluster.
+        scanner.scan_conflicts()
+        self.assertEqual(len(caching.get_book(self.book.pk)['conflicts']), 1)
+        self.assertEqual(caching.get_book(self.book.pk)['cluster_id'], self.book.pk)
+
+        book, update_type, num_conflicts = tools.store_book_with_conflicts(
+            record('A', 'Serial', ('ISBN-10', '1'), ('ISBN-13', '9'), ('ISBN-13', '10')))
+        self.assertEqual(caching.get_book(batch.pk)['title'], 'Serial')
+        self.assertEqual(caching.resolve('ISBN-13', '10'), [batch.pk])
+
+        self.alias.delete()
+        clusters.rebuild_clusters()
+        self.assertEqual(caching.get_book(batch.pk)['cluster_id'], None)
@@ -0,0 +1,98 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.core.management import call_command
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils import timezone
+
+from storage import changes
+from storage.models import Alias, Book
+
+
+class TestChangeFeed(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.books = [Book.objects.create(title='Book {}'.format(n)) for n in range(5)]
+        for book in self.books:
+            Alias.objects.create(book=book, scheme='PUB_ID', value=str(book.pk))
+        # Two books share a modification time, so the id has to break the tie.
+        times = [3, 1, 1, 0, 2]
+        for book, minutes in zip(self.books, times):
+            Book.objects.filter(pk=book.pk).update(
+                last_modified_time=self.now - timedelta(minutes=10 - minutes))
+        self.order = [self.books[n].pk for n in (3, 1, 2, 4, 0)]
+
+    def test_storage_changes_cursor_round_trip(self):
+        """A cursor should decode to the modification time and id it was made from"""
+        book = Book.objects.get(pk=self.books[1].pk)
+        self.assertEqual(changes.decode_cursor(changes.encode_cursor(book)),
+                         (book.last_modified_time, book.pk))
+        for bad in ('nope', '', u'caf\xe9', 'MjAxNC0wMS0wMQ=='):
+            with self.assertRaises(ValueError):
+                changes.decode_cursor(bad)
+
+    def test_storage_changes_pages(self):
+        """Pages should walk the changes oldest first and pick up later changes from the cursor"""
+        seen = []
+        # Each page: books, their aliases, their conflicts (whose aliases there are none of).
+        with self.assertNumQueries(9):
+            for books, cursor in changes.iter_changes(page_size=2):
+                seen.extend(book.pk for book in books)
+                self.assertTrue(all(book.aliases.all() for book in books))
+        self.assertEqual(seen, self.order)
+
+        self.assertEqual(changes.changes_page(cursor), ([], cursor))
+        book = self.books[3]
+        book.title = 'Changed'
+        book.save()
+        # A change as recent as an import transaction that may still be open waits its turn.
+        self.assertEqual(changes.changes_page(cursor), ([], cursor))
+        Book.objects.filter(pk=book.pk).update(
+            last_modified_time=timezone.now() - changes.SAFETY_WINDOW)
+        books, cursor = changes.changes_page(cursor)
+        self.assertEqual([b.title for b in books], ['Changed'])
+
+    def test_storage_changes_endpoint(self):
+        """The change feed endpoint should page through JSON lines with X-Next-Cursor"""
+        url = reverse('api_changes')
+        response = self.client.get(url, {'limit': 3})
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.content.splitlines()]
+        self.assertEqual([line['id'] for line in lines], self.order[:3])
+        self.assertEqual(lines[0]['aliases'], [{'scheme': 'PUB_ID', 'value': str(self.order[0])}])
+
+        response = self.client.get(url, {'limit': 3, 'cursor': response['X-Next-Cursor']})
+        lines = [json.loads(line) for line in response.content.splitlines()]
+        self.assertEqual([line['id'] for line in lines], self.order[3:])
+        cursor = response['X-Next-Cursor']
+        response = self.client.get(url, {'cursor': cursor})
+        self.assertEqual((response.content, response['X-Next-Cursor']), (b'', cursor))
+
+        self.assertEqual(self.client.get(url, {'cursor': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(url, {'limit': 0}).status_code, 400)
+
+    def test_storage_changes_command(self):
+        """change_feed should write JSON lines and keep its place in the cursor file"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        output = os.path.join(tmpdir, 'changes.jsonl')
+        cursor_file = os.path.join(tmpdir, 'cursor')
+
+        call_command('change_feed', output=output, cursor_file=cursor_file, page_size=2)
+        with open(output) as fh:
+            self.assertEqual([json.loads(line)['id'] for line in fh], self.order)
+
+        new = Book.objects.create(title='New')
+        Book.objects.filter(pk=new.pk).update(
+            last_modified_time=timezone.now() - changes.SAFETY_WINDOW)
+        call_command('change_feed', output=output, cursor_file=cursor_file)
+        with open(output) as fh:
+            self.assertEqual([json.loads(line)['title'] for line in fh], ['New'])
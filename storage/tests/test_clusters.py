@@ -0,0 +1,104 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from django.test import SimpleTestCase, TestCase
+
+from storage import clusters, tools
+from storage.models import Book
+
+
+class TestUnionFind(SimpleTestCase):
+
+    def test_storage_clusters_union_find(self):
+        """UnionFind should join sets and root each at its smallest member"""
+        sets = clusters.UnionFind(10)
+        sets.union(5, 7)
+        sets.union(7, 3)
+        sets.union(8, 9)
+        self.assertEqual([sets.find(x) for x in (3, 5, 7, 8, 9, 4)], [3, 3, 3, 8, 8, 4])
+        sets.union(9, 5)
+        self.assertEqual(set(sets.find(x) for x in (3, 5, 7, 8, 9)), set([3]))
+
+
+class TestClusters(TestCase):
+
+    def setUp(self):
+        self.a, self.b, self.c, self.d = [
+            Book.objects.create(title=title) for title in ('A', 'B', 'C', 'D')]
+        self.a.aliases.create(scheme='ISBN-10', value='1')
+        self.b.aliases.create(scheme='ISBN-10', value='1')
+        self.b.aliases.create(scheme='Proprietary', value='X')
+        self.c.aliases.create(scheme='Proprietary', value='X')
+        self.d.aliases.create(scheme='ISBN-13', value='1')
+
+    def cluster_ids(self):
+        return dict(Book.objects.values_list('title', 'cluster_id'))
+
+    def test_storage_clusters_rebuild(self):
+        """rebuild_clusters should cluster books linked through any chain of shared aliases"""
+        self.assertEqual(clusters.rebuild_clusters(chunk_size=2), (1, 3))
+        self.assertEqual(self.cluster_ids(),
+                         {'A': self.a.id, 'B': self.a.id, 'C': self.a.id, 'D': None})
+        # The books that changed cluster count as modified; the others do not.
+        modified = dict(Book.objects.values_list('title', 'last_modified_time'))
+        self.assertTrue(modified['A'] > self.d.last_modified_time)
+        self.assertEqual(modified['D'], self.d.last_modified_time)
+        self.assertEqual(clusters.rebuild_clusters(), (1, 0))
+
+        self.b.aliases.filter(scheme='ISBN-10').delete()
+        self.assertEqual(clusters.rebuild_clusters(), (1, 3))
+        self.assertEqual(self.cluster_ids(),
+                         {'A': None, 'B': self.b.id, 'C': self.b.id, 'D': None})
+
+    def test_storage_clusters_rebuild_during_import(self):
+        """Books created while rebuild_clusters runs should be left for the next rebuild"""
+        test = self
+
+        class ImportingUnionFind(clusters.UnionFind):
+            # Created once max_id has been read, as a concurrent import would.
+            def __init__(self, size):
+                super(ImportingUnionFind, self).__init__(size)
+                test.e = Book.objects.create(title='E')
+                test.e.aliases.create(scheme='ISBN-13', value='2')
+                test.d.aliases.create(scheme='ISBN-13', value='2')
+
+        union_find = clusters.UnionFind
+        self.addCleanup(setattr, clusters, 'UnionFind', union_find)
+        clusters.UnionFind = ImportingUnionFind
+        self.assertEqual(clusters.rebuild_clusters(), (1, 3))
+        self.assertEqual(self.cluster_ids()['E'], None)
+
+        clusters.UnionFind = union_find
+        self.assertEqual(clusters.rebuild_clusters(), (2, 2))
+        self.assertEqual(self.cluster_ids()['E'], self.d.id)
+
+    def test_storage_clusters_follow_imports(self):
+        """Importing books that share aliases should merge their clusters as it goes"""
+        clusters.rebuild_clusters()
+        incoming = {
+            'publisher_id': 'E', 'title': 'E', 'description': '',
+            'aliases': [{'scheme': 'PUB_ID', 'value': 'E'}, {'scheme': 'ISBN-13', 'value': '1'}]}
+        tools.store_book_with_conflicts(incoming)
+        e = Book.objects.get(title='E')
+        self.assertEqual(self.cluster_ids()['D'], self.d.id)
+        self.assertEqual(self.cluster_ids()['E'], self.d.id)
+
+        incoming = {
+            'publisher_id': 'F', 'title': 'F', 'description': '',
+            'aliases': [{'scheme': 'ISBN-10', 'value': '1'}, {'scheme': 'ISBN-13', 'value': '1'}]}
+        tools.store_books_with_conflicts([incoming])
+        self.assertEqual(set(self.cluster_ids().values()), set([self.a.id]))
+        self.assertEqual(Book.objects.get(pk=e.pk).cluster_id, self.a.id)
+
+    def test_storage_clusters_merge_in_chunks(self):
+        """merge_clusters should read and update a large cluster MAX_QUERY_PARAMS ids at a time"""
+        self.addCleanup(setattr, tools, 'MAX_QUERY_PARAMS', tools.MAX_QUERY_PARAMS)
+        tools.MAX_QUERY_PARAMS = 2
+        members = [Book.objects.create(title='Member {}'.format(n)) for n in range(5)]
+        Book.objects.filter(pk__in=[book.pk for book in members]).update(
+            cluster_id=members[0].pk)
+        book = Book.objects.create(title='New')
+        # The two ids' clusters, that cluster's members, then three updates of two ids or less.
+        with self.assertNumQueries(5):
+            clusters.merge_clusters([[book.pk, members[-1].pk]])
+        self.assertEqual(Book.objects.get(pk=book.pk).cluster_id, members[0].pk)
@@ -0,0 +1,208 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import glob
+import os
+import shutil
+import sys
+import tempfile
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.db import OperationalError
+from django.test import TransactionTestCase
+
+from storage import deadletter, feeds, manifest, tools
+from storage.models import Alias, Book, Conflict, FailedRecord, ImportedFile
+
+
+def run_command(*args, **options):
+    """Call a management command and return what it printed"""
+    stdout, sys.stdout = sys.stdout, StringIO()
+    try:
+        call_command(*args, **options)
+        return sys.stdout.getvalue()
+    finally:
+        sys.stdout = stdout
+
+
+class TestProcessDataFile(TransactionTestCase):
+
+    files = sorted(glob.glob('data/initial/*.xml')) + sorted(glob.glob('data/update/*.xml'))
+
+    def snapshot(self):
+        return (sorted(Book.objects.values_list('title', flat=True)),
+                Alias.objects.count(), Conflict.objects.count())
+
+    def test_process_data_file_output(self):
+        """process_data_file should report each book and list the files it skipped"""
+        output = run_command('process_data_file', *self.files)
+        self.assertIn('... Created "this is the first book, second edition"\n'
+                      '... with 2 conflicts.\n', output)
+        self.assertIn('    data/update/update-1bad.xml : No data in title element\n', output)
+        self.assertEqual(Book.objects.count(), 5)
+
+    def test_process_data_file_workers_match_serial(self):
+        """process_data_file --workers should print and store exactly what a serial run does"""
+        serial = run_command('process_data_file', *self.files, batch_size=2)
+        stored = self.snapshot()
+        Book.objects.all().delete()
+        parallel = run_command('process_data_file', *self.files, batch_size=2, workers=3,
+                               force=True)
+        self.assertEqual(parallel, serial)
+        self.assertEqual(self.snapshot(), stored)
+
+    def test_process_data_file_workers_split_files(self):
+        """process_data_file --workers should split a large feed into chunks across workers"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        catalog = os.path.join(tmpdir, 'catalog.xml')
+        with open(catalog, 'wb') as fh:
+            fh.write(b'<catalog>')
+            for n in range(1, 8):
+                fh.write('<book id="{0}"><title>Book {0}</title><aliases><alias scheme="ISBN-10" '
+                         'value="{1}"/></aliases></book>'.format(n, n // 2).encode())
+            fh.write(b'<book id="8"><title></title></book></catalog>')
+        # A book that does not parse ends its file, whichever process finds it.
+        broken = os.path.join(tmpdir, 'broken.xml')
+        with open(broken, 'wb') as fh:
+            fh.write(b'<catalog><book id="9"><title>Book 9</title></book>\n'
+                     b'<book id="10"><title>Book 10</titel></book>\n'
+                     b'<book id="11"><title>Book 11</title></book></catalog>')
+        serial = run_command('process_data_file', catalog, broken, *self.files)
+        stored = self.snapshot()
+        Book.objects.all().delete()
+        self.addCleanup(setattr, feeds, 'WORKER_CHUNK_SIZE', feeds.WORKER_CHUNK_SIZE)
+        feeds.WORKER_CHUNK_SIZE = 2
+        parallel = run_command('process_data_file', catalog, broken, *self.files, workers=2,
+                               force=True)
+        self.assertEqual(parallel, serial)
+        self.assertIn('titel', parallel)
+        self.assertEqual(self.snapshot(), stored)
+
+
+class TestImportManifest(TransactionTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.catalog = os.path.join(self.tmpdir, 'catalog.xml')
+        with open(self.catalog, 'wb') as fh:
+            fh.write(b'<catalog>')
+            for n in range(1, 4):
+                fh.write('<book id="{0}"><title>Book {0}</title></book>'.format(n).encode())
+            fh.write(b'</catalog>')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_process_data_file_skips_imported_files(self):
+        """process_data_file should skip files the manifest lists as imported, unless forced"""
+        run_command('process_data_file', self.catalog)
+        entry = ImportedFile.objects.get()
+        self.assertEqual((entry.status, entry.books_committed, entry.num_errors),
+                         (ImportedFile.DONE, 3, 0))
+        self.assertEqual(entry.content_hash, manifest.content_hash(self.catalog))
+
+        output = run_command('process_data_file', self.catalog)
+        self.assertIn('Skipping {}, already imported.'.format(self.catalog), output)
+        self.assertNotIn('Importing', output)
+
+        output = run_command('process_data_file', self.catalog, force=True)
+        self.assertIn('... Unchanged "Book 1"', output)
+        self.assertEqual(ImportedFile.objects.count(), 2)
+
+    def test_process_data_file_resumes_interrupted_import(self):
+        """process_data_file should resume after the books an interrupted run committed"""
+        entry, skip = manifest.start(self.catalog)
+        manifest.record_progress(entry, 2, 0)
+
+        output = run_command('process_data_file', self.catalog, batch_size=1)
+        self.assertIn('Resuming {} after 2 books.'.format(self.catalog), output)
+        self.assertEqual(list(Book.objects.values_list('title', flat=True)), ['Book 3'])
+        entry = ImportedFile.objects.get()
+        self.assertEqual((entry.status, entry.books_committed), (ImportedFile.DONE, 3))
+
+    def test_process_data_file_records_failed_files(self):
+        """process_data_file should record files it could not read to the end as failed"""
+        run_command('process_data_file', 'data/update/update-2bad.xml')
+        entry = ImportedFile.objects.get()
+        self.assertEqual((entry.status, entry.num_errors), (ImportedFile.FAILED, 1))
+        self.assertIn('error parsing attribute name', entry.message)
+
+
+class TestDeadLetters(TransactionTestCase):
+
+    def test_process_data_file_dead_letters_failures(self):
+        """process_data_file should keep every failure with its stage and raw XML"""
+        run_command('process_data_file', 'data/update/update-1bad.xml',
+                    'data/update/update-2bad.xml')
+        extract, parse = FailedRecord.objects.order_by('id')
+        self.assertEqual((extract.source, extract.stage, extract.exception, extract.message),
+                         ('data/update/update-1bad.xml', FailedRecord.EXTRACT, 'ValueError',
+                          'No data in title element'))
+        self.assertIn('<alias scheme="Proprietary" value="12345ABC"/>', extract.raw_xml)
+        self.assertEqual((parse.stage, parse.exception, parse.raw_xml),
+                         (FailedRecord.PARSE, 'XMLSyntaxError', ''))
+
+    def test_process_data_file_dead_letters_store_failures(self):
+        """process_data_file should dead-letter records the database rejected"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, 'long.xml')
+            with open(filename, 'wb') as fh:
+                fh.write('<book id="1"><title>{}</title></book>'.format('X' * 200).encode())
+            run_command('process_data_file', filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        failure = FailedRecord.objects.get()
+        self.assertEqual((failure.stage, failure.exception),
+                         (FailedRecord.STORE, 'ValidationError'))
+        self.assertTrue(failure.message.startswith('title: Ensure this value has at most 128'))
+
+    def test_replay_failures(self):
+        """replay_failures should import fixed records and keep the ones still failing"""
+        deadletter.record_failure(
+            'feed.xml #1', FailedRecord.STORE, ValueError('Title too long'),
+            u'<book id="1"><title>Fixed</title></book>')
+        deadletter.record_failure(
+            'feed.xml #2', FailedRecord.EXTRACT, ValueError('No data in title element'),
+            u'<book id="2"><description>Still no title</description></book>')
+        deadletter.record_failure('other.xml', FailedRecord.PARSE, ValueError('Broken'))
+
+        output = run_command('replay_failures', batch_size=1)
+        self.assertIn('... Created "Fixed" from feed.xml #1', output)
+        self.assertIn('Replayed 2 records: 1 imported, 1 still failing.', output)
+        self.assertIn('1 failure happened before a <book> could be read', output)
+        self.assertEqual(Book.objects.get().title, 'Fixed')
+        fixed, still_failing = FailedRecord.objects.filter(raw_xml__gt='').order_by('id')
+        self.assertIsNotNone(fixed.resolved_time)
+        self.assertIsNone(still_failing.resolved_time)
+        self.assertEqual(still_failing.attempts, 2)
+
+        output = run_command('replay_failures')
+        self.assertIn('Replayed 1 record: 0 imported, 1 still failing.', output)
+
+    def test_replay_failures_locked(self):
+        """replay_failures should replay a batch again while the database is locked"""
+        for n in range(5):
+            deadletter.record_failure(
+                'feed.xml #{}'.format(n), FailedRecord.STORE, ValueError('Title too long'),
+                u'<book id="{0}"><title>Book {0}</title></book>'.format(n))
+        store = tools.store_books_with_conflicts
+        calls = []
+
+        def locked_once(incomings):
+            calls.append(len(incomings))
+            if len(calls) == 1:
+                raise OperationalError('database is locked')
+            return store(incomings)
+        for name, value in (('store_books_with_conflicts', locked_once), ('LOCKED_BACKOFF', 0),
+                            ('MAX_QUERY_PARAMS', 2)):
+            self.addCleanup(setattr, tools, name, getattr(tools, name))
+            setattr(tools, name, value)
+
+        output = run_command('replay_failures')
+        self.assertEqual(calls, [5, 5])
+        self.assertEqual(output.count('... Created'), 5)
+        self.assertIn('Replayed 5 records: 5 imported, 0 still failing.', output)
+        self.assertFalse(FailedRecord.objects.filter(resolved_time=None).exists())
@@ -0,0 +1,115 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import glob
+import gzip
+import json
+import os
+import shutil
+import tempfile
+from io import BytesIO
+
+from django.core.management import call_command
+from django.test import TestCase, TransactionTestCase
+
+from storage import export, tools
+from storage.models import Alias, Book, Conflict
+from storage.tests.test_commands import run_command
+
+
+def catalog():
+    """Every book as (title, description, aliases), in title order"""
+    return [(book.title, book.description or '',
+             sorted((alias.scheme, alias.value) for alias in book.aliases.all()))
+            for book in Book.objects.order_by('title', 'id').prefetch_related('aliases')]
+
+
+class TestExport(TestCase):
+
+    def setUp(self):
+        self.book = Book.objects.create(title=u'Un Título', description='Both <&> kinds')
+        Alias.objects.create(book=self.book, scheme='PUB_ID', value='9')
+        Alias.objects.create(book=self.book, scheme='PUB_ID', value='10')
+        Alias.objects.create(book=self.book, scheme='ISBN-10', value='1')
+        self.other = Book.objects.create(title='No publisher id')
+        shared = Alias.objects.create(book=self.other, scheme='ISBN-10', value='1')
+        Conflict.objects.create(book=self.book, alias=shared)
+
+    def test_storage_export_jsonl(self):
+        """The JSONL export should hold every book with its aliases and conflicts"""
+        fh = BytesIO()
+        with self.assertNumQueries(2 * 4):
+            self.assertEqual(export.export_catalog(fh, 'jsonl', chunk_size=1), (2, 0))
+        books = [json.loads(line) for line in fh.getvalue().splitlines()]
+        self.assertEqual([book['title'] for book in books], [u'Un Título', 'No publisher id'])
+        self.assertEqual(books[0]['conflicts'],
+                         [{'book_id': self.other.pk, 'scheme': 'ISBN-10', 'value': '1'}])
+
+    def test_storage_export_xml(self):
+        """The XML export should give each book the shape extract_book_data reads"""
+        fh = BytesIO()
+        self.assertEqual(export.export_catalog(fh, 'xml'), (1, 1))
+        self.assertEqual(fh.getvalue().decode('utf-8'), u"""<?xml version='1.0' encoding='utf-8'?>
+<catalog><book id="10">
+  <title>Un Título</title>
+  <description>Both &lt;&amp;&gt; kinds</description>
+  <aliases>
+    <alias scheme="ISBN-10" value="1"/>
+    <alias scheme="PUB_ID" value="9"/>
+  </aliases>
+</book>
+</catalog>""")
+
+
+class TestExportCommand(TransactionTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmpdir)
+
+    def test_storage_export_round_trip(self):
+        """Importing an XML export should leave a database as it was, or rebuild it elsewhere"""
+        run_command('process_data_file', *sorted(glob.glob('data/initial/*.xml')))
+        run_command('process_data_file', 'data/update/update-1.xml', 'data/update/update-2.xml')
+        before = catalog()
+        filename = os.path.join(self.tmpdir, 'catalog.xml.gz')
+        call_command('export_catalog', format='xml', output=filename, gzip=True)
+
+        # The export carries each book's version, so importing it again changes nothing.
+        output = run_command('process_data_file', filename)
+        self.assertNotIn('Created', output)
+        self.assertEqual(catalog(), before)
+        output = run_command('process_data_file', filename, force=True)
+        self.assertEqual(output.count('... Skipped (stale)'), len(before))
+
+        Book.objects.all().delete()
+        run_command('process_data_file', filename, force=True)
+        self.assertEqual(catalog(), before)
+
+    def test_storage_export_round_trip_shared_publisher_id(self):
+        """A book holding another book's PUB_ID should be exported under its own id"""
+        tools.store_books_with_conflicts([
+            {'publisher_id': '1', 'title': 'First', 'description': '',
+             'aliases': [{'scheme': 'PUB_ID', 'value': '1'}]},
+            {'publisher_id': '5', 'title': 'Fifth', 'description': '',
+             'aliases': [{'scheme': 'PUB_ID', 'value': '5'}, {'scheme': 'PUB_ID', 'value': '1'}]},
+        ])
+        before = catalog()
+        filename = os.path.join(self.tmpdir, 'catalog.xml')
+        call_command('export_catalog', format='xml', output=filename)
+        with open(filename) as fh:
+            self.assertIn('<book id="5">', fh.read())
+
+        Book.objects.all().delete()
+        run_command('process_data_file', filename)
+        self.assertEqual(catalog(), before)
+        self.assertEqual(dict(Book.objects.values_list('title', 'publisher_id')),
+                         {'First': '1', 'Fifth': '5'})
+
+    def test_storage_export_command_jsonl(self):
+        """export_catalog should write gzip-compressed JSONL"""
+        Book.objects.create(title='Alone')
+        filename = os.path.join(self.tmpdir, 'catalog.jsonl.gz')
+        call_command('export_catalog', output=filename, gzip=True, chunk_size=1)
+        with gzip.open(filename) as fh:
+            self.assertEqual([json.loads(line)['title'] for line in fh], ['Alone'])
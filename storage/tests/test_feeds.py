@@ -0,0 +1,174 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import bz2
+import gzip
+import os
+import pickle
+import shutil
+import tarfile
+import tempfile
+import zipfile
+from io import BytesIO
+
+from django.test import SimpleTestCase
+from lxml import etree
+
+from storage import feeds, tools
+
+
+CATALOG = b"""<?xml version="1.0" encoding="utf-8"?>
+<catalog>
+    <book id="1"><title>First</title></book>
+    <book id="2"><title>Second</title></book>
+    <book id="3"><title>Third</title></book>
+</catalog>
+"""
+
+
+class TestIterBookElements(SimpleTestCase):
+
+    def test_storage_feeds_iter_book_elements_catalog(self):
+        """iter_book_elements should yield every <book> of a multi-book file"""
+        titles = [tools.extract_book_data(e).title
+                  for e in feeds.iter_book_elements(BytesIO(CATALOG))]
+        self.assertEqual(titles, ['First', 'Second', 'Third'])
+
+    def test_storage_feeds_iter_book_elements_single_book(self):
+        """iter_book_elements should yield the root of a single-book file"""
+        elements = feeds.iter_book_elements(BytesIO(b'<book id="1"><title>Only</title></book>'))
+        self.assertEqual([e.get('id') for e in elements], ['1'])
+
+    def test_storage_feeds_iter_book_elements_frees_earlier_books(self):
+        """iter_book_elements should drop books from the tree once the caller moves on"""
+        for element in feeds.iter_book_elements(BytesIO(CATALOG)):
+            earlier = list(element.itersiblings(preceding=True))
+            self.assertLessEqual(len(earlier), 1)
+            self.assertTrue(all(len(e) == 0 for e in earlier))
+
+
+class TestIterBookFragments(SimpleTestCase):
+
+    def fragments(self, xml, block_size=7):
+        return [(is_root, etree.tostring(etree.fromstring(fragment)))
+                for is_root, fragment in feeds.iter_book_fragments(BytesIO(xml), block_size)]
+
+    def test_storage_feeds_iter_book_fragments_match_elements(self):
+        """iter_book_fragments should split out the books iter_book_elements parses"""
+        tricky = (b'<!DOCTYPE catalog [<!ENTITY ed "2nd &amp; last">]>\n<catalog>'
+                  b'<!-- <book id="0"> --><book id="1" note="a>b"><title>&ed;</title>'
+                  b'<![CDATA[</book>]]></book><shelf><book id="2"/></shelf></catalog>')
+        single = b'<book id="1"><title>Only</title></book>'
+        for xml in (CATALOG, tricky, single, CATALOG.replace(b'utf-8', b'utf-16').decode(
+                'utf-8').encode('utf-16')):
+            self.assertEqual(
+                self.fragments(xml),
+                [(element.getparent() is None, etree.tostring(element, with_tail=False))
+                 for element in feeds.iter_book_elements(BytesIO(xml))])
+
+    def test_storage_feeds_iter_book_fragments_errors(self):
+        """iter_book_fragments should stop where what lies between books is not well-formed"""
+        fragments = feeds.iter_book_fragments(
+            BytesIO(b'<catalog><book id="1"/>junk<&<book id="2"/></catalog>'))
+        self.assertEqual(next(fragments), (False, b'<book id="1"/>'))
+        self.assertRaises(etree.XMLSyntaxError, next, fragments)
+        # A broken book is left for its parser to find.
+        for xml, fragment in ((b'<book id="1"><title>T</book>', b'<book id="1"><title>T</book>'),
+                              (b'<c><book id="1">T', b'<book id="1">T')):
+            self.assertEqual([fragment for is_root, fragment in feeds.iter_book_fragments(
+                BytesIO(xml), block_size=3)], [fragment])
+
+
+class TestOpenFeed(SimpleTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def read_all(self, filename):
+        return [(source, fh.read()) for source, fh in feeds.open_feed(filename)]
+
+    def test_storage_feeds_open_feed_plain_and_compressed(self):
+        """open_feed should read plain, gzip and bz2 files as one stream"""
+        with open(self.path('plain.xml'), 'wb') as fh:
+            fh.write(CATALOG)
+        with gzip.GzipFile(self.path('feed.xml.gz'), 'wb') as fh:
+            fh.write(CATALOG)
+        with bz2.BZ2File(self.path('feed.xml.bz2'), 'wb') as fh:
+            fh.write(CATALOG)
+        for name in ('plain.xml', 'feed.xml.gz', 'feed.xml.bz2'):
+            self.assertEqual(self.read_all(self.path(name)), [(self.path(name), CATALOG)])
+
+    def test_storage_feeds_open_feed_archives(self):
+        """open_feed should yield every file member of tar and zip archives"""
+        with open(self.path('book.xml'), 'wb') as fh:
+            fh.write(CATALOG)
+        with tarfile.open(self.path('feed.tar.gz'), 'w:gz') as archive:
+            archive.add(self.path('book.xml'), arcname='a.xml')
+            archive.add(self.path('book.xml'), arcname='b.xml')
+        with zipfile.ZipFile(self.path('feed.zip'), 'w') as archive:
+            archive.write(self.path('book.xml'), arcname='a.xml')
+
+        tar_path, zip_path = self.path('feed.tar.gz'), self.path('feed.zip')
+        self.assertEqual(self.read_all(tar_path), [
+            (u'{}:a.xml'.format(tar_path), CATALOG),
+            (u'{}:b.xml'.format(tar_path), CATALOG)])
+        self.assertEqual(self.read_all(zip_path), [(u'{}:a.xml'.format(zip_path), CATALOG)])
+
+
+class TestReadFeed(SimpleTestCase):
+
+    def test_storage_feeds_read_feed_records(self):
+        """read_feed should describe a feed with plain, picklable records"""
+        records = list(feeds.read_feed('data/update/update-1bad.xml'))
+        self.assertEqual([r[:2] for r in records], [
+            ('source', 'data/update/update-1bad.xml'),
+            ('book', 'data/update/update-1bad.xml')])
+        err = pickle.loads(pickle.dumps(records[1][2]))
+        self.assertEqual((err.name, err.message), ('ValueError', 'No data in title element'))
+
+    def test_storage_feeds_read_feed_parse_error(self):
+        """read_feed should report a stream it cannot parse as an error record"""
+        records = list(feeds.read_feed('data/update/update-2bad.xml'))
+        self.assertEqual(records[-1][0], 'error')
+        self.assertEqual(records[-1][2].name, 'XMLSyntaxError')
+
+    def test_storage_feeds_extract_chunks(self):
+        """Chunks of unextracted records should extract to what read_feed reads"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'catalog.xml')
+        with open(path, 'wb') as fh:
+            fh.write(CATALOG.replace(b'<title>Second</title>', b''))
+        chunks = list(feeds.chunk_records(feeds.read_feed(path, extract=False), chunk_size=2))
+        self.assertEqual([[r[0] for r in chunk] for chunk in chunks],
+                         [['source', 'book', 'book'], ['book']])
+        self.assertEqual(chunks[0][1][2], None)
+        extracted = [record for chunk in chunks
+                     for record in pickle.loads(pickle.dumps(feeds.extract_records(chunk)))]
+        read = list(feeds.read_feed(path))
+        # FeedErrors compare by identity; the second book's is checked on its own.
+        self.assertEqual(extracted[2][2].message, read[2][2].message)
+        extracted[2] = read[2]
+        self.assertEqual(extracted, read)
+
+    def test_storage_feeds_settle_broken_book(self):
+        """A book that does not parse in a worker should end its stream as one pass would"""
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        path = os.path.join(tmpdir, 'catalog.xml')
+        with open(path, 'wb') as fh:
+            fh.write(CATALOG.replace(b'<title>Second</title>', b'<title>Second</titel>'))
+        records = [record for chunk in feeds.chunk_records(
+                   feeds.read_feed(path, extract=False), chunk_size=1)
+                   for record in feeds.extract_records(chunk)]
+        self.assertEqual([record[0] for record in records], ['source', 'book', 'broken', 'book'])
+        settled = list(feeds.settle_records(path, records))
+        read = list(feeds.read_feed(path))
+        self.assertEqual([record[:2] for record in settled], [record[:2] for record in read])
+        self.assertEqual(settled[-1][2].message, read[-1][2].message)
@@ -0,0 +1,80 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import os
+import shutil
+import tempfile
+
+from django.test import TransactionTestCase
+
+from storage import benchmarks, generator, tools
+from storage.models import Book, Conflict
+from storage.records import BookRecord
+from storage.tests.test_commands import run_command
+
+
+class TestGenerator(TransactionTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_storage_generator_deterministic(self):
+        """The same seed and settings should give the same books, whatever else was asked for"""
+        catalog = generator.Catalog(100, seed=3)
+        self.assertEqual(catalog.book(42), generator.Catalog(10, seed=3).book(42))
+        self.assertNotEqual(catalog.book(42), generator.Catalog(100, seed=4).book(42))
+        element = generator.book_element(catalog.book(42))
+        self.assertEqual(tools.extract_book_data(element),
+                         BookRecord.from_dict(catalog.book(42)))
+
+    def test_storage_generator_rates(self):
+        """Duplicates, conflicts and updates should come at about the rates asked for"""
+        catalog = generator.Catalog(
+            2000, schemes=(('ISBN-13', 1), ('ASIN', 1)), duplicate_rate=0.1, conflict_rate=0.2,
+            update_ratio=0.3)
+        self.assertAlmostEqual(len(list(catalog.initial_books())), 2200, delta=100)
+        self.assertAlmostEqual(len(list(catalog.update_books())), 600, delta=100)
+        values = [alias['value'] for n in range(2000) for alias in catalog.book(n)['aliases']]
+        self.assertAlmostEqual(len(values) - len(set(values)), 400, delta=100)
+        self.assertEqual(set(alias['scheme'] for n in range(2000)
+                             for alias in catalog.own_aliases(n)), set(['ISBN-13', 'ASIN']))
+
+    def test_storage_generator_import(self):
+        """Generated feeds in either layout should import with conflicts and updates"""
+        catalog = generator.Catalog(50, conflict_rate=0.5, update_ratio=0.5)
+        num_records = len(list(catalog.initial_books()))
+        for layout in generator.LAYOUTS:
+            Book.objects.all().delete()
+            directory = os.path.join(self.tmpdir, layout)
+            output = run_command('generate_catalog', directory, books=50, layout=layout,
+                                 conflict_rate=0.5, update_ratio=0.5)
+            num_files = 1 if layout == 'single' else num_records
+            self.assertIn('initial: {} books in {} file'.format(num_records, num_files), output)
+            for feed in ('initial', 'update'):
+                feed_dir = os.path.join(directory, feed)
+                run_command('process_data_file', *[
+                    os.path.join(feed_dir, name) for name in sorted(os.listdir(feed_dir))])
+            self.assertEqual(Book.objects.count(), 50)
+            self.assertTrue(Conflict.objects.exists())
+            self.assertTrue(Book.objects.filter(title__endswith='2nd edition').exists())
+
+
+class TestBenchmarks(TransactionTestCase):
+
+    def test_storage_benchmarks_summarize(self):
+        """summarize should report milliseconds"""
+        summary = benchmarks.summarize([0.002, 0.001, 0.003])
+        self.assertEqual((summary['count'], summary['p50_ms'], summary['max_ms']), (3, 2, 3))
+        self.assertEqual(benchmarks.summarize([]), {'count': 0})
+
+    def test_storage_benchmarks_compare(self):
+        """compare should line up the figures of the sizes both runs measured"""
+        old = {'sizes': [{'books': 10, 'process_data_file': {'books_per_sec': 100.0}},
+                         {'books': 20, 'peak_rss_kb': 1}]}
+        new = {'sizes': [{'books': 10, 'process_data_file': {'books_per_sec': 150.0}},
+                         {'books': 30, 'peak_rss_kb': 2}]}
+        self.assertEqual(benchmarks.compare(old, new), [
+            '10 books:', '    process_data_file.books_per_sec: 100.0 -> 150.0 +50.0%'])
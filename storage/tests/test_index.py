@@ -0,0 +1,122 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from lxml import etree
+
+from django.test import SimpleTestCase, TestCase
+
+from storage import tools
+from storage.index import AliasIndex, BloomFilter
+from storage.models import Alias, Book, Conflict
+
+
+class TestBloomFilter(SimpleTestCase):
+
+    def test_storage_index_bloom_filter_membership(self):
+        """BloomFilter should never report an added key as absent"""
+        bloom = BloomFilter(1000)
+        keys = [('ISBN-13', str(n)) for n in range(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(('ISBN-10', str(n)) in bloom for n in range(1000))
+        self.assertLess(false_positives, 50)
+
+    def test_storage_index_bloom_filter_grows(self):
+        """BloomFilter should keep its false positive rate with many more keys than its capacity"""
+        bloom = BloomFilter(1000)
+        keys = [('ISBN-13', str(n)) for n in range(20000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+        false_positives = sum(('ISBN-10', str(n)) in bloom for n in range(10000))
+        self.assertLess(false_positives, 200)
+
+
+class TestAliasIndex(TestCase):
+
+    def setUp(self):
+        self.book = Book.objects.create(title='The Title')
+        self.alias = self.book.aliases.create(scheme='PUB_ID', value='123')
+        self.book.aliases.create(scheme='FOO', value='BAR')
+
+    def test_storage_index_lookup_before_warm(self):
+        """AliasIndex should not answer lookups until it is warmed"""
+        index = AliasIndex()
+        self.assertIsNone(index.lookup('PUB_ID', '123'))
+        self.assertEqual(index.misses, 1)
+
+    def test_storage_index_warm_and_lookup(self):
+        """A warmed AliasIndex should know every alias and which ones do not exist"""
+        index = AliasIndex().warm(chunk_size=1)
+        with self.assertNumQueries(0):
+            self.assertEqual(index.lookup('PUB_ID', '123'), ((self.alias.id, self.book.id),))
+            self.assertEqual(index.lookup('PUB_ID', 'nope'), ())
+        self.assertEqual((index.hits, index.absent, index.misses), (1, 1, 0))
+
+    def test_storage_index_eviction(self):
+        """AliasIndex should evict least recently used keys and then defer to the database"""
+        index = AliasIndex(max_entries=1).warm()
+        self.assertEqual(len(index.entries), 1)
+        self.assertEqual(index.evictions, 1)
+        self.assertIsNone(index.lookup('PUB_ID', '123'))
+        self.assertEqual(index.lookup('FOO', 'BAR'), ((self.book.aliases.get(scheme='FOO').id,
+                                                       self.book.id),))
+
+    def test_storage_index_warmed_empty(self):
+        """An index warmed on a nearly empty table should still rule out keys never added"""
+        index = AliasIndex().warm()
+        for n in range(20000):
+            index.add(n, self.book.id, 'ISBN-13', str(n))
+        with self.assertNumQueries(0):
+            self.assertEqual(index.lookup('ISBN-13', '19999'), ((19999, self.book.id),))
+        index.forget()
+        unknown = sum(index.lookup('ISBN-10', str(n)) is None for n in range(10000))
+        self.assertLess(unknown, 200)
+
+    def test_storage_index_byte_budget(self):
+        """AliasIndex should stay within its byte budget"""
+        index = AliasIndex(max_bytes=1).warm()
+        self.assertEqual(len(index.entries), 0)
+        self.assertLessEqual(index.num_bytes, 1)
+
+    def test_storage_index_tracks_populate_and_save(self):
+        """populate_and_save should keep the index up to date"""
+        index = AliasIndex().warm()
+        book = tools.populate_and_save(Book(), {
+            'publisher_id': '456', 'title': 'Another', 'description': '',
+            'aliases': [{'scheme': 'PUB_ID', 'value': '456'}, {'scheme': 'FOO', 'value': 'BAR'}]},
+            alias_index=index)
+        alias = book.aliases.get(scheme='PUB_ID')
+        self.assertEqual(index.lookup('PUB_ID', '456'), ((alias.id, book.id),))
+        self.assertEqual(len(index.lookup('FOO', 'BAR')), 2)
+
+
+class TestStoreWithAliasIndex(TestCase):
+
+    feed = [
+        u'<book id="1"><title>First</title><aliases>'
+        u'<alias scheme="ISBN-10" value="0000000001"/></aliases></book>',
+        u'<book id="2"><title>Second</title><aliases>'
+        u'<alias scheme="ISBN-10" value="0000000001"/></aliases></book>',
+        u'<book id="1"><title>First, 2e</title><aliases>'
+        u'<alias scheme="ISBN-13" value="0000000000001"/></aliases></book>',
+    ]
+
+    def import_feed(self, alias_index=None):
+        elements = [etree.fromstring(xml) for xml in self.feed]
+        return [(book.title, update_type, num_conflicts) for book, update_type, num_conflicts
+                in tools.process_book_elements(elements, batch_size=2, alias_index=alias_index)]
+
+    def test_storage_index_batch_import_matches_database(self):
+        """The batch import should store and report the same with or without an alias index"""
+        expected = self.import_feed()
+        expected_counts = (Book.objects.count(), Alias.objects.count(), Conflict.objects.count())
+        Book.objects.all().delete()
+
+        index = AliasIndex().warm()
+        self.assertEqual(self.import_feed(alias_index=index), expected)
+        self.assertEqual(
+            (Book.objects.count(), Alias.objects.count(), Conflict.objects.count()),
+            expected_counts)
+        self.assertEqual(index.misses, 0)
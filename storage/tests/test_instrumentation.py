@@ -0,0 +1,78 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import glob
+import json
+import os
+import shutil
+import tempfile
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from storage import instrumentation, tools
+from storage.tests.test_commands import run_command
+
+
+def incoming_book(num):
+    return {'publisher_id': 'pub-{}'.format(num), 'title': 'Title {}'.format(num),
+            'description': '', 'aliases': [{'scheme': 'ISBN-10', 'value': str(num)}]}
+
+
+class TestInstrumentation(TestCase):
+
+    def tearDown(self):
+        instrumentation.stop()
+
+    def test_storage_instrumentation_off(self):
+        """Stages should cost nothing and record nothing while instrumentation is off"""
+        items = [1, 2]
+        self.assertIs(instrumentation.iterate('parse', items), items)
+        self.assertIs(instrumentation.stage('extract'), instrumentation.stage('validate'))
+        self.assertIsNone(instrumentation.add_books(10))
+        self.assertIsNone(instrumentation.stop())
+
+    def test_storage_instrumentation_stages(self):
+        """Each stage should get its runs, times and queries, and the debug cursor be restored"""
+        use_debug_cursor = connection.use_debug_cursor
+        recorder = instrumentation.start()
+        self.assertEqual(list(instrumentation.iterate('parse', [1, 2, 3])), [1, 2, 3])
+        tools.store_books_with_conflicts([incoming_book(num) for num in range(3)])
+        self.assertIs(instrumentation.stop(), recorder)
+        self.assertEqual(connection.use_debug_cursor, use_debug_cursor)
+
+        summary = recorder.summary()
+        stages = summary['stages']
+        self.assertEqual(stages['parse']['calls'], 4)
+        self.assertEqual(stages['validate']['calls'], 3)
+        self.assertEqual(stages['parse']['queries'], 0)
+        self.assertGreater(stages['write_books']['queries'], 0)
+        self.assertGreater(stages['write_aliases']['queries'], 0)
+        self.assertEqual(sum(stages['validate']['wall']['buckets_us'].values()), 3)
+        self.assertEqual(len(connection.queries), 0)
+        json.dumps(summary)
+
+
+class TestImportStatistics(TransactionTestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_storage_instrumentation_process_data_file(self):
+        """process_data_file should report its figures, save them and the profile if asked"""
+        files = sorted(glob.glob('data/initial/*.xml'))
+        stats_path = os.path.join(self.tmpdir, 'stats.json')
+        profile_path = os.path.join(self.tmpdir, 'import.prof')
+        output = run_command('process_data_file', *files, stats_json=stats_path,
+                             profile=profile_path, progress_interval=0)
+        self.assertIn('\nImport statistics\n', output)
+        self.assertIn('[progress] {} books'.format(len(files)), output)
+        with open(stats_path) as fh:
+            summary = json.load(fh)
+        self.assertEqual(summary['books'], len(files))
+        self.assertEqual(summary['stages']['extract']['calls'], len(files))
+        self.assertTrue(os.path.getsize(profile_path))
+        self.assertIsNone(instrumentation.stop())
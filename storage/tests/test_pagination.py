@@ -0,0 +1,57 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from django.core.cache import cache
+from django.db import connection
+from django.test import TestCase
+
+from storage.models import Book
+from storage.pagination import EstimatedCountPaginator, estimated_count, keyset_filter
+
+
+class TestPagination(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        for title in ('b', 'a', 'c', 'b', 'a'):
+            Book.objects.create(title=title)
+
+    def test_storage_pagination_estimated_count_cached(self):
+        """Without statistics, estimated_count should count once and reuse the answer"""
+        queryset = Book.objects.filter(title='a')
+        self.assertEqual(estimated_count(queryset), 2)
+        Book.objects.create(title='a')
+        with self.assertNumQueries(0):
+            self.assertEqual(estimated_count(queryset), 2)
+        self.assertEqual(estimated_count(Book.objects.filter(title='b')), 2)
+
+    def test_storage_pagination_estimated_count_empty(self):
+        """estimated_count should answer 0 for a queryset that cannot match, without a query"""
+        with self.assertNumQueries(0):
+            self.assertEqual(estimated_count(Book.objects.none()), 0)
+            self.assertEqual(estimated_count(Book.objects.filter(id__in=[])), 0)
+
+    def test_storage_pagination_estimated_count_statistics(self):
+        """An unfiltered queryset should be estimated from the ANALYZE statistics"""
+        connection.cursor().execute('ANALYZE')
+        Book.objects.create(title='d')
+        with self.assertNumQueries(1):
+            self.assertEqual(estimated_count(Book.objects.all()), 5)
+        self.assertEqual(EstimatedCountPaginator(Book.objects.all(), 2).num_pages, 3)
+
+    def test_storage_pagination_keyset_filter(self):
+        """keyset_filter should continue an ordering, in either direction, where a row left it"""
+        for ordering in (['title', 'id'], ['title', '-id'], ['-title', 'id'], ['-id']):
+            expected = list(Book.objects.order_by(*ordering).values_list('title', 'id'))
+            names = [name.lstrip('-') for name in ordering]
+            pages, after = [], None
+            while True:
+                queryset = Book.objects.order_by(*ordering)
+                if after is not None:
+                    queryset = queryset.filter(keyset_filter(ordering, after))
+                page = list(queryset.values_list(*names)[:2])
+                if not page:
+                    break
+                pages.extend(page)
+                after = page[-1]
+            self.assertEqual([row[-1] for row in pages], [row[1] for row in expected])
@@ -0,0 +1,156 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from django.contrib import admin
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from storage import generator, tools
+from storage.admin import BookAdmin
+from storage.models import Alias, Book, Conflict
+from storage.tests.querybudget import QueryBudgetMixin, normalize
+
+# Alias counts and batch sizes every budget is checked at; a budget holds for all of them.
+ALIAS_COUNTS = (1, 5, 20)
+BATCH_SIZES = (1, 10, 100)
+
+
+def incoming_book(num, num_aliases, shared=()):
+    """Return the incoming dict of book num, with num_aliases aliases of its own and shared"""
+    aliases = [{'scheme': 'PUB_ID', 'value': 'pub-{}'.format(num)}]
+    aliases += [{'scheme': 'ISBN-13', 'value': '{}-{}'.format(num, slot)}
+                for slot in range(num_aliases)]
+    aliases += [{'scheme': 'ISBN-13', 'value': value} for value in shared]
+    return {'publisher_id': 'pub-{}'.format(num), 'title': 'Book {:03}'.format(num),
+            'description': 'About book {}'.format(num), 'version': '1.0', 'aliases': aliases}
+
+
+class TestQueryBudget(QueryBudgetMixin, TestCase):
+
+    def test_storage_query_budget_normalize(self):
+        """Queries differing only in their parameters should be told apart from others"""
+        self.assertEqual(
+            normalize(u"QUERY = u'SELECT id FROM t WHERE id IN (%s, %s) AND v = %s' - "
+                      u"PARAMS = (1, 2, u'x')"),
+            'SELECT id FROM t WHERE id IN (...) AND v = ?')
+        self.assertEqual(normalize("SELECT t2.id FROM t2 WHERE name = 'it''s' LIMIT 21"),
+                         'SELECT t2.id FROM t2 WHERE name = ? LIMIT ?')
+        self.assertEqual(
+            normalize('INSERT INTO t (a, b) SELECT %s AS a, %s AS b UNION ALL SELECT %s, %s'),
+            'INSERT INTO t (a, b) SELECT ? AS a, ? AS b UNION ALL ...')
+        self.assertEqual(normalize('RELEASE SAVEPOINT "s140_x3"'), 'RELEASE SAVEPOINT ?')
+
+    def test_storage_query_budget_failure_lists_queries(self):
+        """Going over budget should fail with each statement listed once, with its count"""
+        with self.assertRaises(AssertionError) as context:
+            with self.assertQueryBudget(2, 'Fetching books'):
+                for num in range(3):
+                    list(Book.objects.filter(title='Book {}'.format(num)))
+                Book.objects.count()
+        message = str(context.exception)
+        self.assertIn('Fetching books ran 4 queries, over its budget of 2:', message)
+        lines = message.splitlines()[1:]
+        self.assertEqual(len(lines), 2)
+        self.assertTrue(lines[0].startswith('    3 x SELECT'))
+        self.assertIn('WHERE "storage_book"."title" = ?', lines[0])
+        self.assertTrue(lines[1].startswith('    1 x SELECT COUNT(*)'))
+
+
+class TestStorageQueryBudgets(QueryBudgetMixin, TestCase):
+    """How many queries each storage operation may run, at every input size"""
+
+    def setUp(self):
+        cache.clear()
+
+    def test_storage_query_budget_process_book_element(self):
+        """A new book should cost a fixed number of queries plus one INSERT per alias"""
+        for num_aliases in ALIAS_COUNTS:
+            book = incoming_book(num_aliases, num_aliases)
+            element = generator.book_element(book)
+            # The book is saved in a savepoint of the transaction it commits in with its conflicts.
+            with self.assertQueryBudget(7 + len(book['aliases']), 'process_book_element'):
+                tools.process_book_element(element)
+
+    def test_storage_query_budget_store_book_with_conflicts(self):
+        """An update should cost a fixed number of queries plus one per alias it adds"""
+        for num_aliases in ALIAS_COUNTS:
+            tools.store_book_with_conflicts(incoming_book(num_aliases, num_aliases))
+            shared = ['{}-0'.format(ALIAS_COUNTS[0])]
+            book = incoming_book(num_aliases, num_aliases + 1, shared=shared)
+            book['title'] += ', 2nd edition'
+            with self.assertQueryBudget(11 + 2, 'store_book_with_conflicts'):
+                tools.store_book_with_conflicts(book)
+            # Stored again unchanged, it is only looked up.
+            with self.assertQueryBudget(1, 'store_book_with_conflicts, unchanged'):
+                tools.store_book_with_conflicts(book)
+
+    def test_storage_query_budget_store_books_with_conflicts(self):
+        """A batch should cost a fixed number of queries, whatever its books and aliases"""
+        num = 0
+        for batch_size in BATCH_SIZES:
+            for num_aliases in ALIAS_COUNTS:
+                # Each book shares an alias with the one before it.
+                books = [incoming_book(num + n, num_aliases, shared=['{}-0'.format(num + n - 1)])
+                         for n in range(batch_size)]
+                num += batch_size
+                # Long lists of aliases and conflicts are written and looked up a chunk at a time.
+                chunks = sum(len(book['aliases']) for book in books) // 100
+                with self.assertQueryBudget(12 + chunks, 'store_books_with_conflicts'):
+                    tools.store_books_with_conflicts(books)
+                for book in books:
+                    book['title'] += ', 2nd edition'
+                    book['aliases'].append({'scheme': 'ASIN', 'value': book['title']})
+                # Each updated Book is saved with the fields it changed.
+                with self.assertQueryBudget(
+                        12 + chunks + batch_size, 'store_books_with_conflicts, updating'):
+                    tools.store_books_with_conflicts(books)
+
+    def test_storage_query_budget_get_alias_conflicts(self):
+        """Finding conflicts should take one query, however many aliases the book has"""
+        other = Book.objects.create(title='Other')
+        for num_aliases in ALIAS_COUNTS:
+            book = Book.objects.create(title='Book')
+            for slot in range(num_aliases):
+                value = '{}-{}'.format(num_aliases, slot)
+                Alias.objects.create(book=book, scheme='ISBN-13', value=value)
+                Alias.objects.create(book=other, scheme='ISBN-13', value=value)
+            with self.assertQueryBudget(1, 'get_alias_conflicts'):
+                self.assertEqual(len(tools.get_alias_conflicts(book)), num_aliases)
+
+    def test_storage_query_budget_create_conflicts(self):
+        """Recording conflicts should take one INSERT per conflict and nothing else"""
+        other = Book.objects.create(title='Other')
+        for num_aliases in ALIAS_COUNTS:
+            book = Book.objects.create(title='Book')
+            aliases = [Alias.objects.create(
+                book=other, scheme='ISBN-13', value='{}-{}'.format(num_aliases, slot))
+                       for slot in range(num_aliases)]
+            with self.assertQueryBudget(num_aliases, 'create_conflicts'):
+                self.assertEqual(tools.create_conflicts(book, aliases), num_aliases)
+            with self.assertQueryBudget(num_aliases, 'create_conflicts, already recorded'):
+                self.assertEqual(tools.create_conflicts(book, aliases), 0)
+
+    def test_storage_query_budget_admin_changelist(self):
+        """The Book changelist should cost a fixed number of queries, whatever the page holds"""
+        model_admin = BookAdmin(Book, admin.site)
+        factory = RequestFactory()
+        user = User.objects.create_superuser('admin', 'admin@example.com', 'admin')
+        previous = None
+        for num in range(model_admin.list_per_page + 1):
+            book = Book.objects.create(title='Book {:03}'.format(num))
+            for slot in range(num % 4):
+                alias = Alias.objects.create(
+                    book=book, scheme='ISBN-13', value='{}-{}'.format(num, slot))
+            if previous is not None:
+                Conflict.objects.create(book=book, alias=previous)
+            previous = alias if num % 4 else None
+            # Pages of one book, a few, a full page, and a full page with a next one.
+            if num not in (0, 9, model_admin.list_per_page - 1, model_admin.list_per_page):
+                continue
+            for params in ({}, {'o': '-2'}, {'q': 'book'}):
+                request = factory.get('/admin/storage/book/', params)
+                request.user = user
+                with self.assertQueryBudget(6, 'The Book changelist'):
+                    model_admin.changelist_view(request).render()
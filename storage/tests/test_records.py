@@ -0,0 +1,52 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import pickle
+
+from django.test import SimpleTestCase, TestCase
+
+from storage import tools
+from storage.records import AliasRecord, BookRecord, book_record
+
+BOOK = {
+    'publisher_id': '123',
+    'title': 'Title',
+    'description': 'Description',
+    'version': '1.0',
+    'aliases': [{'scheme': 'PUB_ID', 'value': '123'}, {'scheme': 'ISBN-10', 'value': '1'}],
+}
+
+
+class TestRecords(SimpleTestCase):
+
+    def test_storage_records_dict_round_trip(self):
+        """A record should turn into the dict it was made from, and back"""
+        record = BookRecord.from_dict(BOOK)
+        self.assertEqual(record.aliases, (('PUB_ID', '123'), ('ISBN-10', '1')))
+        self.assertTrue(all(isinstance(alias, AliasRecord) for alias in record.aliases))
+        self.assertEqual(record.to_dict(), BOOK)
+        self.assertIs(book_record(record), record)
+        self.assertEqual(book_record(BOOK), record)
+
+    def test_storage_records_intern_schemes(self):
+        """Aliases of one scheme should share a single copy of its name, even after pickling"""
+        first = AliasRecord(''.join(['ISBN', '-13']), '1')
+        second = AliasRecord(''.join(['ISBN', '-1', '3']), '2')
+        self.assertIs(first.scheme, second.scheme)
+        record = BookRecord('1', 'Title', '', [('PUB_ID', '1'), first])
+        copy = pickle.loads(pickle.dumps(record, pickle.HIGHEST_PROTOCOL))
+        self.assertEqual(copy, record)
+        self.assertIs(copy.aliases[1].scheme, first.scheme)
+
+
+class TestStoreDicts(TestCase):
+
+    def test_storage_records_store_dicts(self):
+        """The storage functions should store a dict as they do the record made from it"""
+        book, update_type, num_conflicts = tools.store_book_with_conflicts(BOOK)
+        self.assertEqual(update_type, 'Created')
+        self.assertEqual(book.fingerprint, tools.fingerprint(BookRecord.from_dict(BOOK)))
+        results = tools.store_books_with_conflicts([BookRecord.from_dict(BOOK), dict(BOOK)])
+        self.assertEqual([result[1] for result in results], [tools.SKIPPED_STALE] * 2)
+        unversioned = dict(BOOK, version=None)
+        self.assertEqual(tools.store_book_with_conflicts(unversioned)[1], 'Unchanged')
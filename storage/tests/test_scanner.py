@@ -0,0 +1,91 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import datetime
+
+from django.test import TestCase
+from django.utils import timezone
+
+from storage import scanner
+from storage.changes import SAFETY_WINDOW
+from storage.models import Alias, Book, Conflict, ConflictScan
+
+
+class TestScanConflicts(TestCase):
+
+    def setUp(self):
+        self.a = Book.objects.create(title='A')
+        self.b = Book.objects.create(title='B')
+        self.c = Book.objects.create(title='C')
+        self.a_isbn = self.a.aliases.create(scheme='ISBN-10', value='1')
+        self.b_isbn = self.b.aliases.create(scheme='ISBN-10', value='1')
+        self.b_prop = self.b.aliases.create(scheme='Proprietary', value='X')
+        self.c_prop = self.c.aliases.create(scheme='Proprietary', value='X')
+        self.c.aliases.create(scheme='ISBN-13', value='1')
+
+    def conflicts(self):
+        return sorted(Conflict.objects.values_list('book__title', 'alias__book__title',
+                                                   'alias__scheme'))
+
+    def test_storage_scanner_full_scan(self):
+        """A full scan should create a Conflict on each side of every shared alias"""
+        scan = scanner.scan_conflicts(chunk_size=1)
+        self.assertEqual(self.conflicts(), [
+            ('A', 'B', 'ISBN-10'), ('B', 'A', 'ISBN-10'),
+            ('B', 'C', 'Proprietary'), ('C', 'B', 'Proprietary')])
+        self.assertEqual((scan.mode, scan.num_inserted, scan.num_deleted),
+                         (ConflictScan.FULL, 4, 0))
+        self.assertIsNotNone(scan.finished_time)
+
+        scan = scanner.scan_conflicts(chunk_size=1)
+        self.assertEqual((scan.num_inserted, scan.num_deleted), (0, 0))
+
+    def test_storage_scanner_full_scan_deletes_stale(self):
+        """A full scan should delete Conflicts whose books no longer share the alias"""
+        scanner.scan_conflicts()
+        self.c_prop.value = 'Y'
+        self.c_prop.save()
+        Conflict.objects.create(book=self.a, alias=self.a_isbn)
+
+        scan = scanner.scan_conflicts(chunk_size=1)
+        self.assertEqual((scan.num_inserted, scan.num_deleted), (0, 3))
+        self.assertEqual(self.conflicts(), [('A', 'B', 'ISBN-10'), ('B', 'A', 'ISBN-10')])
+
+    def test_storage_scanner_incremental_scan(self):
+        """An incremental scan should only look at aliases modified since the last scan"""
+        d = Book.objects.create(title='D')
+        d.aliases.create(scheme='FOO', value='Z')
+        self.a.aliases.create(scheme='FOO', value='Z')
+        # Only the alias edited below is modified within SAFETY_WINDOW of the scan's watermark.
+        Alias.objects.exclude(pk=self.c_prop.pk).update(
+            last_modified_time=timezone.now() - 2 * SAFETY_WINDOW)
+        scan = scanner.scan_conflicts(incremental=True)
+        self.assertEqual((scan.mode, scan.num_inserted), (ConflictScan.FULL, 6))
+
+        # Conflicts on aliases nobody modified are left alone...
+        Conflict.objects.filter(book=d).delete()
+        # ... while an edit shows up on both the alias's new pair and the one it left.
+        Alias.objects.filter(pk=self.c_prop.pk).update(
+            value='1', scheme='ISBN-10',
+            last_modified_time=scan.watermark + datetime.timedelta(seconds=1))
+
+        scan = scanner.scan_conflicts(incremental=True)
+        self.assertEqual((scan.mode, scan.num_inserted, scan.num_deleted),
+                         (ConflictScan.INCREMENTAL, 3, 1))
+        self.assertEqual(self.conflicts(), [
+            ('A', 'B', 'ISBN-10'), ('A', 'C', 'ISBN-10'), ('A', 'D', 'FOO'),
+            ('B', 'A', 'ISBN-10'), ('B', 'C', 'ISBN-10'),
+            ('C', 'A', 'ISBN-10'), ('C', 'B', 'ISBN-10')])
+
+    def test_storage_scanner_incremental_scan_safety_window(self):
+        """An incremental scan should re-check aliases stamped shortly before the last watermark"""
+        Alias.objects.update(last_modified_time=timezone.now() - 2 * SAFETY_WINDOW)
+        scanner.scan_conflicts()
+        # As if an alias stamped before the last scan committed only after it had read Alias.
+        d = Book.objects.create(title='D')
+        d.aliases.create(scheme='ISBN-10', value='1')
+        watermark = ConflictScan.objects.get().watermark
+        Alias.objects.filter(book=d).update(
+            last_modified_time=watermark - SAFETY_WINDOW / 2)
+        scan = scanner.scan_conflicts(incremental=True)
+        self.assertEqual((scan.mode, scan.num_inserted), (ConflictScan.INCREMENTAL, 4))
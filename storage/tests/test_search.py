@@ -0,0 +1,71 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from django.db import connection
+from django.test import TestCase
+
+from storage import search, tools
+from storage.models import Book
+from storage.tests.querybudget import query_plan
+
+
+class TestSearch(TestCase):
+
+    def setUp(self):
+        self.cookbook = Book.objects.create(
+            title='Python Cookbook', description='Recipes for mastering Python')
+        self.perl = Book.objects.create(
+            title='Learning Perl', description='Perl, not python, for the impatient')
+        self.java = Book.objects.create(title=u'Java Précis', description=None)
+
+    def titles(self, text):
+        return [book.title for book in search.search_books(text)]
+
+    def test_storage_search_match_expression(self):
+        """match_expression should quote every word and let the last one be a prefix"""
+        self.assertEqual(search.match_expression(u'python "NEAR" cook'),
+                         u'"python" "NEAR" "cook"*')
+        self.assertEqual(search.match_expression(u' -*" '), None)
+        self.assertEqual(self.titles(u' -*" '), [])
+
+    def test_storage_search_ranking(self):
+        """search_books should rank title matches first and match word prefixes and accents"""
+        self.assertEqual(self.titles('python'), ['Python Cookbook', 'Learning Perl'])
+        self.assertEqual(self.titles('impatient pyth'), ['Learning Perl'])
+        self.assertEqual(self.titles('precis'), [u'Java Précis'])
+        books = list(search.search_books('python'))
+        self.assertTrue(books[0].search_rank < books[1].search_rank)
+
+    def test_storage_search_plan(self):
+        """The full-text query should run once, not once per candidate book"""
+        plan = query_plan(search.search_books('python'))
+        self.assertEqual(plan.count('storage_book_search VIRTUAL TABLE'), 1, plan)
+        self.assertIn('SEARCH storage_book USING INTEGER PRIMARY KEY (rowid=?)', plan)
+        self.assertNotIn('CORRELATED', plan)
+
+    def test_storage_search_follows_writes(self):
+        """The index should follow saves, deletes, updates and the bulk import path"""
+        self.cookbook.title = 'Ruby Cookbook'
+        self.cookbook.save()
+        self.assertEqual(self.titles('ruby'), ['Ruby Cookbook'])
+        Book.objects.filter(pk=self.perl.pk).update(description='Camels')
+        self.assertEqual(self.titles('camels'), ['Learning Perl'])
+        self.perl.delete()
+        self.assertEqual(self.titles('camels'), [])
+
+        tools.store_books_with_conflicts([{
+            'publisher_id': 'X', 'title': 'Programming Rust', 'description': 'Ferris',
+            'aliases': [{'scheme': 'PUB_ID', 'value': 'X'}]}])
+        self.assertEqual(self.titles('ferris'), ['Programming Rust'])
+
+    def test_storage_search_rebuild(self):
+        """rebuild_search_index should restore an index that fell out of step"""
+        connection.cursor().execute('DELETE FROM storage_book_search WHERE rowid = %s',
+                                    [self.java.pk])
+        connection.cursor().execute(
+            'UPDATE storage_book_search SET title = %s WHERE rowid = %s', ['Stale', self.perl.pk])
+        self.assertEqual(self.titles('java'), [])
+        self.assertEqual(search.rebuild_search_index(chunk_size=2), 3)
+        self.assertEqual(self.titles('java'), [u'Java Précis'])
+        self.assertEqual(self.titles('stale'), [])
+        self.assertEqual(self.titles('perl'), ['Learning Perl'])
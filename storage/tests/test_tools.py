@@ -7,9 +7,11 @@
 from lxml import etree
 
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.db import OperationalError, connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
 
-from storage import tools
+from storage import clusters, tools
 from storage.models import Book, Alias, Conflict
 
 
@@ -97,6 +99,50 @@ class TestProcessBookElement(TestCase):
         self.assertEqual(Alias.objects.get(scheme='FOO').value, 'BAR')
         self.assertEqual(Alias.objects.get(scheme='THIS').value, 'THAT')
 
+    def test_storage_tools_reimport_is_unchanged(self):
+        """process_book_element should report an identical record as Unchanged and write nothing"""
+        xml = etree.fromstring(self.xml_str)
+        tools.process_book_element(xml)
+        modified = Book.objects.get().last_modified_time
+
+        with self.assertNumQueries(1):
+            book, update_type, num_conflicts = tools.process_book_element(xml)
+        self.assertEqual((update_type, num_conflicts), ('Unchanged', 0))
+        self.assertEqual(Book.objects.get().last_modified_time, modified)
+
+    def test_storage_tools_update_writes_only_changes(self):
+        """process_book_element should only write changed fields and missing aliases"""
+        tools.process_book_element(etree.fromstring(self.xml_str))
+        old_ids = set(Alias.objects.values_list('id', flat=True))
+
+        xml = etree.fromstring(self.xml_str.replace(
+            'This and that', 'Something else').replace(
+            '</aliases>', '<alias scheme="Proprietary" value="ABC"/></aliases>'))
+        book, update_type, num_conflicts = tools.process_book_element(xml)
+        self.assertEqual(update_type, 'Updated')
+        self.assertEqual(Book.objects.get().description, 'Something else')
+        self.assertEqual(Book.objects.get().fingerprint, tools.fingerprint(
+            tools.extract_book_data(xml)))
+        new_aliases = Alias.objects.exclude(id__in=old_ids)
+        self.assertEqual(list(new_aliases.values_list('scheme', 'value')), [('Proprietary', 'ABC')])
+
+    def test_storage_tools_changed_fields(self):
+        """changed_fields should list only the fields that differ from the incoming data"""
+        incoming = tools.extract_book_data(etree.fromstring(self.xml_str))
+        book = Book(title=incoming.title, description='Old',
+                    fingerprint=tools.fingerprint(incoming))
+        self.assertEqual(tools.changed_fields(book, incoming),
+                         ['description', 'last_modified_time'])
+
+    def test_storage_tools_fingerprint_ignores_alias_order(self):
+        """fingerprint should not depend on the order aliases arrive in"""
+        incoming = tools.extract_book_data(etree.fromstring(self.xml_str))
+        shuffled = incoming._replace(aliases=tuple(reversed(incoming.aliases)))
+        self.assertEqual(tools.fingerprint(incoming), tools.fingerprint(shuffled))
+        self.assertEqual(tools.fingerprint(incoming), tools.fingerprint(incoming.to_dict()))
+        self.assertNotEqual(tools.fingerprint(incoming),
+                            tools.fingerprint(incoming._replace(title='Other')))
+
     def test_storage_tools_populate_and_save_fails_on_book_overflow(self):
         """populate_and_save should fail when book fields overflow"""
         book = Book()
@@ -132,17 +178,17 @@ class TestProcessBookElement(TestCase):
         self.assertEqual(Alias.objects.count(), 0)
 
     def test_storage_tools_extract_book_data(self):
-        """extract_book_data should extract data from XML into dict of appropriate values"""
+        """extract_book_data should extract data from XML into a record of appropriate values"""
         book_element = etree.fromstring(self.xml_str)
         data = tools.extract_book_data(book_element)
-        self.assertEqual(data['publisher_id'], '12345')
-        self.assertEqual(data['title'], u'El Título')
-        self.assertEqual(data['description'], 'This and that')
-        self.assertEqual(data['aliases'], [
-            {'scheme': 'PUB_ID', 'value': '12345'},
-            {'scheme': 'ISBN-10', 'value': '0158757819'},
-            {'scheme': 'ISBN-13', 'value': '0000000000123'},
-        ])
+        self.assertEqual(data.publisher_id, '12345')
+        self.assertEqual(data.title, u'El Título')
+        self.assertEqual(data.description, 'This and that')
+        self.assertEqual(data.aliases, (
+            ('PUB_ID', '12345'),
+            ('ISBN-10', '0158757819'),
+            ('ISBN-13', '0000000000123'),
+        ))
 
     def test_storage_tools_extract_book_data_with_missing_title(self):
         """extract_book_data should throw error if missing title data"""
@@ -195,3 +241,258 @@ class TestProcessingConflicts(TestCase):
         """get_alias_conflicts should return empty list if incoming data has no conflicts"""
         conflicts = tools.get_alias_conflicts(self.existing_book)
         self.assertEqual(conflicts, [])
+
+    def test_storage_tools_get_alias_conflicts_single_query(self):
+        """get_alias_conflicts should take one query whatever the number of aliases"""
+        for num_aliases in (1, 50):
+            new_book = Book.objects.create(title='Ninjas are for Movies')
+            new_book.aliases.create(scheme='FOO', value='BAR')
+            for n in range(num_aliases):
+                new_book.aliases.create(scheme='ISBN-13', value=str(n))
+            with self.assertNumQueries(1):
+                conflicts = tools.get_alias_conflicts(new_book)
+            self.assertEqual([(a.book_id, a.scheme, a.value) for a in conflicts],
+                             [(self.existing_book.id, 'FOO', 'BAR')])
+            new_book.delete()
+
+
+class TestProcessBookElements(TestCase):
+    """The batch import path should give the same results as importing one book at a time"""
+
+    feed = [
+        u"""<book id="1"><title>First</title><description>One</description><aliases>
+            <alias scheme="ISBN-10" value="0000000001"/>
+            <alias scheme="ISBN-13" value="0000000000001"/>
+        </aliases></book>""",
+        u"""<book id="2"><title>Second</title><description>Two</description><aliases>
+            <alias scheme="ISBN-10" value="0000000001"/>
+            <alias scheme="Proprietary" value="ABC"/>
+        </aliases></book>""",
+        u"""<book id="1"><title>First, 2e</title><description>One again</description><aliases>
+            <alias scheme="ISBN-13" value="0000000000001"/>
+            <alias scheme="Proprietary" value="ABC"/>
+        </aliases></book>""",
+        u"""<book id="3"><description>No title</description></book>""",
+        u"""<book id="4"><title>Fourth</title><aliases>
+            <alias scheme="ISBN-10" value="0000000001"/>
+            <alias scheme="FOO" value="{}"/>
+        </aliases></book>""".format('X' * 1000),
+        u"""<book id="5"><title>Fifth</title><aliases>
+            <alias scheme="PUB_ID" value="1"/>
+            <alias scheme="ISBN-13" value="0000000000001"/>
+        </aliases></book>""",
+        u"""<book id="2"><title>Second, 2e</title><description>Two again</description><aliases>
+            <alias scheme="Proprietary" value="ABC"/>
+        </aliases></book>""",
+        u"""<book id="1"><title>First, 3e</title><description>Ambiguous now</description></book>""",
+    ]
+
+    def elements(self):
+        return [etree.fromstring(xml) for xml in self.feed]
+
+    def snapshot(self, results):
+        """Reduce results and database content to something comparable across runs"""
+        outcome = []
+        for result in results:
+            if isinstance(result, Exception):
+                outcome.append(type(result).__name__)
+            else:
+                book, update_type, num_conflicts = result
+                outcome.append((book.title, update_type, num_conflicts))
+        books = sorted(Book.objects.values_list('title', 'description'))
+        aliases = sorted(Alias.objects.values_list('book__title', 'scheme', 'value'))
+        conflicts = sorted(Conflict.objects.values_list(
+            'book__title', 'alias__book__title', 'alias__scheme', 'alias__value'))
+        return outcome, books, aliases, conflicts
+
+    def one_by_one(self):
+        results = []
+        for element in self.elements():
+            try:
+                results.append(tools.process_book_element(element))
+            except Exception as err:
+                results.append(err)
+        return self.snapshot(results)
+
+    def test_storage_tools_process_book_elements_matches_one_by_one(self):
+        """process_book_elements should store and report exactly like process_book_element"""
+        expected = self.one_by_one()
+        for batch_size in (1, 2, 3, len(self.feed)):
+            Book.objects.all().delete()
+            results = list(tools.process_book_elements(self.elements(), batch_size=batch_size))
+            self.assertEqual(self.snapshot(results), expected)
+
+    def test_storage_tools_process_book_elements_reimport(self):
+        """process_book_elements should not duplicate anything when a feed is imported twice"""
+        # Leave out the records that make PUB_ID 1 ambiguous; those create a new Book every time.
+        elements = self.elements()[:4] + self.elements()[6:7]
+        list(tools.process_book_elements(elements))
+        first = self.snapshot([])
+        results = list(tools.process_book_elements(elements))
+        self.assertEqual(self.snapshot([]), first)
+        self.assertTrue(all(r[2] == 0 for r in results if not isinstance(r, Exception)))
+
+    def test_storage_tools_store_books_with_conflicts_passes_errors_through(self):
+        """store_books_with_conflicts should hand back exceptions it is given, in place"""
+        err = ValueError('No data in title element')
+        incoming = tools.extract_book_data(self.elements()[0])
+        results = tools.store_books_with_conflicts([err, incoming])
+        self.assertIs(results[0], err)
+        self.assertEqual(results[1][0].title, 'First')
+        self.assertEqual(results[1][1], 'Created')
+
+
+class TestConcurrentImports(TestCase):
+    incoming = {
+        'publisher_id': '777',
+        'title': 'Raced',
+        'description': '',
+        'aliases': [{'scheme': 'PUB_ID', 'value': '777'}, {'scheme': 'ISBN-10', 'value': '1'}]}
+
+    def test_storage_tools_claimed_publisher_id_is_updated(self):
+        """A Book another importer created for the publisher id after the lookup is updated"""
+        # As if the other importer had committed its Book but not yet its aliases.
+        other = Book.objects.create(title='First', publisher_id='777')
+        for store in (tools.store_book_with_conflicts,
+                      lambda incoming: tools.store_books_with_conflicts([incoming])[0]):
+            other.aliases.all().delete()
+            book, update_type, num_conflicts = store(dict(self.incoming, title=store.__name__))
+            self.assertEqual((book.pk, update_type), (other.pk, 'Updated'))
+            self.assertEqual(Book.objects.get().title, store.__name__)
+            self.assertEqual(other.aliases.count(), 2)
+
+    def test_storage_tools_ambiguous_publisher_id_is_not_claimed(self):
+        """Only the first Book created for a publisher id claims it"""
+        tools.store_book_with_conflicts(self.incoming)
+        tools.store_book_with_conflicts(dict(self.incoming, publisher_id='778', aliases=[
+            {'scheme': 'PUB_ID', 'value': '778'}, {'scheme': 'PUB_ID', 'value': '777'}]))
+        book, update_type, num_conflicts = tools.store_book_with_conflicts(self.incoming)
+        self.assertEqual(update_type, 'Created')
+        self.assertEqual(
+            sorted(Book.objects.values_list('publisher_id', flat=True)), [None, '777', '778'])
+
+    def test_storage_tools_conflicts_commit_with_book(self):
+        """A store interrupted before its clusters are merged should write nothing"""
+        tools.store_book_with_conflicts(self.incoming)
+        incoming = dict(self.incoming, publisher_id='778', aliases=[
+            {'scheme': 'PUB_ID', 'value': '778'}, {'scheme': 'ISBN-10', 'value': '1'}])
+
+        def interrupted(components):
+            raise OperationalError('database is locked')
+        merge_clusters = clusters.merge_clusters
+        self.addCleanup(setattr, clusters, 'merge_clusters', merge_clusters)
+        clusters.merge_clusters = interrupted
+        self.assertRaises(OperationalError, tools.store_book_with_conflicts, incoming)
+        self.assertEqual(Book.objects.count(), 1)
+
+        # Stored again, the record is new rather than unchanged, so its conflict is written.
+        clusters.merge_clusters = merge_clusters
+        book, update_type, num_conflicts = tools.store_book_with_conflicts(incoming)
+        self.assertEqual((update_type, num_conflicts), ('Created', 1))
+        self.assertEqual(Book.objects.get(pk=book.pk).cluster_id,
+                         Book.objects.get(publisher_id='777').cluster_id)
+
+    def test_storage_tools_insert_or_ignore(self):
+        """insert_or_ignore should insert a row once and then leave it alone"""
+        book = Book.objects.create(title='Title')
+        self.assertTrue(tools.insert_or_ignore(Alias(book=book, scheme='S', value='V'),
+                                               ['book', 'scheme', 'value']))
+        alias = Alias(book=book, scheme='S', value='V')
+        self.assertFalse(tools.insert_or_ignore(alias, ['book', 'scheme', 'value']))
+        self.assertIsNone(alias.pk)
+        self.assertIsNotNone(Alias.objects.get().last_modified_time)
+
+
+class TestVersions(TestCase):
+    incoming = {
+        'publisher_id': '555',
+        'title': 'First edition',
+        'description': '',
+        'version': '1.0',
+        'aliases': [{'scheme': 'PUB_ID', 'value': '555'}, {'scheme': 'ISBN-10', 'value': '1'}]}
+
+    def second_edition(self):
+        return dict(self.incoming, title='Second edition', version='2.0', aliases=(
+            self.incoming['aliases'] + [{'scheme': 'ISBN-13', 'value': '2'}]))
+
+    def test_storage_tools_extract_book_data_version(self):
+        """extract_book_data should read the <version>, if there is one"""
+        xml = u'<book id="1"><title>T</title>{}</book>'
+        self.assertEqual(tools.extract_book_data(
+            etree.fromstring(xml.format('<version> 2.1 </version>'))).version, '2.1')
+        self.assertIsNone(tools.extract_book_data(etree.fromstring(xml.format(''))).version)
+
+    def test_storage_tools_version_key(self):
+        """Versions should compare part by part, numbers as numbers"""
+        versions = ['1', '1.2', '1.10', '2.0', '2.0.1', '2.0.1b', '10']
+        self.assertEqual(sorted(reversed(versions), key=tools.version_key), versions)
+
+    def test_storage_tools_older_version_is_skipped(self):
+        """A version older than or equal to the stored one should be skipped without writing"""
+        tools.store_book_with_conflicts(self.second_edition())
+        for incoming in (self.incoming, self.second_edition()):
+            with self.assertNumQueries(1):
+                book, update_type, num_conflicts = tools.store_book_with_conflicts(incoming)
+            self.assertEqual((update_type, num_conflicts), (tools.SKIPPED_STALE, 0))
+        book = Book.objects.get()
+        self.assertEqual((book.title, book.version), ('Second edition', '2.0'))
+        self.assertEqual(book.aliases.count(), 3)
+
+    def test_storage_tools_newer_version_is_stored(self):
+        """A newer version should update the book and its version, even with the same data"""
+        tools.store_book_with_conflicts(self.incoming)
+        book, update_type, num_conflicts = tools.store_book_with_conflicts(self.second_edition())
+        self.assertEqual(update_type, 'Updated')
+        self.assertEqual(Book.objects.get().version, '2.0')
+        book, update_type, num_conflicts = tools.store_book_with_conflicts(
+            dict(self.second_edition(), version='2.1'))
+        self.assertEqual(update_type, 'Updated')
+        self.assertEqual(Book.objects.get().version, '2.1')
+
+    def test_storage_tools_batch_skips_stale_versions(self):
+        """The batch path should skip stale records, reading the stored versions in one query"""
+        tools.store_books_with_conflicts([self.second_edition()])
+        books = [dict(self.incoming, publisher_id=str(n), title='Book {}'.format(n),
+                      aliases=[{'scheme': 'PUB_ID', 'value': str(n)}]) for n in range(20)]
+        tools.store_books_with_conflicts([dict(book, version='3.0') for book in books])
+
+        with CaptureQueriesContext(connection) as context:
+            results = tools.store_books_with_conflicts(books + [self.incoming])
+        self.assertEqual([result[1] for result in results], [tools.SKIPPED_STALE] * 21)
+        statements = [query['sql'] for query in context.captured_queries]
+        self.assertFalse([sql for sql in statements if 'INSERT' in sql or 'UPDATE' in sql])
+        self.assertEqual(len([sql for sql in statements if 'FROM "storage_book"' in sql]), 1)
+        self.assertEqual(Book.objects.get(publisher_id='555').title, 'Second edition')
+
+
+class TestRetryWhenLocked(SimpleTestCase):
+
+    def setUp(self):
+        self.calls = 0
+        self.locked_backoff = tools.LOCKED_BACKOFF
+        tools.LOCKED_BACKOFF = 0
+
+    def tearDown(self):
+        tools.LOCKED_BACKOFF = self.locked_backoff
+
+    def _fail_then_succeed(self, times, message):
+        self.calls += 1
+        if self.calls <= times:
+            raise OperationalError(message)
+        return self.calls
+
+    def test_storage_tools_retry_when_locked(self):
+        """retry_when_locked should call again while the database is locked, then give up"""
+        self.assertEqual(
+            tools.retry_when_locked(self._fail_then_succeed, 2, 'database is locked'), 3)
+        self.calls = 0
+        with self.assertRaises(OperationalError):
+            tools.retry_when_locked(
+                self._fail_then_succeed, tools.LOCKED_ATTEMPTS, 'database is locked')
+        self.assertEqual(self.calls, tools.LOCKED_ATTEMPTS)
+
+    def test_storage_tools_retry_when_locked_other_errors(self):
+        """retry_when_locked should not retry errors other than a locked database"""
+        with self.assertRaises(OperationalError):
+            tools.retry_when_locked(self._fail_then_succeed, 1, 'no such table: storage_book')
+        self.assertEqual(self.calls, 1)
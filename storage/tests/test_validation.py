@@ -0,0 +1,58 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+from django.core.exceptions import ValidationError
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+
+from storage import validation
+from storage.models import Alias, Book, FailedRecord
+
+
+class TestValidation(TestCase):
+
+    def assertSameErrors(self, obj):
+        """Both full_clean and validate_instance should reject obj with the same messages"""
+        with self.assertRaises(ValidationError) as expected:
+            obj.full_clean()
+        with self.assertRaises(ValidationError) as actual:
+            validation.validate_instance(obj)
+        self.assertEqual(actual.exception.message_dict, expected.exception.message_dict)
+
+    def test_storage_validation_matches_full_clean(self):
+        """The compiled checks should reject what full_clean rejects, with its messages"""
+        self.assertSameErrors(Book(title='X' * 129))
+        self.assertSameErrors(Book(title=''))
+        self.assertSameErrors(Book(title=None))
+        self.assertSameErrors(FailedRecord(source='a.xml', stage='bogus', exception='E'))
+        book = Book.objects.create(title='The Title')
+        self.assertSameErrors(Alias(book=book, scheme='X' * 41, value='Y' * 256))
+
+    def test_storage_validation_accepts_valid(self):
+        """Valid instances and dicts should pass, including auto_now fields not yet filled in"""
+        validation.validate_instance(Book(title='X' * 128))
+        validation.validate_instance(FailedRecord(source='a.xml', stage='store', exception='E'))
+        validation.validate_values(Alias, {'scheme': 'ISBN-10', 'value': '0000000000'})
+
+    def test_storage_validation_values(self):
+        """validate_values should check only the fields given, keyed by field name"""
+        with self.assertRaises(ValidationError) as raised:
+            validation.validate_values(Alias, {'scheme': 'X' * 41, 'value': ''})
+        self.assertEqual(sorted(raised.exception.message_dict), ['scheme', 'value'])
+
+    def test_storage_validation_update_fields(self):
+        """save(update_fields=...) should only check the fields it writes"""
+        book = Book.objects.create(title='The Title')
+        book.title = 'X' * 1000
+        book.description = 'Short'
+        book.save(update_fields=['description'])
+        with self.assertRaises(ValidationError):
+            book.save(update_fields=['title'])
+
+    def test_storage_validation_no_queries(self):
+        """Saving should not SELECT to check uniqueness or foreign keys first"""
+        book = Book.objects.create(title='The Title')
+        with CaptureQueriesContext(connection) as queries:
+            Alias.objects.create(book=book, scheme='ISBN-10', value='0000000000')
+        self.assertEqual(len(queries), 1)
@@ -0,0 +1,144 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+import json
+
+from django.core.cache import cache
+from django.core.urlresolvers import reverse
+from django.test import TestCase
+from django.utils.http import http_date
+
+from storage import clusters, views
+from storage.models import Alias, Book, Conflict
+
+
+class TestApi(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.book = Book.objects.create(title='The Title', description='About it')
+        self.other = Book.objects.create(title='Other')
+        Alias.objects.create(book=self.book, scheme='PUB_ID', value='p1')
+        Alias.objects.create(book=self.book, scheme='ISBN-10', value='1')
+        shared = Alias.objects.create(book=self.other, scheme='ISBN-10', value='1')
+        Conflict.objects.create(book=self.book, alias=shared)
+
+    def get_json(self, url, data=None, **headers):
+        response = self.client.get(url, data or {}, **headers)
+        if response.status_code == 304:
+            return response, None
+        self.assertEqual(response['Content-Type'], 'application/json')
+        return response, json.loads(response.content)
+
+    def test_storage_api_book(self):
+        """A book should come with its aliases and conflicts"""
+        response, data = self.get_json(reverse('api_book', args=[self.book.pk]))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['title'], 'The Title')
+        self.assertEqual(data['aliases'], [{'scheme': 'ISBN-10', 'value': '1'},
+                                           {'scheme': 'PUB_ID', 'value': 'p1'}])
+        self.assertEqual(data['conflicts'],
+                         [{'book_id': self.other.pk, 'scheme': 'ISBN-10', 'value': '1'}])
+        response, data = self.get_json(reverse('api_book', args=[self.other.pk + 1]))
+        self.assertEqual(response.status_code, 404)
+
+    def test_storage_api_book_conditional_get(self):
+        """A book should answer a matching conditional GET with a 304 and one query"""
+        url = reverse('api_book', args=[self.book.pk])
+        response, data = self.get_json(url)
+        etag = response['ETag']
+        with self.assertNumQueries(1):
+            response, data = self.get_json(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        # A deletion moves no modification time, so there is no Last-Modified to go by.
+        self.assertFalse(response.has_header('Last-Modified'))
+        response, data = self.get_json(url, HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+
+        # Without validators, the body comes from the cache after the validator query.
+        with self.assertNumQueries(1):
+            response, data = self.get_json(url)
+        self.assertEqual(data['title'], 'The Title')
+
+        # Removing an alias changes no modification time, but does change the ETag.
+        Alias.objects.filter(scheme='PUB_ID').delete()
+        response, data = self.get_json(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(data['aliases']), 1)
+        response, data = self.get_json(url, HTTP_IF_MODIFIED_SINCE=http_date())
+        self.assertEqual(response.status_code, 200)
+
+    def test_storage_api_cluster_change(self):
+        """Joining a cluster should change the validators of the book and its identifiers"""
+        url = reverse('api_book', args=[self.book.pk])
+        response, data = self.get_json(url)
+        self.assertEqual(data['cluster_id'], None)
+        resolve_url = reverse('api_resolve')
+        identifier = {'scheme': 'PUB_ID', 'value': 'p1'}
+        resolved = self.client.get(resolve_url, identifier)
+
+        clusters.merge_clusters([[self.book.pk, self.other.pk]])
+        response, data = self.get_json(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['cluster_id'], self.book.pk)
+        response, data = self.get_json(resolve_url, identifier,
+                                       HTTP_IF_NONE_MATCH=resolved['ETag'])
+        self.assertEqual(data['books'][0]['cluster_id'], self.book.pk)
+
+    def test_storage_api_resolve(self):
+        """resolve should list the books holding an identifier and honor its ETag"""
+        url = reverse('api_resolve')
+        response, data = self.get_json(url, {'scheme': 'ISBN-10', 'value': '1'})
+        self.assertEqual([book['id'] for book in data['books']], [self.book.pk, self.other.pk])
+        response, data = self.get_json(url, {'scheme': 'ISBN-10', 'value': '1'},
+                                       HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+        response, data = self.get_json(url, {'scheme': 'ISBN-10', 'value': '2'})
+        self.assertEqual(response.status_code, 404)
+        response, data = self.get_json(url, {'scheme': 'ISBN-10'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_storage_api_resolve_batch(self):
+        """resolve_batch should resolve many identifiers, in order, in one query"""
+        identifiers = [{'scheme': 'PUB_ID', 'value': 'p1'},
+                       {'scheme': 'PUB_ID', 'value': '1'},
+                       {'scheme': 'ISBN-10', 'value': '1'}]
+        identifiers += [{'scheme': 'ISBN-13', 'value': str(n)} for n in range(500)]
+        with self.assertNumQueries(1):
+            response = self.client.post(
+                reverse('api_resolve_batch'), json.dumps({'identifiers': identifiers}),
+                content_type='application/json')
+        results = json.loads(response.content)['results']
+        self.assertEqual(len(results), 503)
+        self.assertEqual([result['book_ids'] for result in results[:4]],
+                         [[self.book.pk], [], [self.book.pk, self.other.pk], []])
+
+        response = self.client.post(reverse('api_resolve_batch'), '{"identifiers": [1]}',
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+        for value in (1, ['1'], {'1': '1'}):
+            response = self.client.post(
+                reverse('api_resolve_batch'),
+                json.dumps({'identifiers': [{'scheme': 'ISBN-10', 'value': value}]}),
+                content_type='application/json')
+            self.assertEqual(response.status_code, 400)
+        # A rejected number must not hide the book holding its digits.
+        response = self.client.post(
+            reverse('api_resolve_batch'),
+            json.dumps({'identifiers': [{'scheme': 'ISBN-10', 'value': '1'}]}),
+            content_type='application/json')
+        self.assertEqual(json.loads(response.content)['results'][0]['book_ids'],
+                         [self.book.pk, self.other.pk])
+        response = self.client.get(reverse('api_resolve_batch'))
+        self.assertEqual(response.status_code, 405)
+
+    def test_storage_api_resolve_batch_limit(self):
+        """resolve_batch should refuse requests over MAX_BATCH_IDENTIFIERS"""
+        identifiers = [{'scheme': 'ISBN-13', 'value': str(n)}
+                       for n in range(views.MAX_BATCH_IDENTIFIERS + 1)]
+        response = self.client.post(
+            reverse('api_resolve_batch'), json.dumps({'identifiers': identifiers}),
+            content_type='application/json')
+        self.assertEqual(response.status_code, 400)
@@ -2,43 +2,479 @@
 
 # Created by David Rideout <drideout@safaribooksonline.com> on 2/7/14 4:58 PM
 # Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
-from django.db import transaction
+import hashlib
+import json
+import re
+import time
+from collections import defaultdict
+from contextlib import contextmanager
 
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction, DatabaseError, IntegrityError, OperationalError
+from django.db.models import AutoField, Max
+
+from storage import caching, clusters, instrumentation, validation
+from storage.records import AliasRecord, BookRecord, book_record
 from storage.models import Alias, Book, Conflict
 
+DEFAULT_BATCH_SIZE = 500
+
+# SQLite refuses statements with more than 999 bound parameters; keep `__in` lookups below that.
+MAX_QUERY_PARAMS = 900
+
+# How many times a write refused because another process holds the database lock is tried, and
+# the pause before the first retry, in seconds; each further pause is twice as long.
+LOCKED_ATTEMPTS = 5
+LOCKED_BACKOFF = 0.1
+
+# update_type of a record whose version is not newer than the stored book's.
+SKIPPED_STALE = 'Skipped (stale)'
+
+
+class PublisherIdTaken(Exception):
+    """Another importer created the Book for this publisher id after it was looked up"""
+
 
 def process_book_element(book_element):
     """Process a book element into the database.
 
     Simple wrapper method that takes XML as input.
     """
-    incoming = extract_book_data(book_element)
-    book, update_type, num_conflicts = store_book_with_conflicts(incoming)
+    with instrumentation.stage('extract'):
+        incoming = extract_book_data(book_element)
+    book, update_type, num_conflicts = retry_when_locked(store_book_with_conflicts, incoming)
     return book, update_type, num_conflicts
 
 
-def store_book_with_conflicts(incoming):
-    """Given a dict of incoming data, persist a Book, its Aliases, and and any Conflicts
+def process_book_elements(book_elements, batch_size=DEFAULT_BATCH_SIZE, alias_index=None):
+    """Process an iterable of book elements into the database, batch_size books at a time.
+
+    Yields one result per element, in order: the (book, update_type, num_conflicts) tuple that
+    process_book_element would have returned, or the exception that rejected the element.
+    """
+    batch = []
+    for book_element in book_elements:
+        with instrumentation.stage('extract'):
+            try:
+                batch.append(extract_book_data(book_element))
+            except ValueError as err:
+                batch.append(err)
+        if len(batch) >= batch_size:
+            for result in store_books_with_conflicts(batch, alias_index=alias_index):
+                yield result
+            batch = []
+    for result in store_books_with_conflicts(batch, alias_index=alias_index):
+        yield result
+
+
+def store_books_with_conflicts(incomings, alias_index=None):
+    """Batch version of store_book_with_conflicts; return a list with one result per incoming book
+
+    Each result is the (book, update_type, num_conflicts) tuple store_book_with_conflicts would
+    have returned had the books been stored one after another, or the exception that rejected
+    the record. Entries of `incomings` that already are exceptions are passed through untouched.
+
+    PUB_IDs are resolved, Books and Aliases created and Conflicts detected with a handful of
+    set-based queries per batch instead of several queries per alias. With a warmed
+    storage.index.AliasIndex, lookups it can answer skip the database altogether.
+    """
+    results = [None] * len(incomings)
+    valid = []
+    for index, incoming in enumerate(incomings):
+        if isinstance(incoming, Exception):
+            results[index] = incoming
+            continue
+        try:
+            with instrumentation.stage('validate'):
+                incoming = book_record(incoming)
+                validate_incoming(incoming)
+        except ValidationError as err:
+            results[index] = err
+            continue
+        valid.append((index, incoming))
+
+    for run in _independent_runs(valid):
+        with instrumentation.stage('lookup'):
+            found = _alias_holders(
+                set(('PUB_ID', incoming.publisher_id) for index, incoming in run), alias_index)
+
+        # A Book found twice in one run has to see its first update before the second one.
+        entries, seen = [], set()
+        for index, incoming in run:
+            holders = found[('PUB_ID', incoming.publisher_id)]
+            book_id = holders[0][1] if len(holders) == 1 else None
+            if book_id is not None and book_id in seen:
+                _store_run(entries, results, alias_index)
+                entries, seen = [], set()
+            entries.append((index, incoming, book_id, not holders))
+            seen.add(book_id)
+        _store_run(entries, results, alias_index)
+    return results
+
+
+def validate_incoming(incoming):
+    """Raise a ValidationError if the incoming book would not make a valid Book and Aliases"""
+    incoming = book_record(incoming)
+    validation.validate_values(
+        Book, {'title': incoming.title, 'description': incoming.description,
+               'version': incoming.version})
+    for alias in incoming.aliases:
+        validation.validate_values(Alias, {'scheme': alias.scheme, 'value': alias.value})
+
+
+def _independent_runs(indexed_incomings):
+    """Split (index, incoming) pairs into runs whose PUB_ID lookups do not depend on each other
+
+    A record whose publisher id matches a PUB_ID alias written earlier in the same run would
+    resolve differently once that alias exists, so it starts a new run.
+    """
+    run, pending = [], set()
+    for index, incoming in indexed_incomings:
+        if incoming.publisher_id in pending:
+            yield run
+            run, pending = [], set()
+        run.append((index, incoming))
+        pending.update(alias.value for alias in incoming.aliases if alias.scheme == 'PUB_ID')
+    if run:
+        yield run
+
+
+def _store_run(entries, results, alias_index):
+    """Store (index, incoming, book_id, unheld) entries, each for a distinct Book, into results
+
+    unheld tells that no Book held the publisher id when it was looked up, so a new Book claims
+    it. If the set-based write fails (a concurrent importer claiming the same publisher id or
+    alias makes it violate a unique constraint) the whole run is rolled back and replayed one
+    record at a time, so a single bad record only costs itself.
+    """
+    if not entries:
+        return
+
+    def bulk_store():
+        try:
+            with write_transaction():
+                return _bulk_store(entries, alias_index)
+        except (DatabaseError, ValidationError):
+            if alias_index is not None:
+                # Entries may describe rows that were just rolled back.
+                alias_index.forget()
+            raise
+
+    try:
+        stored = retry_when_locked(bulk_store)
+    except (DatabaseError, ValidationError) as err:
+        if is_locked(err):
+            # Not the records' fault: the caller's transaction has to run again.
+            raise
+        for index, incoming, book_id, unheld in entries:
+            try:
+                results[index] = retry_when_locked(
+                    store_book_with_conflicts, incoming, alias_index=alias_index)
+            except Exception as err:
+                if is_locked(err):
+                    raise
+                results[index] = err
+        return
+    for (index, incoming, book_id, unheld), result in zip(entries, stored):
+        results[index] = result
+
+
+def _bulk_store(entries, alias_index):
+    """Write the Books, Aliases and Conflicts for a run; return a result tuple per entry"""
+    with instrumentation.stage('write_books'):
+        existing = {}
+        for book in in_chunks(Book.objects.all(), 'pk', [e[2] for e in entries if e[2]]):
+            existing[book.pk] = book
+
+        books, update_types, new_books, updated = [], [], [], {}
+        for index, incoming, book_id, unheld in entries:
+            if book_id is None:
+                book = Book(publisher_id=incoming.publisher_id if unheld else None)
+                new_books.append(book)
+                update_types.append('Created')
+            else:
+                # The stored versions of the whole run came with the Books, in the query above.
+                book = existing[book_id]
+                skipped = skip_reason(book, incoming)
+                if skipped:
+                    books.append(book)
+                    update_types.append(skipped)
+                    continue
+                updated[book.pk] = changed_fields(book, incoming)
+                update_types.append('Updated')
+            book.title = incoming.title
+            book.description = incoming.description
+            book.fingerprint = fingerprint(incoming)
+            if incoming.version is not None:
+                book.version = incoming.version
+            books.append(book)
+
+        for book_id, fields in updated.items():
+            existing[book_id].save(update_fields=fields)
+        _bulk_create_with_ids(Book, new_books)
+
+    with instrumentation.stage('write_aliases'):
+        # Aliases the updated Books already hold, and the position of the record adding each
+        # new one.
+        old_aliases = set(in_chunks(
+            Alias.objects.values_list('book_id', 'scheme', 'value'), 'book_id', updated))
+        new_aliases = {}
+        for position, (book, (index, incoming, book_id, unheld)) in enumerate(
+                zip(books, entries)):
+            if update_types[position] in ('Unchanged', SKIPPED_STALE):
+                continue
+            for scheme, value in incoming.aliases:
+                key = (book.id, scheme, value)
+                if key not in old_aliases and key not in new_aliases:
+                    new_aliases[key] = position
+        created = _bulk_create_with_ids(
+            Alias, [Alias(book_id=key[0], scheme=key[1], value=key[2]) for key in new_aliases])
+        if alias_index is not None:
+            for alias in created:
+                alias_index.add(alias.id, alias.book_id, alias.scheme, alias.value)
+
+    with instrumentation.stage('conflicts'):
+        pairs_by_book = defaultdict(set)
+        for book_id, scheme, value in old_aliases.union(new_aliases):
+            pairs_by_book[book_id].add((scheme, value))
+        holders = _alias_holders(
+            set(pair for pairs in pairs_by_book.values() for pair in pairs), alias_index)
+
+        old_conflicts = set(in_chunks(
+            Conflict.objects.values_list('book_id', 'alias_id'), 'book_id', updated))
+        new_conflicts = []
+        num_conflicts = []
+        linked = []
+        for position, book in enumerate(books):
+            num_created = 0
+            group = [book.id]
+            for scheme, value in pairs_by_book[book.id]:
+                for alias_id, holder_id in holders[(scheme, value)]:
+                    # Same as get_alias_conflicts at this point in a one-by-one import: skip
+                    # our own aliases and the ones later records in this run have not written.
+                    if holder_id == book.id:
+                        continue
+                    if new_aliases.get((holder_id, scheme, value), -1) > position:
+                        continue
+                    group.append(holder_id)
+                    if (book.id, alias_id) in old_conflicts:
+                        continue
+                    old_conflicts.add((book.id, alias_id))
+                    new_conflicts.append(Conflict(book_id=book.id, alias_id=alias_id))
+                    num_created += 1
+            num_conflicts.append(num_created)
+            linked.append(group)
+        Conflict.objects.bulk_create(new_conflicts)
+        # Neither bulk_create sends signals.
+        caching.invalidate_aliases((scheme, value) for book_id, scheme, value in new_aliases)
+        caching.invalidate_books([book.pk for book in new_books] +
+                                 [key[0] for key in new_aliases] +
+                                 [conflict.book_id for conflict in new_conflicts])
+    with instrumentation.stage('clusters'):
+        clusters.merge_clusters(linked)
+
+    return zip(books, update_types, num_conflicts)
+
+
+def _alias_holders(pairs, alias_index=None):
+    """Return a dict of (scheme, value) -> list of (alias id, book id) for each of pairs
+
+    Pairs the alias index can answer cost nothing; the rest are fetched in one chunked query.
+    """
+    holders = {}
+    unknown = set()
+    for scheme, value in pairs:
+        known = alias_index.lookup(scheme, value) if alias_index is not None else None
+        if known is None:
+            unknown.add((scheme, value))
+            holders[(scheme, value)] = []
+        else:
+            holders[(scheme, value)] = list(known)
+    if unknown:
+        for alias_id, book_id, scheme, value in in_chunks(
+                Alias.objects.values_list('id', 'book_id', 'scheme', 'value'), 'value',
+                set(value for scheme, value in unknown)):
+            if (scheme, value) in unknown:
+                holders[(scheme, value)].append((alias_id, book_id))
+        if alias_index is not None:
+            for pair in unknown:
+                alias_index.remember(pair[0], pair[1], holders[pair])
+    return holders
+
+
+def _bulk_create_with_ids(model, objs):
+    """bulk_create objs and set their primary keys, which Django does not hand back
+
+    SQLite gives a new row max(rowid) + 1 and holds the write lock until the surrounding
+    transaction commits, so the rows just inserted carry the last len(objs) ids. Other
+    backends fall back to one INSERT per object.
+    """
+    if not objs:
+        return objs
+    # bulk_create skips save(), so check here what save() would have.
+    validation.validate_batch(objs)
+    if connection.vendor != 'sqlite':
+        for obj in objs:
+            obj.save()
+        return objs
+    model.objects.bulk_create(objs)
+    last_id = model.objects.aggregate(last_id=Max('pk'))['last_id']
+    for offset, obj in enumerate(reversed(objs)):
+        obj.pk = last_id - offset
+        obj._state.adding = False
+        obj._state.db = connection.alias
+    return objs
+
+
+def insert_or_ignore(obj, unique_fields):
+    """INSERT obj unless a row with the same unique_fields exists; return whether it was inserted
+
+    The database settles a race between importers adding the same row: the second INSERT ... ON
+    CONFLICT DO NOTHING writes nothing instead of failing. obj gets its primary key when it is
+    inserted. Like bulk_create, no signals are sent. Backends without ON CONFLICT save() in a
+    savepoint instead.
+    """
+    validation.validate_instance(obj)
+    if connection.vendor not in ('sqlite', 'postgresql'):
+        try:
+            with transaction.atomic():
+                obj.save(force_insert=True)
+        except IntegrityError:
+            return False
+        return True
+    opts = obj._meta
+    qn = connection.ops.quote_name
+    fields = [field for field in opts.concrete_fields if not isinstance(field, AutoField)]
+    sql = ('INSERT INTO {table} ({columns}) VALUES ({params}) '
+           'ON CONFLICT ({unique}) DO NOTHING').format(
+        table=qn(opts.db_table),
+        columns=', '.join(qn(field.column) for field in fields),
+        params=', '.join(['%s'] * len(fields)),
+        unique=', '.join(qn(opts.get_field(name).column) for name in unique_fields))
+    if connection.vendor == 'postgresql':
+        sql += ' RETURNING {}'.format(qn(opts.pk.column))
+    cursor = connection.cursor()
+    cursor.execute(sql, [field.get_db_prep_save(field.pre_save(obj, True), connection)
+                         for field in fields])
+    if cursor.rowcount != 1:
+        return False
+    obj.pk = cursor.fetchone()[0] if connection.vendor == 'postgresql' else cursor.lastrowid
+    obj._state.adding = False
+    obj._state.db = connection.alias
+    return True
+
+
+def retry_when_locked(func, *args, **kwargs):
+    """Call func, and again after a pause while the database reports it is locked
+
+    SQLite lets one process write at a time. A writer waits for the lock up to the connection's
+    timeout, but a transaction that read before another process wrote cannot wait and fails at
+    once with "database is locked"; run again from the start, it reads the other's rows. Inside
+    a transaction nothing is retried, as the failure has undone the statements before it.
+    """
+    for attempt in range(LOCKED_ATTEMPTS):
+        try:
+            return func(*args, **kwargs)
+        except OperationalError as err:
+            if connection.in_atomic_block or attempt == LOCKED_ATTEMPTS - 1 or not is_locked(err):
+                raise
+        time.sleep(LOCKED_BACKOFF * 2 ** attempt)
+
+
+@contextmanager
+def write_transaction():
+    """transaction.atomic() that takes the SQLite write lock as it begins
+
+    SQLite's BEGIN is deferred: a transaction that has read cannot wait for another process to
+    finish writing, so its first write fails at once with "database is locked". Taking the lock
+    before reading, with a write that changes nothing, makes concurrent importers wait their
+    turn for up to the connection's timeout instead.
+    """
+    outermost = not connection.in_atomic_block
+    with transaction.atomic():
+        if outermost and connection.vendor == 'sqlite':
+            connection.cursor().execute(
+                'DELETE FROM {} WHERE 0'.format(connection.ops.quote_name(Book._meta.db_table)))
+        yield
+
+
+def is_locked(err):
+    """Return whether err is the database refusing a write because another process holds it"""
+    message = str(err)
+    return isinstance(err, OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def in_chunks(queryset, field, values):
+    """Yield the rows of queryset filtered on `field__in=values`, a chunk of values at a time"""
+    values = list(values)
+    for start in range(0, len(values), MAX_QUERY_PARAMS):
+        for row in queryset.filter(**{field + '__in': values[start:start + MAX_QUERY_PARAMS]}):
+            yield row
+
+
+def store_book_with_conflicts(incoming, alias_index=None):
+    """Given an incoming BookRecord or dict, persist a Book, its Aliases, and and any Conflicts
 
     We store the publisher id as another alias. If we have any alias conflicts (including pub_id)
     we create a Conflict object so we can research and fix the issue. Possible resolutions can
     include correcting the data or merging aliases/books to point to the canonical book.
 
-    Since this takes an incoming dictionary, it could work just fine with the results of
+    A Book whose stored fingerprint matches the incoming data is reported as 'Unchanged', and
+    one whose stored version is newer than or the same as the incoming one as 'Skipped (stale)';
+    nothing is written for either.
+
+    Since this also takes an incoming dictionary, it could work just fine with the results of
     a form's cleaned_data output with similar structure.
     """
-    found = Alias.objects.filter(scheme='PUB_ID', value=incoming['publisher_id'])
-    num_found = found.count()
-    if num_found == 1:
-        book = found[0].book
+    incoming = book_record(incoming)
+    with instrumentation.stage('lookup'):
+        known = None
+        if alias_index is not None:
+            known = alias_index.lookup('PUB_ID', incoming.publisher_id)
+        if known is not None:
+            num_holders = len(known)
+            found = [Book.objects.get(pk=known[0][1])] if num_holders == 1 else []
+        else:
+            # One query; two rows are enough to tell a unique match from an ambiguous one.
+            found = list(Book.objects.filter(
+                aliases__scheme='PUB_ID', aliases__value=incoming.publisher_id)[:2])
+            num_holders = len(found)
+    if len(found) == 1:
+        book = found[0]
         update_type = 'Updated'
     else:
-        book = Book()
+        # Only a publisher id no Book holds yet is claimed; an ambiguous one makes a new Book.
+        book = Book(publisher_id=None if num_holders else incoming.publisher_id)
         update_type = 'Created'
 
-    book = populate_and_save(book, incoming)
-    conflicted_aliases = get_alias_conflicts(book)
-    num_conflicts = create_conflicts(book, conflicted_aliases)
+    skipped = skip_reason(book, incoming) if update_type == 'Updated' else None
+    if skipped:
+        # Nothing to write, and a re-delivered record does not look for conflicts again.
+        return book, skipped, 0
+    try:
+        # The conflicts and clusters commit with the book: a book saved without them would
+        # look unchanged when its record is stored again, and they would never be written.
+        with write_transaction():
+            try:
+                book = populate_and_save(book, incoming, alias_index=alias_index)
+            except PublisherIdTaken:
+                book = Book.objects.get(publisher_id=incoming.publisher_id)
+                skipped = skip_reason(book, incoming)
+                if skipped:
+                    return book, skipped, 0
+                update_type = 'Updated'
+                book = populate_and_save(book, incoming, alias_index=alias_index)
+            with instrumentation.stage('conflicts'):
+                conflicted_aliases = get_alias_conflicts(book)
+                num_conflicts = create_conflicts(book, conflicted_aliases)
+            with instrumentation.stage('clusters'):
+                clusters.merge_clusters(
+                    [[book.id] + [alias.book_id for alias in conflicted_aliases]])
+    except (DatabaseError, ValidationError):
+        if alias_index is not None:
+            # The index may have been told about aliases that were just rolled back.
+            alias_index.forget()
+        raise
     return book, update_type, num_conflicts
 
 
@@ -46,47 +482,145 @@ def create_conflicts(book, dupe_aliases):
     """Create a Conflict object for each alias duplicate; return count of newly created Conflicts"""
     num_created = 0
     for alias in dupe_aliases:
-        conflict, created = Conflict.objects.get_or_create(book=book, alias=alias)
-        num_created = num_created + 1 if created else num_created
+        if insert_or_ignore(Conflict(book=book, alias=alias), ['book', 'alias']):
+            num_created += 1
+    if num_created:
+        caching.invalidate_books([book.pk])
     return num_created
 
 
 def get_alias_conflicts(book):
-    """Return a list of Aliases on other books that match the aliases on newly created Book"""
-    conflicts = []
-    for a in book.aliases.all():
-        conflicts.append(Alias.objects.filter(scheme=a.scheme, value=a.value).exclude(book=book))
+    """Return a list of Aliases on other books that match the aliases on newly created Book
+
+    All of the book's (scheme, value) pairs are matched in a single self-join on the
+    (scheme, value) index, however many aliases the book has.
+    """
+    return list(Alias.objects.raw(
+        'SELECT other.* FROM {table} other '
+        'INNER JOIN {table} mine ON mine.scheme = other.scheme AND mine.value = other.value '
+        'WHERE mine.book_id = %s AND other.book_id != %s '
+        'ORDER BY mine.id, other.id'.format(table=Alias._meta.db_table),
+        [book.pk, book.pk]))
 
-    # The call `conflicts.append(Alias.obj...` results in a list of QuerySets; flatten those out.
-    flattened_conflicts = [item for found_set in conflicts for item in found_set]
-    return flattened_conflicts
 
+def populate_and_save(book, incoming, alias_index=None):
+    """Populate book object with values from an incoming book and save the Book/Aliases
 
-def populate_and_save(book, incoming):
-    """Populate book object with values from incoming dict and save the Book/Aliases"""
+    An existing Book only has the fields that changed written, and only gets the aliases it
+    does not hold yet. A new Book with a publisher_id is inserted only if no Book claims that id
+    already; otherwise PublisherIdTaken is raised and nothing is written.
+    """
 
     # Save book AND aliases as one transaction; an error in alias
     # creation would leave a book without complete alias data.
-    with transaction.atomic():
-        book.title = incoming['title']
-        book.description = incoming['description']
-        book.save()
-        for alias in incoming['aliases']:
-            book.aliases.get_or_create(scheme=alias['scheme'], value=alias['value'])
-        return book
+    incoming = book_record(incoming)
+    created_aliases = []
+    with write_transaction():
+        if book.pk is None:
+            held = set()
+            fields = None
+        else:
+            held = set(book.aliases.values_list('scheme', 'value'))
+            fields = changed_fields(book, incoming)
+        book.title = incoming.title
+        book.description = incoming.description
+        book.fingerprint = fingerprint(incoming)
+        if incoming.version is not None:
+            book.version = incoming.version
+        with instrumentation.stage('write_books'):
+            if fields is None and book.publisher_id is not None:
+                if not insert_or_ignore(book, ['publisher_id']):
+                    raise PublisherIdTaken(book.publisher_id)
+            elif fields is None or len(fields) > 1:
+                book.save(update_fields=fields)
+        with instrumentation.stage('write_aliases'):
+            for scheme, value in incoming.aliases:
+                if (scheme, value) not in held:
+                    held.add((scheme, value))
+                    # Another importer may have added the same alias since `held` was read.
+                    alias = Alias(book=book, scheme=scheme, value=value)
+                    if insert_or_ignore(alias, ['book', 'scheme', 'value']):
+                        created_aliases.append(alias)
+
+    # insert_or_ignore sends no signals.
+    caching.invalidate_books([book.pk])
+    caching.invalidate_aliases((alias.scheme, alias.value) for alias in created_aliases)
+    # Only tell the index about aliases that made it past the atomic block.
+    if alias_index is not None:
+        for alias in created_aliases:
+            alias_index.add(alias.id, book.id, alias.scheme, alias.value)
+    return book
+
+
+def fingerprint(incoming):
+    """Return a stable hash of an incoming book: title, description, publisher id and aliases"""
+    incoming = book_record(incoming)
+    normalized = [
+        incoming.title,
+        incoming.description,
+        incoming.publisher_id,
+        sorted([scheme, value] for scheme, value in incoming.aliases)]
+    return hashlib.sha1(json.dumps(normalized).encode('utf-8')).hexdigest()
+
+
+def version_key(version):
+    """Return a sort key for a version string, so that '1.2' < '1.10' < '2.0'
+
+    Runs of digits compare as numbers, runs of letters regardless of case and before digits;
+    other characters only separate the runs.
+    """
+    return [(1, int(part), '') if part.isdigit() else (0, 0, part.lower())
+            for part in re.findall(r'\d+|[^\W\d_]+', version, re.UNICODE)]
+
+
+def is_stale(book, incoming):
+    """Return whether a saved Book holds a version newer than or the same as an incoming book's
+
+    A book or record without a version is never stale.
+    """
+    incoming = book_record(incoming)
+    return bool(book.version and incoming.version and
+                version_key(incoming.version) <= version_key(book.version))
+
+
+def skip_reason(book, incoming):
+    """Return the update_type of a saved Book nothing need be written to for an incoming book
+
+    That is 'Skipped (stale)' if the incoming version is not newer, 'Unchanged' if the book was
+    last imported from the same data and version, and None if the book needs updating.
+    """
+    if is_stale(book, incoming):
+        return SKIPPED_STALE
+    if book.fingerprint == fingerprint(incoming) and incoming.version in (None, book.version):
+        return 'Unchanged'
+    return None
+
+
+def changed_fields(book, incoming):
+    """Return the update_fields needed to bring a saved Book in line with an incoming book"""
+    incoming = book_record(incoming)
+    fields = [name for name in ('title', 'description')
+              if getattr(book, name) != getattr(incoming, name)]
+    if incoming.version is not None and book.version != incoming.version:
+        fields.append('version')
+    if book.fingerprint != fingerprint(incoming):
+        fields.append('fingerprint')
+    return fields + ['last_modified_time']
 
 
 def extract_book_data(book_element):
-    """Return a dict of the data extracted from provided element
+    """Return a BookRecord of the data extracted from provided element
 
-    Note that the publisher id is available as a key in the dict and also stored as an alias with
-    a scheme of PUB_ID.
+    Note that the publisher id is available as a field of the record and also stored as an alias
+    with a scheme of PUB_ID.
 
-    The 'aliases' key will return a list of dicts with two keys: 'scheme' and 'value'
+    The aliases field holds a tuple of AliasRecords, with a scheme and a value each. The version
+    field holds the <version> element's text, or None if the element is missing or empty.
     """
     title = book_element.findtext('title', default='').strip()
     publisher_id = book_element.get('id', default='').strip()
     description = book_element.findtext('description', default='').strip()
+    version = book_element.findtext('version', default='').strip() or None
 
     if not title:
         raise ValueError('No data in title element')
@@ -94,12 +628,8 @@ def extract_book_data(book_element):
         raise ValueError('No data for publisher id')
 
     # Translate the publisher id into an alias, then add the other aliases
-    aliases = [{'scheme': 'PUB_ID', 'value': publisher_id}]
+    aliases = [AliasRecord('PUB_ID', publisher_id)]
     for alias in book_element.xpath('aliases/alias'):
-        aliases.append({'scheme': alias.get('scheme'), 'value': alias.get('value')})
+        aliases.append(AliasRecord(alias.get('scheme'), alias.get('value')))
 
-    return {
-        'publisher_id': publisher_id,
-        'title': title,
-        'description': description,
-        'aliases': aliases}
+    return BookRecord(publisher_id, title, description, aliases, version)
@@ -0,0 +1,9 @@
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns(
+    'storage.views',
+    url(r'^books/(?P<pk>\d+)/$', 'book_detail', name='api_book'),
+    url(r'^resolve/$', 'resolve', name='api_resolve'),
+    url(r'^resolve/batch/$', 'resolve_batch', name='api_resolve_batch'),
+    url(r'^changes/$', 'change_feed', name='api_changes'),
+)
@@ -0,0 +1,96 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Compiled field checks standing in for full_clean() on every save
+
+SQLite enforces neither CharField max_length nor blank, so something has to. full_clean() does,
+but it also re-runs every validator and issues a SELECT per unique_together and foreign key on
+every save. The checks here are worked out once per model from its fields (max_length, null,
+blank and choices) and applied to instances, plain dicts or whole batches before any write.
+Uniqueness and foreign keys are left to the database constraints.
+
+Failures raise the same ValidationError, keyed by field name with Django's own messages, that
+full_clean() would have raised.
+"""
+from django.core.exceptions import ValidationError
+from django.core.validators import MaxLengthValidator
+from django.db.models import AutoField
+
+_checks = {}
+
+
+class FieldCheck(object):
+    """What one field requires of its value"""
+    __slots__ = ('name', 'attname', 'max_length', 'null', 'blank', 'choices', 'messages',
+                 'empty_values')
+
+    def __init__(self, field):
+        self.name = field.name
+        self.attname = field.attname
+        self.max_length = field.max_length
+        self.null = field.null
+        self.blank = field.blank
+        self.choices = frozenset(value for value, label in field.flatchoices) or None
+        self.messages = field.error_messages
+        self.empty_values = field.empty_values
+
+    def errors(self, value):
+        """Return the list of messages for value, empty if it passes"""
+        if value in self.empty_values:
+            # As in full_clean, blank=True lets any empty value through, even None on a field
+            # that is not null (auto_now fields are only filled in on save).
+            if self.blank:
+                return []
+            if value is None and not self.null:
+                return [self.messages['null']]
+            return [self.messages['blank']]
+        if self.choices is not None and value not in self.choices:
+            return [self.messages['invalid_choice'] % {'value': value}]
+        if self.max_length is not None and len(value) > self.max_length:
+            return [MaxLengthValidator.message % {
+                'limit_value': self.max_length, 'show_value': len(value)}]
+        return []
+
+
+def checks_for(model):
+    """Return the FieldChecks of model, worked out on first use"""
+    checks = _checks.get(model)
+    if checks is None:
+        checks = _checks[model] = tuple(
+            FieldCheck(field) for field in model._meta.concrete_fields
+            if not isinstance(field, AutoField))
+    return checks
+
+
+def validate_values(model, values):
+    """Raise a ValidationError if the fields of model given in the values dict are not valid
+
+    Fields missing from values are not checked.
+    """
+    errors = {}
+    for check in checks_for(model):
+        if check.name in values:
+            messages = check.errors(values[check.name])
+            if messages:
+                errors[check.name] = messages
+    if errors:
+        raise ValidationError(errors)
+
+
+def validate_instance(obj, fields=None):
+    """Raise a ValidationError if obj, or just the named fields of it, would not be valid"""
+    errors = {}
+    for check in checks_for(type(obj)):
+        if fields is not None and check.name not in fields:
+            continue
+        messages = check.errors(getattr(obj, check.attname))
+        if messages:
+            errors[check.name] = messages
+    if errors:
+        raise ValidationError(errors)
+
+
+def validate_batch(objs):
+    """Raise a ValidationError for the first of objs that would not be valid"""
+    for obj in objs:
+        validate_instance(obj)
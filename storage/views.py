@@ -0,0 +1,168 @@
+# encoding: utf-8
+
+# Copyright (c) 2013 Safari Books Online, LLC. All rights reserved.
+"""Read-only JSON API resolving identifiers to books
+
+Book and single identifier responses carry an ETag computed by one indexed query and answer
+conditional GETs with 304. Their bodies come from the cache: storage.caching
+for books and batch lookups, the Django cache under the ETag for single identifiers. Either way
+a hot identifier never re-runs the joins behind its body.
+"""
+import hashlib
+import json
+
+from django.core.cache import cache
+from django.db.models import Count, Max
+from django.http import HttpResponse
+from django.utils import six
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import condition, require_GET, require_POST
+
+from storage import caching, changes
+from storage.models import Alias, Book
+from storage.serializers import serialize_book, to_json
+
+# Most identifiers one resolve_batch request may ask for.
+MAX_BATCH_IDENTIFIERS = 10000
+# Most books one change_feed page may hold.
+MAX_PAGE_SIZE = 5000
+
+
+def json_response(data, status=200):
+    return HttpResponse(to_json(data), content_type='application/json', status=status)
+
+
+def json_error(message, status=400):
+    return json_response({'error': message}, status=status)
+
+
+def _etag(key, *row):
+    """Return the ETag of a response whose source rows are summarized by row
+
+    row holds the modification times and row counts of everything the response shows; counts
+    catch deletions, which no modification time records, so no Last-Modified is sent. Book
+    fields that bulk writes set, such as cluster_id and version, are part of row too, in case a
+    write leaves the time as it was.
+    """
+    return hashlib.sha1(u'{}:{}'.format(key, row).encode('utf-8')).hexdigest()
+
+
+def _book_etag(request, pk):
+    if not hasattr(request, 'storage_etag'):
+        row = Book.objects.filter(pk=pk).annotate(
+            alias_time=Max('aliases__last_modified_time'),
+            num_aliases=Count('aliases', distinct=True),
+            conflict_time=Max('conflicted_books__last_modified_time'),
+            num_conflicts=Count('conflicted_books', distinct=True),
+        ).values_list(
+            'last_modified_time', 'cluster_id', 'version', 'alias_time', 'num_aliases',
+            'conflict_time', 'num_conflicts')
+        row = row.first()
+        request.storage_etag = None if row is None else _etag('book:{}'.format(pk), *row)
+    return request.storage_etag
+
+
+def _resolve_etag(request):
+    if not hasattr(request, 'storage_etag'):
+        scheme, value = request.GET.get('scheme'), request.GET.get('value')
+        row = Alias.objects.filter(scheme=scheme, value=value).aggregate(
+            num_books=Count('id'), alias_time=Max('last_modified_time'),
+            book_time=Max('book__last_modified_time'))
+        request.storage_etag = None
+        if row['num_books']:
+            request.storage_etag = _etag(
+                u'resolve:{}:{}'.format(scheme, value),
+                row['num_books'], row['alias_time'], row['book_time'])
+    return request.storage_etag
+
+
+def _cached_body(etag, build):
+    """Return the response body cached under etag, building and caching it on a miss"""
+    key = 'storage.api.{}'.format(etag)
+    body = cache.get(key)
+    if body is None:
+        body = to_json(build())
+        cache.set(key, body)
+    return body
+
+
+@require_GET
+@condition(etag_func=_book_etag)
+def book_detail(request, pk):
+    """A book with its aliases and conflicts"""
+    data = _book_etag(request, pk) and caching.get_book(pk)
+    if not data:
+        return json_error('No such book', status=404)
+    return json_response(data)
+
+
+@require_GET
+@condition(etag_func=_resolve_etag)
+def resolve(request):
+    """The books holding the identifier given as ?scheme=...&value=..."""
+    scheme, value = request.GET.get('scheme'), request.GET.get('value')
+    if not scheme or not value:
+        return json_error('Give both scheme and value')
+    etag = _resolve_etag(request)
+    if etag is None:
+        return json_error('No book holds this identifier', status=404)
+
+    def build():
+        books = Book.objects.filter(
+            aliases__scheme=scheme, aliases__value=value).order_by('id').distinct()
+        return {
+            'scheme': scheme,
+            'value': value,
+            'books': [{'id': book.id, 'title': book.title, 'cluster_id': book.cluster_id}
+                      for book in books],
+        }
+    return HttpResponse(_cached_body(etag, build), content_type='application/json')
+
+
+@csrf_exempt
+@require_POST
+def resolve_batch(request):
+    """Resolve many identifiers at once; read-only despite the POST, which only carries them
+
+    The body is {"identifiers": [{"scheme": ..., "value": ...}, ...]}. The answer lists, in the
+    same order, each identifier with the ids of the books holding it.
+    """
+    try:
+        identifiers = json.loads(request.body)['identifiers']
+        pairs = [(item['scheme'], item['value']) for item in identifiers]
+        # Identifiers are text; a number would be looked up as a different identifier.
+        if not all(isinstance(part, six.string_types) for pair in pairs for part in pair):
+            raise TypeError('Identifier schemes and values are strings')
+    except (ValueError, KeyError, TypeError):
+        return json_error('Expected {"identifiers": [{"scheme": "...", "value": "..."}, ...]}')
+    if len(pairs) > MAX_BATCH_IDENTIFIERS:
+        return json_error('At most {} identifiers per request'.format(MAX_BATCH_IDENTIFIERS))
+
+    holders = caching.resolve_many(pairs)
+    return json_response({
+        'results': [{'scheme': scheme, 'value': value, 'book_ids': holders[(scheme, value)]}
+                    for scheme, value in pairs],
+    })
+
+
+@require_GET
+def change_feed(request):
+    """The books modified after ?cursor=..., as JSON lines, at most ?limit=... of them
+
+    The cursor to pass next time comes back in the X-Next-Cursor header; it is the one given
+    when there are no changes yet. Books show up changes.SAFETY_WINDOW after they were modified,
+    so that import transactions still open when they were stamped have committed by then.
+    """
+    try:
+        page_size = min(int(request.GET.get('limit', changes.DEFAULT_PAGE_SIZE)), MAX_PAGE_SIZE)
+        if page_size < 1:
+            raise ValueError('limit must be positive')
+        books, cursor = changes.changes_page(request.GET.get('cursor'), page_size)
+    except ValueError as err:
+        return json_error(u'{}'.format(err))
+    response = HttpResponse(
+        ''.join(to_json(serialize_book(book)) + '\n' for book in books),
+        content_type='application/x-ndjson')
+    if cursor:
+        response['X-Next-Cursor'] = cursor
+    return response